@@ -1,4 +1,27 @@
-def create(plugname):
+import imp
+
+def create(plugname, isolated=False):
+   """
+   Load a generator plugin.
+
+   @param plugname: The module name of the plugin
+   @param isolated: If True, a new, private instance of the module is
+                    created. This allows running several profiles using the
+                    same plugin at the same time, as each instance gets its
+                    own module-level config.
+   """
+
+   if isolated:
+      fptr, pathname, description = imp.find_module(plugname, __path__)
+      if fptr:
+         fptr.close()
+      if description[2] != imp.PY_SOURCE:
+         raise ImportError("Unable to create an isolated instance of %r "
+               "(source file not found)" % plugname)
+      module = imp.new_module('pickup.generator_profile.%s' % plugname)
+      module.__file__ = pathname
+      execfile(pathname, module.__dict__)
+      return module
 
    if plugname in globals():
       module = reload(globals()[plugname])
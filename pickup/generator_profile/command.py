@@ -1,6 +1,7 @@
 """
-The command plugin executes a shell command. It will capture stdout and stderr
-to stdout.txt and stderr.txt respectively.
+The command plugin executes one or more shell commands. It will capture stdout
+and stderr to stdout.txt and stderr.txt respectively. The standard output can
+be compressed while it is captured.
 
 .. note::
    Piping multiple commands together does not work due to the simple usage of
@@ -15,6 +16,44 @@ The following fields are used by this plugin:
    **command** (string)
       The command
 
+   **commands** (list) *optional*
+      .. versionadded:: 1.5
+
+      A list of commands to run instead of the single ``command``. Each element
+      is either a string (the command), or a dictionary with the key
+      ``command`` and optionally ``name``, ``returncodes_ok``,
+      ``popen_params``, ``compressor`` and ``timeout`` to override the
+      profile-wide values for this one command.
+
+      The output of each command is stored in a subfolder named after the
+      command's ``name`` (Default: ``command-1``, ``command-2``, ...). If two
+      names map to the same folder, the position of the command is appended
+      (f.ex. ``my_db-2``).
+
+   **parallel** (int) *optional*
+      .. versionadded:: 1.5
+
+      The number of commands from ``commands`` which are run at the same time.
+      Default: 1
+
+   **compressor** (string) *optional*
+      .. versionadded:: 1.5
+
+      Compress stdout while it is captured. One of ``"gzip"``, ``"bzip2"`` or
+      ``"none"``. The matching suffix is appended to ``stdout.txt``.
+      Default: ``"none"``
+
+   **compress_level** (int) *optional*
+      .. versionadded:: 1.5
+
+      The compression level passed to the compressor.
+
+   **timeout** (int) *optional*
+      .. versionadded:: 1.5
+
+      The number of seconds a command is allowed to run. When it takes longer,
+      it is killed and an error is logged. Default: no timeout
+
    **returncodes_ok** (string) *optional*
       A list of expected return codes. All return codes in this list are
       considered to indicate successful process termination. If a different
@@ -46,12 +85,36 @@ Configuration Example
          ),
       ),
 
+   dict(
+      name = 'exports',
+      profile = 'command',
+      config = dict(
+         parallel = 2,
+         compressor = 'gzip',
+         timeout = 4 * 3600,
+         commands = [
+            dict(name='ldap', command='slapcat -n 1'),
+            dict(name='svn', command='svnadmin dump -q /var/svn/repo',
+                 compressor='bzip2'),
+            ],
+         ),
+      ),
+
 """
 import logging
-from os.path import join
+import os
+import re
+import threading
+import time
+from os.path import join, exists
 from subprocess import Popen, PIPE
 import shlex
 
+from pickup.lib import manifest
+from pickup.lib.pipeline import get_compressor, add_suffix, copy_stream, \
+      throughput
+from pickup.lib.workers import run_parallel
+
 LOG = logging.getLogger(__name__)
 API_VERSION = (2,0)
 CONFIG = {}
@@ -65,28 +128,129 @@ def init(source):
    SOURCE.update(source)
    LOG.debug("Initialised '%s' with %r" % ( __name__, CONFIG))
 
-def run(staging_area):
+def get_commands():
+   """
+   Returns the list of commands to run as dictionaries. Values which are not
+   specified per command are taken from the profile config.
+
+   The legacy single ``command`` is returned without a subfolder, so its
+   output ends up directly in the staging area as before. Commands whose
+   names map to the same folder get the index of the command appended.
+   """
+   defaults = dict(
+         returncodes_ok = CONFIG.get("returncodes_ok", [0]),
+         popen_params = CONFIG.get("popen_params", {}),
+         compressor = CONFIG.get("compressor", None),
+         compress_level = CONFIG.get("compress_level", None),
+         timeout = CONFIG.get("timeout", None),
+         )
+
+   if "commands" not in CONFIG:
+      spec = dict(defaults)
+      spec.update(name=None, command=CONFIG['command'])
+      return [spec]
+
+   output = []
+   folders = set()
+   for i, entry in enumerate(CONFIG['commands']):
+      if isinstance(entry, basestring):
+         entry = dict(command=entry)
+      spec = dict(defaults)
+      spec.update(entry)
+      if not spec.get('name'):
+         spec['name'] = "command-%d" % (i+1)
+      folder = re.sub( r'[^a-zA-Z0-9_-]', "_", spec['name'] ).strip("_")
+      if not folder or folder in folders:
+         folder = "%s-%d" % (folder or "command", i+1)
+         LOG.warning("The output of command %r is stored in %r (name "
+               "already used)" % (spec['name'], folder))
+      folders.add(folder)
+      spec['folder'] = folder
+      output.append(spec)
+   return output
+
+def get_output_folder(staging_area, spec):
+   """
+   Returns (and creates) the folder receiving the output of one command.
+   """
+   if not spec['name']:
+      return staging_area
+   folder = join(staging_area, spec['folder'])
+   if not exists(folder):
+      os.makedirs(folder)
+   return folder
 
-   LOG.info( "Capturing output of command %r" % CONFIG['command'] )
-   LOG.debug( "   shlex.split result: %r" % shlex.split(CONFIG['command']) )
-   stdout = open( join(staging_area, "stdout.txt"), "w+" )
-   stderr = open( join(staging_area, "stderr.txt"), "w+" )
-   popen_params = CONFIG.get( 'popen_params', {} )
-   process = Popen( shlex.split( CONFIG['command']),
-      stdout=stdout,
-      stderr=stderr,
-      **popen_params)
-   retcode = process.wait()
-   expected_codes = CONFIG.get("returncodes_ok", [0])
+def run_command(staging_area, spec):
+   """
+   Run one command and capture its output.
+
+   @param staging_area: The target folder
+   @param spec: The command specification as returned by `get_commands`
+   """
+   LOG.info( "Capturing output of command %r" % spec['command'] )
+   LOG.debug( "   shlex.split result: %r" % shlex.split(spec['command']) )
+   folder = get_output_folder(staging_area, spec)
+   compressor = get_compressor(spec['compressor'], spec['compress_level'])
+   popen_params = dict(stdout=PIPE)
+
+   # Redirections in ``popen_params`` replace the default files
+   stdout = stderr = None
+   if 'stdout' not in spec['popen_params']:
+      stdout = open( join(folder, add_suffix("stdout.txt", compressor)), "wb" )
+   if 'stderr' not in spec['popen_params']:
+      stderr = open( join(folder, "stderr.txt"), "w+" )
+      popen_params['stderr'] = stderr
+   popen_params.update(spec['popen_params'])
+   process = Popen( shlex.split( spec['command']), **popen_params)
+
+   timer = None
+   timed_out = []
+   if spec['timeout']:
+      def kill():
+         timed_out.append(True)
+         LOG.error("Command %r exceeded its timeout of %ss. Killing it!" % (
+            spec['command'], spec['timeout']))
+         process.kill()
+      timer = threading.Timer(spec['timeout'], kill)
+      timer.start()
+
+   start = time.time()
+   stats = None
+   digest = manifest.new_hash()
+   try:
+      if process.stdout and stdout:
+         stats = copy_stream(process.stdout, stdout, compressor,
+               digest=digest)
+      retcode = process.wait()
+   finally:
+      if timer:
+         timer.cancel()
+      if stdout:
+         stdout.close()
+   if stats:
+      # The manifest does not need to read the output again
+      manifest.register(stdout.name, stats['bytes_out'], digest.hexdigest())
+
+   expected_codes = spec["returncodes_ok"]
    if isinstance(expected_codes, int):
       expected_codes = [expected_codes]
-   if retcode not in expected_codes:
+   if timed_out or retcode not in expected_codes:
       LOG.error( "Process terminated with non-expected return code: %r"
             % retcode )
-      stderr.seek(0)
-      LOG.error( "STDERR data:\n%s" % stderr.read() )
-   stdout.close()
-   stderr.close()
-
+      if stderr:
+         stderr.seek(0)
+         LOG.error( "STDERR data:\n%s" % stderr.read() )
+   if stderr:
+      stderr.close()
 
+   if stats:
+      elapsed = time.time() - start
+      LOG.info("Command %r produced %d bytes (%d bytes written) in %.1fs "
+            "(%s)" % (spec['command'], stats['bytes_in'], stats['bytes_out'],
+               elapsed, throughput(stats['bytes_in'], elapsed)))
+   return stats
 
+def run(staging_area):
+   commands = get_commands()
+   run_parallel(lambda spec: run_command(staging_area, spec), commands,
+         CONFIG.get('parallel', 1))
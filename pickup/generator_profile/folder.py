@@ -35,6 +35,8 @@ import re
 from os.path import exists, join, abspath, isdir
 import os
 
+from pickup.lib.pipeline import Sink
+
 LOG = logging.getLogger(__name__)
 API_VERSION = (2,0)
 CONFIG = {}
@@ -90,18 +92,32 @@ def create_split_tar(staging_area):
 
       tarname = join(staging_area, "%s.tar.bz2" % entry)
       LOG.info("Writing to '%s'" % abspath(tarname))
-      tar = tarfile.open(abspath(tarname), "w:bz2")
+      tar = open_tar(tarname)
       tar.add(entrypath)
-      tar.close()
+      close_tar(tar)
 
    if files:
       tarname = join(staging_area, "__PICKUP_FILES__.tar.bz2")
       LOG.info("Writing remaining files to '%s'" % abspath(tarname))
-      tar = tarfile.open(abspath(tarname), "w:bz2")
+      tar = open_tar(tarname)
       for file in files:
          LOG.info("   Adding %s" % file)
          tar.add(file)
-      tar.close()
+      close_tar(tar)
+
+def open_tar(tarname):
+   """
+   Open a new bzip2 compressed tar file. It is written through a `Sink`, so
+   the manifest of the session does not need to read it again.
+   """
+   sink = Sink(abspath(tarname))
+   tar = tarfile.open(abspath(tarname), "w:bz2", fileobj=sink)
+   tar.sink = sink
+   return tar
+
+def close_tar(tar):
+   tar.close()
+   tar.sink.close()
 
 def get_basename():
    """
@@ -130,6 +146,6 @@ def create_simple_tar(staging_area):
    tarname = join(staging_area, tarname)
 
    LOG.info("Writing to '%s'" % abspath(tarname))
-   tar = tarfile.open(abspath(tarname), "w:bz2")
+   tar = open_tar(tarname)
    tar.add( CONFIG['path'] )
-   tar.close()
+   close_tar(tar)
@@ -1,6 +1,6 @@
 """
 This module will dump MySQL databases running ``mysqldump``. The output will be
-run through ``bzip2``.
+compressed with ``bzip2`` (or the configured ``compressor``).
 
 Prerequisites
 ~~~~~~~~~~~~~
@@ -48,6 +48,146 @@ The following fields are used by this plugin:
                    specified in the dedicated config variables this may have
                    unexpected results.
 
+   **compressor** (string|list) *optional* (default="bzip2")
+      .. versionadded:: 1.5
+
+      The compressor used for the dump files. Either ``"gzip"``, ``"bzip2"``
+      or ``"none"`` for in-process compression, or a list which is run as
+      external command (f.ex. ``['pbzip2', '-p8']``). External commands
+      cannot be used with ``mode="tables"``.
+
+   **compress_level** (int) *optional*
+      .. versionadded:: 1.5
+
+      The compression level of the in-process compressors.
+
+   **compress_threads** (int) *optional* (default=1)
+      .. versionadded:: 1.5
+
+      The number of threads used by the in-process compressors.
+
+   **parallel** (int) *optional* (default=1)
+      .. versionadded:: 1.5
+
+      The number of databases dumped at the same time when using ``'*'``. The
+      database ``mysql`` is always dumped first. The remaining databases are
+      scheduled by size (taken from ``information_schema.TABLES``), largest
+      first, so the longest dump starts immediately.
+
+      The number of concurrent dumps is further reduced if the server does not
+      have enough free connections (``max_connections`` minus
+      ``Threads_connected`` minus ``connection_headroom``).
+
+   **max_server_connections** (int) *optional*
+      .. versionadded:: 1.5
+
+      The maximum number of concurrent dumps against one server (identified by
+      host and port). This limit is shared by all profiles targeting the same
+      server. Default: no limit
+
+   **connection_headroom** (int) *optional* (default=10)
+      .. versionadded:: 1.5
+
+      The number of connections which should always remain available to other
+      clients of the server when dumping in parallel.
+
+   **mode** (string) *optional* (default="database")
+      .. versionadded:: 1.5
+
+      ``"database"`` runs one ``mysqldump`` per database. ``"tables"`` dumps
+      the tables of the selected databases (except ``mysql``) in parallel from
+      one consistent snapshot:
+
+         - A global read lock (``FLUSH TABLES WITH READ LOCK``) is taken.
+         - ``parallel`` worker connections open a transaction ``WITH
+           CONSISTENT SNAPSHOT`` and the binlog position is recorded.
+         - The schemas and the tables which are not using InnoDB are dumped
+           while the lock is held. Then the lock is released.
+         - The remaining tables are dumped by the workers, largest first.
+           Tables with more than ``chunk_rows`` rows and an integer primary
+           key are split into row ranges which are dumped independently.
+
+      Each database ends up in its own folder containing ``schema.sql`` (from
+      ``mysqldump --no-data``), one file per table or row range containing
+      ``INSERT`` statements, and ``manifest.json`` which lists the files and
+      the binlog position. To restore, load the schema first, then all data
+      files in any order.
+
+   **chunk_rows** (int) *optional* (default=1000000)
+      .. versionadded:: 1.5
+
+      When using ``mode="tables"``: the approximate number of rows per data
+      file for large tables.
+
+   **incremental** (dict) *optional*
+      .. versionadded:: 1.5
+
+      Enables incremental sessions based on the binary log. A full dump
+      records the binlog position at which it was taken. The following
+      sessions only copy the binary logs written since the last recorded
+      position (using ``mysqlbinlog --read-from-remote-server``) into a file
+      ``binlog-<first>-<last>.sql`` (compressed with ``compressor``), until the
+      next full dump is due. The dictionary supports the following keys:
+
+         ``full_every`` (int)
+            The number of days after which a new full dump is made.
+            Default: 7
+
+         ``keep_chains`` (int)
+            The number of chains (one full dump and its incrementals) kept in
+            the manifest. Default: 10
+
+      The chains are tracked in a manifest in the state folder (see
+      ``state_folder``) and a copy of it is written into the staging area as
+      ``binlog-manifest.json``. To restore, load the full dump and then replay
+      each incremental file of the chain in order (f.ex. ``bzcat
+      binlog-....sql.bz2 | mysql``).
+
+      A new full dump is made whenever the binlog files needed for the next
+      incremental have been purged from the server.
+
+      .. note:: The user needs the privileges ``RELOAD`` and ``REPLICATION
+                SLAVE``/``REPLICATION CLIENT``. Binary logging must be enabled
+                on the server.
+
+      .. note:: Incremental sessions require ``mode="tables"``. The
+                recorded position then matches the snapshot of the full dump
+                exactly. In ``database`` mode the databases are dumped
+                without a common snapshot, so replaying the binary logs would
+                re-apply changes made while the full dump was running.
+
+   **skip_unchanged** (boolean) *optional* (default=False)
+      .. versionadded:: 1.5
+
+      Reuse the previous dump of a database if it did not change since. This
+      applies to ``database`` mode when dumping ``'*'``. Before dumping, a
+      fingerprint is computed for each database from
+      ``information_schema`` (``UPDATE_TIME``, row counts and sizes of all
+      tables, definitions of views, routines and triggers) and ``CHECKSUM
+      TABLE`` for tables smaller than ``checksum_max_size``. If it matches the
+      fingerprint of the last successful dump, that dump is hard-linked from
+      the state folder into the staging area instead of running
+      ``mysqldump``.
+
+      If a table larger than ``checksum_max_size`` does not report an
+      ``UPDATE_TIME`` (f.ex. InnoDB before MySQL 5.7, or after a server
+      restart), the database is always dumped.
+
+      .. note:: The state folder should be on the same filesystem as the
+                staging area. Otherwise the dumps are copied instead of
+                linked.
+
+   **checksum_max_size** (int) *optional* (default=10485760)
+      .. versionadded:: 1.5
+
+      Tables up to this size (in bytes) are included in the fingerprint using
+      ``CHECKSUM TABLE``.
+
+   **state_folder** (string) *optional* (default="~/.pickup/state")
+      .. versionadded:: 1.5
+
+      The local folder keeping the state between sessions.
+
 Configuration Example
 ~~~~~~~~~~~~~~~~~~~~~
 
@@ -61,7 +201,9 @@ Configuration Example
          port = "3306",
          host = "localhost",
          user = "backupuser",
-         password = "foobar"
+         password = "foobar",
+         parallel = 4,
+         max_server_connections = 6,
          mysqldump_params = "",
          connection_params = dict(
             charset='utf8',
@@ -71,35 +213,236 @@ Configuration Example
    ),
 
 """
+from datetime import datetime, timedelta
+from Queue import Queue
+from os.path import join, exists
+import hashlib
+import json
 import logging
+import os
 import shlex
+
 import MySQLdb
-from subprocess import Popen, PIPE
-from os.path import join
+import MySQLdb.cursors
+
+from pickup.lib.pipeline import get_compressor, add_suffix, run_pipeline, \
+      log_result, Sink, ExternalCompressor
+from pickup.lib.workers import run_parallel, server_slots
+from pickup.lib import state
+from pickup.lib.reuse import ArtifactCache
 LOG = logging.getLogger(__name__)
 API_VERSION = (2,0)
 CONFIG = {}
+SOURCE = {}
+
+#: Column types which can be used to split a table into row ranges
+CHUNKABLE_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint')
+
+#: The approximate size of one INSERT statement in the per-table dumps
+INSERT_SIZE = 1024 * 1024
+
+#: The format of the dates stored in the binlog manifest
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
 def init(source_dict):
    LOG.debug("Hello, I was initialised with %s" % source_dict)
    CONFIG.update(source_dict["config"])
+   SOURCE.update(source_dict)
+   if (CONFIG.get('mode', 'database') == 'tables' and
+         isinstance(get_compressor_from_config(), ExternalCompressor)):
+      raise ValueError("External compressors cannot be used with "
+            "mode='tables'")
+   if (CONFIG.get('incremental') and
+         CONFIG.get('mode', 'database') != 'tables'):
+      raise ValueError("Incremental sessions require mode='tables'")
 
-def dump_all_dbs(conn, staging_area):
+def connect(db="mysql"):
+   """
+   Open a new connection to the server using the config values.
+   """
+   return MySQLdb.connect( db=db,
+        user = CONFIG.get("user", "root"),
+        passwd = CONFIG.get('password', ""),
+        host = CONFIG.get('host', "localhost"),
+        port = int(CONFIG.get('port', 3306)),
+        **CONFIG.get('connection_params', {})
+        )
+
+def get_compressor_from_config():
+   """
+   Returns a new compressor instance as specified in the config.
+   """
+   return get_compressor(CONFIG.get('compressor', 'bzip2'),
+         CONFIG.get('compress_level', None),
+         CONFIG.get('compress_threads', 1))
+
+def get_db_sizes(conn):
+   """
+   Returns a dictionary mapping schema names to their size (data + indexes)
+   in bytes, as reported by ``information_schema``.
+   """
+   cur = conn.cursor()
+   cur.execute("SELECT table_schema, SUM(data_length + index_length) "
+         "FROM information_schema.TABLES GROUP BY table_schema")
+   output = dict((row[0], int(row[1] or 0)) for row in cur.fetchall())
+   cur.close()
+   return output
+
+def get_free_connections(conn):
+   """
+   Returns the number of connections the server can still accept, keeping
+   ``connection_headroom`` connections available for other clients.
+   """
+   cur = conn.cursor()
+   cur.execute("SHOW GLOBAL VARIABLES LIKE 'max_connections'")
+   max_connections = int(cur.fetchone()[1])
+   cur.execute("SHOW GLOBAL STATUS LIKE 'Threads_connected'")
+   connected = int(cur.fetchone()[1])
+   cur.close()
+   return max_connections - connected - int(
+         CONFIG.get('connection_headroom', 10))
+
+def get_concurrency(conn):
+   """
+   Determine the number of databases which can be dumped at the same time.
+   """
+   workers = int(CONFIG.get('parallel', 1))
+   if workers <= 1:
+      return 1
+
+   if CONFIG.get('max_server_connections'):
+      workers = min(workers, int(CONFIG['max_server_connections']))
+
+   free = get_free_connections(conn)
+   if free < workers:
+      LOG.warning("Only %d free connections available on the server. "
+            "Reducing the number of parallel dumps from %d." % (free, workers))
+      workers = free
+   return max(1, workers)
+
+def list_dbs(conn):
+   """
+   Returns the names of all databases, except "mysql" and
+   "information_schema".
+   """
    # get a list of all available dbs
    cur = conn.cursor()
    cur.execute("SHOW databases")
+   dbs = []
    for row in cur.fetchall():
       # Database "mysql" is *always* included in the backup. It contains
       # critical data like usernames and passwords. Without it a backup is
       # worthless. So we ignore it here, and create it separately in the main
       # "run" method.
       if row[0] not in ["information_schema", "mysql"]:
-         dump_one_db(conn, row[0], staging_area)
+         dbs.append(row[0])
    cur.close()
+   return dbs
 
-def dump_one_db(conn, db, staging_area):
-   LOG.info("Dumping %s" % db)
+def get_fingerprint(conn, db):
+   """
+   Compute a cheap fingerprint of a database which changes whenever the
+   data or the schema changes.
+
+   @return: A hex string, or ``None`` if the database cannot be
+            fingerprinted reliably.
+   """
+   max_size = int(CONFIG.get('checksum_max_size', 10 * 1024 * 1024))
+   cur = conn.cursor()
+   cur.execute("SELECT TABLE_NAME, TABLE_TYPE, ENGINE, CREATE_TIME, "
+         "UPDATE_TIME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH, AUTO_INCREMENT "
+         "FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s "
+         "ORDER BY TABLE_NAME", (db,))
+   tables = cur.fetchall()
+
+   small = []
+   for row in tables:
+      name, table_type, update_time = row[0], row[1], row[4]
+      if table_type != 'BASE TABLE':
+         continue
+      size = int(row[6] or 0) + int(row[7] or 0)
+      if size <= max_size:
+         small.append(name)
+      elif update_time is None:
+         LOG.debug("Table %s.%s has no UPDATE_TIME. Unable to fingerprint "
+               "%s." % (db, name, db))
+         cur.close()
+         return None
+
+   data = [CONFIG.get('mysqldump_params'), get_compressor_from_config().suffix,
+      [tuple(map(str, row)) for row in tables]]
+   if small:
+      cur.execute("CHECKSUM TABLE %s" % ", ".join(["%s.%s" % (
+         quote_name(db), quote_name(name)) for name in small]))
+      data.append([tuple(map(str, row)) for row in cur.fetchall()])
+
+   for query in [
+         "SELECT TABLE_NAME, VIEW_DEFINITION FROM information_schema.VIEWS "
+         "WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME",
+         "SELECT ROUTINE_NAME, ROUTINE_TYPE, LAST_ALTERED "
+         "FROM information_schema.ROUTINES WHERE ROUTINE_SCHEMA = %s "
+         "ORDER BY ROUTINE_NAME",
+         "SELECT TRIGGER_NAME, ACTION_STATEMENT "
+         "FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = %s "
+         "ORDER BY TRIGGER_NAME"]:
+      cur.execute(query, (db,))
+      data.append([tuple(map(str, row)) for row in cur.fetchall()])
+   cur.close()
+   return hashlib.sha1(repr(data)).hexdigest()
+
+def get_artifact_cache():
+   """
+   Returns the cache keeping the last dump of each database.
+   """
+   return ArtifactCache(state.get_folder(CONFIG, 'mysql',
+      SOURCE.get('name', 'mysql'), 'artifacts'))
+
+def dump_all_dbs(conn, staging_area):
+   dbs = list_dbs(conn)
+   workers = get_concurrency(conn)
+   if workers > 1:
+      # start with the largest schemas, so the longest dump runs from the
+      # beginning.
+      sizes = get_db_sizes(conn)
+      dbs.sort(key=lambda db: sizes.get(db, 0), reverse=True)
+      LOG.info("Dumping %d databases with %d parallel dumps" % (
+         len(dbs), workers))
+
+   if not CONFIG.get('skip_unchanged', False):
+      return run_parallel(lambda db: dump_one_db(conn, db, staging_area),
+            dbs, workers)
+
+   # The fingerprints are computed up front, as the connection must not be
+   # shared between the worker threads.
+   cache = get_artifact_cache()
+   fingerprints = dict((db, get_fingerprint(conn, db)) for db in dbs)
+
+   def dump_or_reuse(db):
+      entry = cache.restore(db, fingerprints[db], staging_area)
+      if entry:
+         LOG.info("Database %s is unchanged since %s. Reusing the previous "
+               "dump." % (db, entry['date']))
+         return dict(returncode=0, filename=join(staging_area, entry['file']),
+               checksum=entry.get('checksum'), reused=True)
+      result = dump_one_db(conn, db, staging_area)
+      if dump_ok(result):
+         cache.store(db, fingerprints[db], result['filename'],
+               checksum = result['checksum'],
+               date = datetime.now().strftime(DATE_FORMAT))
+      return result
+
+   results = run_parallel(dump_or_reuse, dbs, workers)
+   cache.save()
+   return results
+
+def get_mysqldump_command(db, extra_params=None):
+   """
+   Construct the ``mysqldump`` command line for one database.
 
+   @param db: The database name
+   @param extra_params: A list of parameters appended after the ones from
+                        ``mysqldump_params``
+   """
    command = [ 'mysqldump',
       "-P", str(CONFIG.get('port', 3306)),
       "-h", CONFIG.get('host', "localhost"),
@@ -108,39 +451,509 @@ def dump_one_db(conn, db, staging_area):
 
    if "mysqldump_params" in CONFIG and CONFIG["mysqldump_params"]:
       command.extend( shlex.split(CONFIG["mysqldump_params"]) )
+   command.extend( extra_params or [] )
    command.append( db )
+   return command
+
+def dump_one_db(conn, db, staging_area):
+   LOG.info("Dumping %s" % db)
+
+   command = get_mysqldump_command(db)
    LOG.debug("Running command %r" % command)
 
-   p1 = Popen( command, stdout=PIPE, stderr=PIPE )
-   p2 = Popen( "bzip2", stdin=p1.stdout, stdout=open(
-      join(staging_area, "%s.bz2" % db), "wb"), stderr=PIPE )
+   compressor = get_compressor_from_config()
+   server = (CONFIG.get('host', "localhost"), int(CONFIG.get('port', 3306)))
+   with server_slots(server, CONFIG.get('max_server_connections')):
+      result = run_pipeline(command,
+            join(staging_area, add_suffix(db, compressor)), compressor)
 
-   p1.wait()
-   p2.wait()
+   if result['returncode'] != 0:
+      LOG.error("Error while running mysql_dump: %s" % result['stderr'])
 
-   if p1.returncode != 0:
-      LOG.error("Error while running mysql_dump: %s" % p1.stderr.read())
+   if result['compressor_returncode'] != 0:
+      LOG.error("Error while running the compressor: %s" %
+            result['compressor_stderr'])
 
-   if p2.returncode != 0:
-      LOG.error("Error while running bzip2: %s" % p2.stderr.read())
+   log_result(db, result)
+   return result
 
-def run(staging_area):
+def open_snapshot(workers):
+   """
+   Take a global read lock and open ``workers`` connections which share one
+   consistent snapshot. The lock is *not* released. Pass the returned lock
+   connection to `release_lock` once the non-transactional tables are dumped.
 
-   # so far so good. connect...
-   conn = MySQLdb.connect( db="mysql",
-        user = CONFIG.get("user", "root"),
-        passwd = CONFIG.get('password', ""),
-        host = CONFIG.get('host', "localhost"),
-        port = CONFIG.get('port', 3306),
-        **CONFIG.get('connection_params', {})
-        )
+   @return: A tuple (lock_connection, worker_connections, binlog_position).
+            The binlog position is a dictionary with the keys ``file`` and
+            ``position`` or ``None`` if binary logging is disabled.
+   """
+   lock_conn = connect()
+   conns = []
+   success = False
+   try:
+      cur = lock_conn.cursor()
+      LOG.info("Acquiring global read lock")
+      cur.execute("FLUSH TABLES WITH READ LOCK")
+      for _ in range(workers):
+         conn = connect()
+         conns.append(conn)
+         worker_cur = conn.cursor()
+         worker_cur.execute("SET SESSION TRANSACTION ISOLATION LEVEL "
+               "REPEATABLE READ")
+         worker_cur.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+         worker_cur.close()
+
+      cur.execute("SHOW MASTER STATUS")
+      row = cur.fetchone()
+      position = None
+      if row:
+         position = dict(file=row[0], position=int(row[1]))
+      LOG.info("Opened %d snapshot connections at binlog position %r" % (
+         workers, position))
+      cur.close()
+      success = True
+   finally:
+      if not success:
+         for conn in conns:
+            conn.close()
+         release_lock(lock_conn)
+   return lock_conn, conns, position
+
+def release_lock(lock_conn):
+   """
+   Release the global read lock taken by `open_snapshot`.
+   """
+   try:
+      cur = lock_conn.cursor()
+      cur.execute("UNLOCK TABLES")
+      cur.close()
+   finally:
+      # Closing the connection releases the lock as well
+      lock_conn.close()
+   LOG.info("Released global read lock")
+
+def quote_name(name):
+   """
+   Quote an identifier for use in SQL statements.
+   """
+   return "`%s`" % name.replace("`", "``")
+
+def get_chunk_key(conn, db, table):
+   """
+   Returns the name of the primary key column if the table has a primary key
+   consisting of exactly one integer column. Otherwise returns ``None``.
+   """
+   cur = conn.cursor()
+   cur.execute("SELECT k.COLUMN_NAME, c.DATA_TYPE "
+         "FROM information_schema.KEY_COLUMN_USAGE k "
+         "JOIN information_schema.COLUMNS c ON "
+         "   c.TABLE_SCHEMA = k.TABLE_SCHEMA AND "
+         "   c.TABLE_NAME = k.TABLE_NAME AND "
+         "   c.COLUMN_NAME = k.COLUMN_NAME "
+         "WHERE k.TABLE_SCHEMA = %s AND k.TABLE_NAME = %s "
+         "AND k.CONSTRAINT_NAME = 'PRIMARY'", (db, table))
+   rows = cur.fetchall()
+   cur.close()
+   if len(rows) != 1 or rows[0][1].lower() not in CHUNKABLE_TYPES:
+      return None
+   return rows[0][0]
+
+def plan_table_jobs(conn, db):
+   """
+   Create the list of dump jobs for one database. Large tables with an
+   integer primary key are split into several jobs of ``chunk_rows`` rows.
+
+   The planning must be done on a snapshot connection, so the row ranges
+   match the data which will be dumped.
+
+   @return: A list of dictionaries with the keys ``db``, ``table``,
+            ``engine``, ``size``, ``part`` and ``where``
+   """
+   chunk_rows = int(CONFIG.get('chunk_rows', 1000000))
+   cur = conn.cursor()
+   cur.execute("SELECT TABLE_NAME, ENGINE, TABLE_ROWS, "
+         "DATA_LENGTH + INDEX_LENGTH FROM information_schema.TABLES "
+         "WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE'", (db,))
+   tables = cur.fetchall()
+
+   jobs = []
+   for table, engine, rows, size in tables:
+      rows = int(rows or 0)
+      size = int(size or 0)
+      job = dict(db=db, table=table, engine=engine, size=size, part=1,
+            where=None)
+
+      key = rows > chunk_rows and get_chunk_key(conn, db, table) or None
+      if not key:
+         jobs.append(job)
+         continue
+
+      cur.execute("SELECT MIN(%s), MAX(%s) FROM %s.%s" % (
+         quote_name(key), quote_name(key), quote_name(db), quote_name(table)))
+      low, high = cur.fetchone()
+      if low is None:
+         jobs.append(job)
+         continue
+
+      parts = (rows + chunk_rows - 1) // chunk_rows
+      step = max(1, (int(high) - int(low) + parts) // parts)
+      start = int(low)
+      part = 1
+      while start <= high:
+         end = start + step
+         where = "%s >= %d AND %s < %d" % (quote_name(key), start,
+               quote_name(key), end)
+         jobs.append(dict(job, part=part, where=where, size=size // parts))
+         start = end
+         part += 1
+   cur.close()
+   return jobs
+
+def get_table_filename(job, compressor):
+   """
+   Returns the filename (relative to the database folder) of a table dump.
+   """
+   return add_suffix("%s.%05d.sql" % (job['table'], job['part']), compressor)
+
+def dump_table(conn, job, folder):
+   """
+   Dump the rows of one table (or one row range of a table) as ``INSERT``
+   statements.
+
+   @param conn: A snapshot connection
+   @param job: A job as returned by `plan_table_jobs`
+   @param folder: The folder of the database
+   """
+   compressor = get_compressor_from_config()
+   sink = Sink(join(folder, get_table_filename(job, compressor)), compressor)
+   query = "SELECT * FROM %s.%s" % (quote_name(job['db']),
+         quote_name(job['table']))
+   if job['where']:
+      query += " WHERE %s" % job['where']
+   LOG.debug("Dumping %s.%s (part %d)" % (job['db'], job['table'],
+      job['part']))
+
+   sink.write("SET NAMES %s;\n" % conn.character_set_name())
+   sink.write("SET FOREIGN_KEY_CHECKS=0;\nSET UNIQUE_CHECKS=0;\n")
+   insert = "INSERT INTO %s VALUES " % quote_name(job['table'])
+   cur = conn.cursor(MySQLdb.cursors.SSCursor)
+   cur.execute(query)
+   values = []
+   size = 0
+   for row in cur:
+      value = "(%s)" % ",".join([conn.literal(item) for item in row])
+      values.append(value)
+      size += len(value)
+      if size >= INSERT_SIZE:
+         sink.write("%s%s;\n" % (insert, ",".join(values)))
+         values = []
+         size = 0
+   if values:
+      sink.write("%s%s;\n" % (insert, ",".join(values)))
+   cur.close()
+   return sink.close()
+
+def dump_db_schema(db, folder):
+   """
+   Dump the schema (tables, views, routines, triggers and events) of one
+   database using ``mysqldump``.
+   """
+   compressor = get_compressor_from_config()
+   command = get_mysqldump_command(db, ['--no-data', '--routines',
+      '--triggers', '--events', '--skip-lock-tables'])
+   result = run_pipeline(command,
+         join(folder, add_suffix("schema.sql", compressor)), compressor)
+   if result['returncode'] != 0:
+      LOG.error("Error while running mysql_dump: %s" % result['stderr'])
+   return result
+
+def dump_tables(conn, dbs, staging_area):
+   """
+   Dump all tables of the given databases in parallel from one consistent
+   snapshot (see the ``mode`` config value).
+   """
+   workers = get_concurrency(conn)
+   lock_conn, snapshot_conns, position = open_snapshot(workers)
+   pool = Queue()
+   for snapshot_conn in snapshot_conns:
+      pool.put(snapshot_conn)
+
+   def run_job(job):
+      snapshot_conn = pool.get()
+      try:
+         folder = join(staging_area, job['db'])
+         return dump_table(snapshot_conn, job, folder)
+      finally:
+         pool.put(snapshot_conn)
+
+   try:
+      try:
+         jobs = []
+         for db in dbs:
+            jobs.extend(plan_table_jobs(snapshot_conns[0], db))
+            folder = join(staging_area, db)
+            if not exists(folder):
+               os.makedirs(folder)
+         jobs.sort(key=lambda job: job['size'], reverse=True)
+
+         # The schema is read by mysqldump using its own connection. Like
+         # the tables without transaction support (which are not covered by
+         # the snapshot), it must be dumped while the global read lock is
+         # still held.
+         locked = [job for job in jobs if job['engine'] != 'InnoDB']
+         unlocked = [job for job in jobs if job['engine'] == 'InnoDB']
+         LOG.info("Dumping %d schemas and %d non-transactional tables under "
+               "read lock" % (len(dbs), len(locked)))
+         schema_results = run_parallel(
+            lambda db: dump_db_schema(db, join(staging_area, db)), dbs,
+            workers)
+         results = run_parallel(run_job, locked, workers)
+      finally:
+         release_lock(lock_conn)
 
+      LOG.info("Dumping %d table parts with %d workers" % (len(unlocked),
+         workers))
+      results.extend(run_parallel(run_job, unlocked, workers))
+   finally:
+      for snapshot_conn in snapshot_conns:
+         try:
+            snapshot_conn.rollback()
+         except MySQLdb.Error, exc:
+            LOG.debug("Unable to end snapshot transaction: %s" % exc)
+         snapshot_conn.close()
+
+   schemas = dict((item[0], item[1]) for item in schema_results)
+   write_manifests(dbs, staging_area, schemas, results, position)
+   return position, all_ok(results + schema_results)
+
+def write_manifests(dbs, staging_area, schemas, results, position):
+   """
+   Write a ``manifest.json`` into each database folder, listing the files
+   required to restore it.
+   """
+   compressor = get_compressor_from_config()
+   for db in dbs:
+      tables = {}
+      for job, result, exc in results:
+         if job['db'] != db:
+            continue
+         entry = tables.setdefault(job['table'], dict(table=job['table'],
+            files=[]))
+         entry['files'].append(dict(
+            file = get_table_filename(job, compressor),
+            where = job['where'],
+            ok = exc is None,
+            checksum = result and result['checksum'] or None,
+            ))
+      for entry in tables.values():
+         entry['files'].sort(key=lambda item: item['file'])
+
+      schema = schemas.get(db)
+      manifest = dict(
+            database = db,
+            binlog = position,
+            compressor = compressor.suffix or None,
+            schema = dict(
+               file = add_suffix("schema.sql", compressor),
+               ok = bool(schema and schema['returncode'] == 0),
+               checksum = schema and schema['checksum'] or None,
+               ),
+            tables = sorted(tables.values(), key=lambda item: item['table']),
+            )
+      with open(join(staging_area, db, "manifest.json"), "w") as fptr:
+         json.dump(manifest, fptr, indent=2)
+
+def dump_ok(result):
+   """
+   Returns True if a dump result indicates success.
+   """
+   return bool(result) and result.get('returncode', 0) == 0 and \
+         result.get('compressor_returncode', 0) == 0
+
+def all_ok(results):
+   """
+   Returns True if all results of `run_parallel` indicate success.
+   """
+   return all(exc is None and dump_ok(result)
+         for _, result, exc in results)
+
+def get_binlog_position(conn, flush=False):
+   """
+   Returns the current binlog position as dictionary with the keys ``file``
+   and ``position``, or ``None`` if binary logging is disabled.
+
+   @param flush: If True, the server starts a new binlog file first. This
+                 closes the current file, so it can be copied completely.
+   """
+   cur = conn.cursor()
+   if flush:
+      cur.execute("FLUSH BINARY LOGS")
+   cur.execute("SHOW MASTER STATUS")
+   row = cur.fetchone()
+   cur.close()
+   if not row:
+      return None
+   return dict(file=row[0], position=int(row[1]))
+
+def list_binlogs(conn):
+   """
+   Returns the names of the binary logs available on the server.
+   """
+   cur = conn.cursor()
+   cur.execute("SHOW BINARY LOGS")
+   output = [row[0] for row in cur.fetchall()]
+   cur.close()
+   return output
+
+def get_manifest_filename():
+   return join(state.get_folder(CONFIG, 'mysql'),
+         "%s.binlog.json" % state.clean_name(SOURCE.get('name', 'mysql')))
+
+def needs_full_dump(conn, manifest):
+   """
+   Determine if the next session must be a full dump.
+
+   @return: A reason (string) if a full dump is needed, or ``None``
+   """
+   if not manifest['chains']:
+      return "no previous full dump"
+
+   chain = manifest['chains'][-1]
+   full_date = datetime.strptime(chain['full']['date'], DATE_FORMAT)
+   full_every = CONFIG['incremental'].get('full_every', 7)
+   if datetime.now() - full_date >= timedelta(days=full_every):
+      return "last full dump is older than %d days" % full_every
+
+   start = get_chain_position(chain)
+   if not start:
+      return "binary logging was disabled during the last full dump"
+   if start['file'] not in list_binlogs(conn):
+      return "binlog %r has been purged" % start['file']
+   return None
+
+def get_chain_position(chain):
+   """
+   Returns the position up to which a chain covers the changes.
+   """
+   if chain['incrementals']:
+      return chain['incrementals'][-1]['end']
+   return chain['full']['binlog']
+
+def dump_binlogs(conn, staging_area, chain):
+   """
+   Copy all binary logs written since the end of ``chain`` into the staging
+   area and append the incremental to the chain.
+
+   @return: True if the binlogs have been copied successfully
+   """
+   start = get_chain_position(chain)
+   end = get_binlog_position(conn, flush=True)
+   if not end:
+      raise IOError("Unable to read the binlog position. Is binary logging "
+            "enabled?")
+   logs = list_binlogs(conn)
+   for name in (start['file'], end['file']):
+      if name not in logs:
+         raise IOError("Binlog %r is not listed by SHOW BINARY LOGS" % name)
+   logs = logs[logs.index(start['file']):logs.index(end['file'])]
+   if not logs:
+      LOG.info("No new binary logs since %r" % start)
+      return True
+
+   compressor = get_compressor_from_config()
+   filename = add_suffix("binlog-%s-%s.sql" % (logs[0], logs[-1]),
+         compressor)
+   command = [ 'mysqlbinlog', '--read-from-remote-server',
+      "--port=%s" % CONFIG.get('port', 3306),
+      "--host=%s" % CONFIG.get('host', "localhost"),
+      "--user=%s" % CONFIG.get('user', "root"),
+      "--password=%s" % CONFIG.get('password', ""),
+      "--start-position=%d" % start['position'] ]
+   command.extend(logs)
+   LOG.info("Copying binary logs %s to %s from position %d" % (
+      ", ".join(logs), end['file'], start['position']))
+   result = run_pipeline(command, join(staging_area, filename), compressor)
+   log_result("binlog", result)
+   if not dump_ok(result):
+      LOG.error("Error while running mysqlbinlog: %s" % result['stderr'])
+      return False
+
+   chain['incrementals'].append(dict(
+      date = datetime.now().strftime(DATE_FORMAT),
+      start = start,
+      end = dict(file=end['file'], position=end['position']),
+      binlogs = logs,
+      file = filename,
+      checksum = result['checksum'],
+      ))
+   return True
+
+def dump_full(conn, staging_area):
+   """
+   Create a full dump of the configured databases.
+
+   @return: A tuple (binlog_position, success)
+   """
    # always create a backup of "mysql" if possible
-   dump_one_db(conn, "mysql", staging_area)
+   results = [(None, dump_one_db(conn, "mysql", staging_area), None)]
+   if CONFIG.get('mode', 'database') == 'tables':
+      if CONFIG['database'] == '*':
+         dbs = list_dbs(conn)
+      else:
+         dbs = [CONFIG['database']]
+      position, ok = dump_tables(conn, dbs, staging_area)
+      return position, ok and all_ok(results)
+
    if CONFIG['database'] == '*':
-      dump_all_dbs(conn, staging_area)
+      results.extend(dump_all_dbs(conn, staging_area))
+   else:
+      results.append((None, dump_one_db(conn, CONFIG['database'],
+         staging_area), None))
+   return None, all_ok(results)
+
+def run_incremental(conn, staging_area):
+   """
+   Run either a full dump or an incremental session, depending on the
+   manifest in the state folder.
+   """
+   manifest_file = get_manifest_filename()
+   manifest = state.load(manifest_file, dict(chains=[]))
+
+   reason = needs_full_dump(conn, manifest)
+   if reason:
+      LOG.info("Creating a full dump (%s)" % reason)
+      position, ok = dump_full(conn, staging_area)
+      if ok:
+         manifest['chains'].append(dict(
+            full = dict(
+               date = datetime.now().strftime(DATE_FORMAT),
+               binlog = position,
+               mode = CONFIG.get('mode', 'database'),
+               ),
+            incrementals = [],
+            ))
+   else:
+      ok = dump_binlogs(conn, staging_area, manifest['chains'][-1])
+
+   if not ok:
+      LOG.error("The session did not complete successfully. The binlog "
+            "manifest is left unchanged.")
+      return
+
+   keep = CONFIG['incremental'].get('keep_chains', 10)
+   manifest['chains'] = manifest['chains'][-keep:]
+   state.save(manifest_file, manifest)
+   state.save(join(staging_area, "binlog-manifest.json"), manifest)
+
+def run(staging_area):
+
+   # so far so good. connect...
+   conn = connect()
+
+   if CONFIG.get('incremental'):
+      run_incremental(conn, staging_area)
    else:
-      dump_one_db(conn, CONFIG['database'], staging_area)
+      dump_full(conn, staging_area)
 
    conn.close()
 
@@ -0,0 +1,354 @@
+"""
+This module creates physical backups of a PostgreSQL cluster using
+``pg_basebackup``. The base backup is streamed in tar format and compressed by
+``pg_basebackup`` itself. Optionally, WAL segments archived between two base
+backups are collected, so the cluster can be restored to any point in time
+covered by the chain.
+
+Each session either takes a new base backup (when none exists yet or the last
+one is older than ``base_every`` days) or collects the WAL segments archived
+since the previous session.
+
+The staging area will contain:
+
+   ``base/``
+      The output of ``pg_basebackup`` (``base.tar.gz``, ``pg_wal.tar.gz``,
+      one archive per tablespace and, with PostgreSQL 13+,
+      ``backup_manifest``). Only present for base backup sessions.
+
+   ``wal/``
+      The collected WAL segments (gzip compressed). Only present if
+      ``wal_archive`` is set.
+
+   ``catalog.json``
+      The backup label, start and end LSN, timeline and first WAL segment of
+      each base backup, and the WAL segments collected for it.
+
+Prerequisites
+~~~~~~~~~~~~~
+
+   - ``pg_basebackup`` must be installed.
+   - The user needs the ``REPLICATION`` attribute and a matching
+     ``replication`` entry in ``pg_hba.conf``. See :ref:`postgres_passwords`
+     for password handling.
+   - To collect WAL segments, the server must archive them into a folder
+     readable by pickup (``archive_command`` or ``pg_receivewal``).
+
+Configuration
+~~~~~~~~~~~~~
+
+The following fields are used by this plugin:
+
+   **host** (string) *optional*
+      The host on which the cluster is running
+
+   **port** (int) *optional*
+      The port on which the cluster is running
+
+   **user** (string) *optional*
+      The username as whom to connect.
+
+   **compress_level** (int) *optional* (default=6)
+      The gzip compression level used by ``pg_basebackup`` (``-Z``).
+
+   **wal_method** (string) *optional* (default="stream")
+      How the WAL needed to make the base backup consistent is included
+      (``-X``): ``"stream"``, ``"fetch"`` or ``"none"``.
+
+   **checkpoint** (string) *optional* (default="fast")
+      ``"fast"`` or ``"spread"`` (``-c``).
+
+   **max_rate** (string) *optional*
+      Limits the transfer rate of the base backup (``-r``, f.ex.
+      ``"100M"``).
+
+   **pg_basebackup_params** (string) *optional*
+      Additional parameters passed directly to ``pg_basebackup``.
+
+   **base_every** (int) *optional* (default=7)
+      The number of days after which a new base backup is taken. This is only
+      relevant if ``wal_archive`` is set. Without it, every session takes a
+      base backup.
+
+   **wal_archive** (string) *optional*
+      A local folder into which the server archives its WAL segments. If set,
+      sessions between two base backups copy the new segments from this
+      folder.
+
+   **keep_chains** (int) *optional* (default=10)
+      The number of base backups (and their WAL) kept in the catalog.
+
+   **state_folder** (string) *optional* (default="~/.pickup/state")
+      The local folder keeping the catalog between sessions.
+
+Configuration Example
+~~~~~~~~~~~~~~~~~~~~~
+
+.. code-block:: python
+
+   dict(
+      name = 'PostgreSQL cluster',
+      profile = 'pg_basebackup',
+      config = dict(
+         host = 'db1',
+         user = 'replication',
+         port = 5432,
+         compress_level = 3,
+         base_every = 7,
+         wal_archive = '/var/lib/postgresql/wal_archive',
+         ),
+      ),
+"""
+
+from datetime import datetime, timedelta
+from os.path import join, exists
+from subprocess import Popen, PIPE
+import logging
+import os
+import re
+import shlex
+import tarfile
+import time
+
+from pickup.lib import manifest, state
+from pickup.lib.pipeline import get_compressor, add_suffix, copy_stream, \
+      throughput
+
+LOG = logging.getLogger(__name__)
+API_VERSION = (2,0)
+CONFIG = {}
+SOURCE = {}
+
+#: The format of the dates stored in the catalog
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+#: Files in the WAL archive which are collected. Segments which are still
+#: being written (``.partial`` or temporary names) do not match.
+WAL_PATTERN = re.compile(r'^[0-9A-F]{24}(\.[0-9A-F]{8}\.backup)?'
+      r'(\.gz|\.bz2)?$|^[0-9A-F]{8}\.history(\.gz|\.bz2)?$')
+
+START_PATTERN = re.compile(r'(?:write-ahead|transaction) log start point: '
+      r'([0-9A-F]+/[0-9A-F]+) on timeline (\d+)')
+END_PATTERN = re.compile(r'(?:write-ahead|transaction) log end point: '
+      r'([0-9A-F]+/[0-9A-F]+)')
+
+def init(source):
+   CONFIG.update(source['config'])
+   SOURCE.update(source)
+   LOG.debug("Initialised '%s' with %r" % ( __name__, CONFIG))
+
+def get_command(target):
+   """
+   Construct the ``pg_basebackup`` command line.
+
+   @param target: The output folder
+   """
+   command = [ 'pg_basebackup', '-w', '-v',
+      '-D', target,
+      '-Ft', '-z', '-Z', str(CONFIG.get('compress_level', 6)),
+      '-X', CONFIG.get('wal_method', 'stream'),
+      '-c', CONFIG.get('checkpoint', 'fast'),
+      '-l', "pickup %s %s" % (SOURCE.get('name', ''),
+         datetime.now().strftime(DATE_FORMAT)) ]
+   if CONFIG.get('port'):
+      command.extend([ "-p", str(CONFIG['port']) ])
+   if CONFIG.get('host'):
+      command.extend([ "-h", CONFIG['host'] ])
+   if CONFIG.get('user'):
+      command.extend([ "-U", CONFIG['user'] ])
+   if CONFIG.get('max_rate'):
+      command.extend([ "-r", str(CONFIG['max_rate']) ])
+   if CONFIG.get('pg_basebackup_params'):
+      command.extend( shlex.split(CONFIG['pg_basebackup_params']) )
+   return command
+
+def read_backup_label(folder):
+   """
+   Read the ``backup_label`` file from ``base.tar.gz``.
+
+   @return: A dictionary with the label's entries (f.ex. ``LABEL``,
+            ``START WAL LOCATION``)
+   """
+   archive = join(folder, "base.tar.gz")
+   if not exists(archive):
+      return {}
+   tar = tarfile.open(archive, "r:gz")
+   try:
+      member = tar.extractfile("backup_label")
+      content = member.read()
+   except KeyError:
+      LOG.warning("No backup_label found in %r" % archive)
+      return {}
+   finally:
+      tar.close()
+
+   output = {}
+   for line in content.splitlines():
+      if ":" in line:
+         key, value = line.split(":", 1)
+         output[key.strip()] = value.strip()
+   return output
+
+def take_base_backup(staging_area):
+   """
+   Run ``pg_basebackup`` into the folder ``base`` of the staging area.
+
+   @return: The catalog entry of the new base backup, or ``None`` on failure
+   """
+   target = join(staging_area, "base")
+   command = get_command(target)
+   LOG.info("Taking base backup into %r" % target)
+   LOG.debug("Running command %r" % command)
+
+   start = time.time()
+   process = Popen(command, stdout=PIPE, stderr=PIPE)
+   _, stderr = process.communicate()
+   elapsed = time.time() - start
+
+   if process.returncode != 0:
+      LOG.error("Error while running pg_basebackup: %s" % stderr)
+      return None
+   LOG.debug("pg_basebackup output:\n%s" % stderr)
+
+   files = sorted(os.listdir(target))
+   size = sum(os.path.getsize(join(target, name)) for name in files)
+   LOG.info("Base backup: %d bytes written in %.1fs (%s)" % (size, elapsed,
+      throughput(size, elapsed)))
+
+   label = read_backup_label(target)
+   entry = dict(
+         date = datetime.now().strftime(DATE_FORMAT),
+         label = label.get('LABEL'),
+         files = files,
+         bytes = size,
+         start_lsn = None,
+         end_lsn = None,
+         timeline = None,
+         start_wal = None,
+         wal = [],
+         )
+
+   match = START_PATTERN.search(stderr)
+   if match:
+      entry['start_lsn'] = match.group(1)
+      entry['timeline'] = int(match.group(2))
+   match = END_PATTERN.search(stderr)
+   if match:
+      entry['end_lsn'] = match.group(1)
+
+   # START WAL LOCATION: 0/2000028 (file 000000010000000000000002)
+   match = re.search(r'\(file ([0-9A-F]{24})\)',
+         label.get('START WAL LOCATION', ''))
+   if match:
+      entry['start_wal'] = match.group(1)
+
+   LOG.info("Base backup %r: start LSN %s, end LSN %s, timeline %s" % (
+      entry['label'], entry['start_lsn'], entry['end_lsn'],
+      entry['timeline']))
+   return entry
+
+def get_last_wal(base):
+   """
+   Returns the name of the newest WAL file recorded for a base backup.
+   """
+   if base['wal']:
+      return base['wal'][-1]['last']
+   return None
+
+def collect_wal(staging_area, base):
+   """
+   Copy the WAL files archived since the last session into the folder
+   ``wal`` of the staging area. Uncompressed files are gzipped on the way.
+
+   @param base: The catalog entry of the current base backup. Its list of
+                collected WAL is updated.
+   """
+   archive = CONFIG['wal_archive']
+   last = get_last_wal(base)
+   names = sorted(name for name in os.listdir(archive)
+         if WAL_PATTERN.match(name))
+
+   # Everything older than the base backup is not needed to restore it.
+   # History files are always included (once) as they are needed to follow
+   # timeline switches. Segments are selected by name rather than by
+   # comparing with the last one, so a segment archived late (f.ex. after a
+   # timeline switch) is still collected.
+   first_needed = base.get('start_wal') or ''
+   collected = set()
+   for entry in base['wal']:
+      collected.update(entry['files'])
+   names = [name for name in names if name not in collected and (
+      '.history' in name or name[:24] >= first_needed)]
+
+   if not names:
+      LOG.info("No new WAL files since %r" % last)
+      return
+
+   folder = join(staging_area, "wal")
+   if not exists(folder):
+      os.makedirs(folder)
+
+   start = time.time()
+   total = 0
+   for name in names:
+      source = open(join(archive, name), "rb")
+      if name.endswith('.gz') or name.endswith('.bz2'):
+         compressor = get_compressor('none')
+      else:
+         compressor = get_compressor('gzip')
+      sink = open(join(folder, add_suffix(name, compressor)), "wb")
+      digest = manifest.new_hash()
+      try:
+         stats = copy_stream(source, sink, compressor, digest=digest)
+      finally:
+         source.close()
+         sink.close()
+      manifest.register(sink.name, stats['bytes_out'], digest.hexdigest())
+      total += stats['bytes_in']
+   elapsed = time.time() - start
+   LOG.info("Collected %d WAL files (%d bytes) in %.1fs (%s)" % (len(names),
+      total, elapsed, throughput(total, elapsed)))
+
+   segments = [name for name in names if '.history' not in name]
+   base['wal'].append(dict(
+      date = datetime.now().strftime(DATE_FORMAT),
+      first = segments and segments[0] or None,
+      last = segments and segments[-1] or last,
+      files = names,
+      ))
+
+def needs_base_backup(catalog):
+   """
+   Returns a reason (string) if a new base backup must be taken, or ``None``.
+   """
+   if not CONFIG.get('wal_archive'):
+      return "WAL collection is disabled"
+   if not catalog['bases']:
+      return "no previous base backup"
+   base = catalog['bases'][-1]
+   base_date = datetime.strptime(base['date'], DATE_FORMAT)
+   base_every = CONFIG.get('base_every', 7)
+   if datetime.now() - base_date >= timedelta(days=base_every):
+      return "last base backup is older than %d days" % base_every
+   return None
+
+def run(staging_area):
+   catalog_file = join(state.get_folder(CONFIG, 'pg_basebackup'),
+         "%s.json" % state.clean_name(SOURCE.get('name', 'pg_basebackup')))
+   catalog = state.load(catalog_file, dict(bases=[]))
+
+   reason = needs_base_backup(catalog)
+   if reason:
+      LOG.info("Taking a new base backup (%s)" % reason)
+      base = take_base_backup(staging_area)
+      if not base:
+         LOG.error("The base backup failed. The catalog is left unchanged.")
+         return
+      catalog['bases'].append(base)
+   else:
+      collect_wal(staging_area, catalog['bases'][-1])
+
+   keep = CONFIG.get('keep_chains', 10)
+   catalog['bases'] = catalog['bases'][-keep:]
+   state.save(catalog_file, catalog)
+   state.save(join(staging_area, "catalog.json"), catalog)
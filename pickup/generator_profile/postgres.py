@@ -1,6 +1,7 @@
 """
-This module will dump the databases running ``pg_dump``. The output will be run
-through ``gzip``.
+This module will dump the databases running ``pg_dump``. The output can be
+compressed in-process (see ``compressor``) or run through an external command
+(see ``compress_command``).
 
 Prerequisites
 ~~~~~~~~~~~~~
@@ -43,6 +44,24 @@ The following fields are used by this plugin:
             * ``['gzip']``
             * ``['gzip', '-5']``
 
+   **compressor** (string) *optional*
+      .. versionadded:: 1.5
+
+      In-process compression of the dumps: ``"gzip"``, ``"bzip2"`` or
+      ``"none"``. This is faster than piping the data through an external
+      process. If both ``compressor`` and ``compress_command`` are set,
+      ``compress_command`` is used.
+
+   **compress_level** (int) *optional*
+      .. versionadded:: 1.5
+
+      The compression level of the in-process compressor.
+
+   **compress_threads** (int) *optional* (default=1)
+      .. versionadded:: 1.5
+
+      The number of threads used by the in-process compressor.
+
    **ignore_dbs**
       A list of databases to ignore (mostly useful when using ``'*'`` as
       database source.
@@ -71,6 +90,69 @@ The following fields are used by this plugin:
    **pg_dumpall_params** (string) *optional*
       Same as ``pg_dump_params``, but for the command ``pg_dumpall``
 
+   **jobs** (int) *optional*
+      .. versionadded:: 1.5
+
+      The number of parallel jobs used by ``pg_dump`` to dump *one* database
+      (``pg_dump -j``). This requires the directory format. If no format is
+      given in ``pg_dump_params``, the directory format is selected
+      automatically (``-Fd``). Each database is then dumped into a folder
+      named ``<dbname>.dir`` in the staging area.
+
+      .. note:: The directory format compresses the data itself, so
+                ``compressor`` and ``compress_command`` are not used for it.
+                Use ``-Z <level>`` in ``pg_dump_params`` to change the
+                compression level.
+
+      .. note:: Each job opens its own connection. ``max_cluster_jobs``
+                counts dumps, not connections. So keep ``jobs * parallel``
+                within the connection limit of the cluster.
+
+   **parallel** (int) *optional* (default=1)
+      .. versionadded:: 1.5
+
+      The number of databases dumped at the same time. The globals are dumped
+      alongside the databases. When using ``'*'``, the databases are
+      scheduled by size (``pg_database_size``), largest first, so the longest
+      dump starts immediately.
+
+   **max_cluster_jobs** (int) *optional*
+      .. versionadded:: 1.5
+
+      The maximum number of concurrent dumps against one cluster (identified
+      by host and port). This limit is shared by all profiles targeting the
+      same cluster. Default: no limit
+
+   **skip_unchanged** (boolean) *optional* (default=False)
+      .. versionadded:: 1.5
+
+      Reuse the previous dump of a database if nothing was written to it
+      since. Before dumping, the tuple counters (``tup_inserted``,
+      ``tup_updated``, ``tup_deleted``) and ``stats_reset`` of
+      ``pg_stat_database``, and the number of tables and their summed
+      ``n_tup_ins``/``n_tup_upd``/``n_tup_del`` from ``pg_stat_user_tables``
+      are read, as well as the current value of each sequence (which
+      ``nextval()`` and ``setval()`` change without touching any tuple
+      counter). If they match the values saved with the last successful dump,
+      that dump is hard-linked from the state folder into the staging area
+      instead of running ``pg_dump``. Databases with sequences the user may
+      not read are always dumped.
+
+      The transaction counters (``xact_commit``) are not used, because every
+      read-only transaction (including the ones of pickup itself) increments
+      them.
+
+      Dumps in directory format are never reused.
+
+      .. note:: The state folder should be on the same filesystem as the
+                staging area. Otherwise the dumps are copied instead of
+                linked.
+
+   **state_folder** (string) *optional* (default="~/.pickup/state")
+      .. versionadded:: 1.5
+
+      The local folder keeping the state between sessions.
+
 Configuration Example
 ~~~~~~~~~~~~~~~~~~~~~
 
@@ -86,10 +168,23 @@ Configuration Example
          compress_command = ['gzip'],
          ignore_dbs = ['my_test_db'],
          port = 5432,
+         parallel = 4,
          pg_dump_params = "-Ft -c",
          ),
       ),
 
+   dict(
+      name = 'Large PostgreSQL database',
+      profile = 'postgres',
+      config = dict(
+         host = 'localhost',
+         user = 'backup',
+         database = 'warehouse',
+         port = 5432,
+         jobs = 16,
+         ),
+      ),
+
 .. _postgres_passwords:
 
 A note on passwords
@@ -130,11 +225,21 @@ Here's a copy of the relevant docs:
    ``:`` or ``\``, escape this character with ``\``.
 """
 
+from datetime import datetime
+import hashlib
 import logging
+import os
 import psycopg2
 import shlex
-from subprocess import Popen, PIPE
+import time
 from os.path import join
+from subprocess import Popen, PIPE
+
+from pickup.lib.pipeline import get_compressor, add_suffix, run_pipeline, \
+      log_result, throughput
+from pickup.lib.workers import run_parallel, server_slots
+from pickup.lib import state
+from pickup.lib.reuse import ArtifactCache
 
 LOG = logging.getLogger(__name__)
 API_VERSION = (2,0)
@@ -144,6 +249,7 @@ SOURCE = {}
 FORMAT_PLAIN = 0
 FORMAT_TAR = 1
 FORMAT_CUSTOM = 2
+FORMAT_DIRECTORY = 3
 
 def init(source):
    CONFIG.update(source['config'])
@@ -154,6 +260,9 @@ def init(source):
    LOG.debug("Initialised '%s' with %r" % ( __name__, CONFIG))
 
 def list_dbs():
+   """
+   Returns the names of all databases, ordered by size (largest first).
+   """
    conn = psycopg2.connect(
          database = 'template1',
          user = CONFIG['user'],
@@ -162,12 +271,114 @@ def list_dbs():
       )
    cursor = conn.cursor()
    cursor.execute("SELECT datname FROM pg_database WHERE datname NOT IN "
-         "('template0', 'template1', 'postgres')")
+         "('template0', 'template1', 'postgres') "
+         "ORDER BY CASE WHEN has_database_privilege(datname, 'CONNECT') "
+         "THEN pg_database_size(datname) ELSE 0 END DESC")
    output = [row[0] for row in cursor.fetchall()]
    cursor.close()
    conn.close()
    return output
 
+def get_activity_counters():
+   """
+   Returns a dictionary mapping database names to their tuple modification
+   counters from ``pg_stat_database``.
+   """
+   conn = psycopg2.connect(
+         database = 'template1',
+         user = CONFIG['user'],
+         host = CONFIG['host'],
+         port = CONFIG['port'],
+      )
+   cursor = conn.cursor()
+   cursor.execute("SELECT datname, tup_inserted, tup_updated, tup_deleted, "
+         "stats_reset FROM pg_stat_database")
+   output = dict((row[0], [str(value) for value in row[1:]])
+         for row in cursor.fetchall())
+   cursor.close()
+   conn.close()
+   return output
+
+def get_sequence_values(cursor):
+   """
+   Returns the current values of all sequences. ``nextval()`` and
+   ``setval()`` do not change any tuple counter.
+
+   @return: A list of strings, or ``None`` if a sequence is not readable
+   """
+   if cursor.connection.server_version >= 100000:
+      cursor.execute("SELECT schemaname, sequencename, last_value, "
+            "has_sequence_privilege(quote_ident(schemaname) || '.' || "
+            "quote_ident(sequencename), 'SELECT') "
+            "FROM pg_sequences ORDER BY 1, 2")
+      rows = cursor.fetchall()
+      if not all(row[3] for row in rows):
+         return None
+      return [str(row[:3]) for row in rows]
+   cursor.execute("SELECT quote_ident(n.nspname) || '.' || "
+         "quote_ident(c.relname) FROM pg_class c JOIN pg_namespace n "
+         "ON n.oid = c.relnamespace WHERE c.relkind = 'S' ORDER BY 1")
+   output = []
+   for (name,) in cursor.fetchall():
+      try:
+         cursor.execute("SELECT last_value, is_called FROM %s" % name)
+      except psycopg2.Error, exc:
+         LOG.debug("Unable to read sequence %s: %s" % (name, exc))
+         return None
+      output.append(str((name,) + cursor.fetchone()))
+   return output
+
+def get_table_counters(dbname):
+   """
+   Returns the number of user tables and their summed modification counters
+   from ``pg_stat_user_tables``, followed by the values of all sequences.
+
+   @return: A list of strings, or ``None`` if the sequences are not readable
+   """
+   conn = psycopg2.connect(
+         database = dbname,
+         user = CONFIG['user'],
+         host = CONFIG['host'],
+         port = CONFIG['port'],
+      )
+   cursor = conn.cursor()
+   cursor.execute("SELECT count(*), sum(n_tup_ins), sum(n_tup_upd), "
+         "sum(n_tup_del) FROM pg_stat_user_tables")
+   output = [str(value) for value in cursor.fetchone()]
+   sequences = get_sequence_values(cursor)
+   cursor.close()
+   conn.close()
+   if sequences is None:
+      return None
+   return output + sequences
+
+def get_fingerprint(dbname, activity):
+   """
+   Compute a fingerprint of a database which changes whenever data is
+   written to it.
+
+   @param activity: The counters returned by `get_activity_counters`
+   @return: A hex string, or ``None`` if there are no statistics for the
+            database or its sequences are not readable
+   """
+   if dbname not in activity:
+      return None
+   counters = get_table_counters(dbname)
+   if counters is None:
+      LOG.info("Unable to read the sequences of %s. It will be dumped."
+            % dbname)
+      return None
+   data = [get_params("pg_dump"), get_db_compressor().suffix,
+         activity[dbname], counters]
+   return hashlib.sha1(repr(data)).hexdigest()
+
+def get_cluster_slots():
+   """
+   Returns the semaphore limiting concurrent dumps against the cluster.
+   """
+   return server_slots((CONFIG.get('host'), CONFIG.get('port')),
+         CONFIG.get('max_cluster_jobs'))
+
 def get_params(command):
    """
    Construct a list of command-line params and return it.
@@ -205,21 +416,96 @@ def get_format_type(command):
          format_string = element[-1]
          break
 
+      # the format was specified using the long form (one element)
+      if element.startswith('--format='):
+         format_string = element.split('=', 1)[1]
+         break
+
    if format_string in ('c', 'custom'):
       return FORMAT_CUSTOM
    elif format_string in ('t', 'tar'):
       return FORMAT_TAR
+   elif format_string in ('d', 'directory'):
+      return FORMAT_DIRECTORY
    else:
       return FORMAT_PLAIN
 
+def get_db_compressor():
+   """
+   Returns the compressor for database dumps based on the config values
+   ``compress_command`` and ``compressor``.
+   """
+   if CONFIG['compress_command']:
+      return get_compressor(CONFIG['compress_command'])
+   return get_compressor(CONFIG.get('compressor', None),
+         CONFIG.get('compress_level', None),
+         CONFIG.get('compress_threads', 1))
+
+def has_format(command):
+   """
+   Returns True if a dump format has been specified explicitly in the command.
+   """
+   for element in command:
+      if element in ('-F', '--format') or element.startswith('--format='):
+         return True
+      if element.startswith('-F') and len(element) == 3:
+         return True
+   return False
+
+def get_directory_size(path):
+   """
+   Returns the total size of all files below ``path``.
+   """
+   total = 0
+   for root, dirs, files in os.walk(path):
+      for name in files:
+         total += os.path.getsize(join(root, name))
+   return total
+
+def dump_directory(staging_area, dbname, command):
+   """
+   Dump a database in directory format (``pg_dump -Fd``) into the folder
+   ``<dbname>.dir``, using ``jobs`` parallel jobs.
+   """
+   target = join(staging_area, "%s.dir" % dbname)
+   command = command[:-1]
+   if CONFIG.get('jobs'):
+      command.extend(['-j', str(CONFIG['jobs'])])
+   command.extend(['-f', target, dbname])
+   LOG.debug("Running command %r" % command)
+
+   start = time.time()
+   with get_cluster_slots():
+      process = Popen(command, stdout=PIPE, stderr=PIPE)
+      _, stderr = process.communicate()
+   elapsed = time.time() - start
+
+   if process.returncode != 0:
+      LOG.error("Error while running pg_dump: %s" % stderr)
+
+   size = get_directory_size(target)
+   LOG.info("%s: %d bytes written in %.1fs (%s)" % (dbname, size, elapsed,
+      throughput(size, elapsed)))
+   return dict(returncode=process.returncode, stderr=stderr,
+         compressor_returncode=0, filename=target, bytes_in=size,
+         bytes_out=size, elapsed=elapsed, checksum=None)
+
 def dump_one_db(staging_area, dbname):
    LOG.info("Dumping %s" % dbname)
    command = [ 'pg_dump', '-w' ]
    command.extend( get_params("pg_dump") )
+   if CONFIG.get('jobs') and not has_format(command):
+      command.append('-Fd')
    command.append( dbname )
 
    # change dump file suffix depending on dump type
    dump_format = get_format_type(command)
+   if dump_format == FORMAT_DIRECTORY:
+      return dump_directory(staging_area, dbname, command)
+   elif CONFIG.get('jobs'):
+      LOG.warning("The config value 'jobs' is only supported for the "
+            "directory format. Ignoring it!")
+
    if dump_format == FORMAT_TAR:
       file_suffix = 'tar'
    elif dump_format == FORMAT_CUSTOM:
@@ -228,73 +514,99 @@ def dump_one_db(staging_area, dbname):
       file_suffix = 'sql'
 
    filename = "%s.%s" % (dbname, file_suffix)
+   compressor = get_db_compressor()
+   with get_cluster_slots():
+      result = run_pipeline(command,
+            join(staging_area, add_suffix(filename, compressor)), compressor)
 
-   if CONFIG['compress_command']:
-
-      if CONFIG['compress_command'][0] == 'gzip':
-         compress_suffix = 'gz'
-      elif CONFIG['compress_command'][0] == 'bzip2':
-         compress_suffix = 'bz2'
-      elif CONFIG['compress_command'][0] == 'compress':
-         compress_suffix = 'z'
-      else:
-         compress_suffix = CONFIG['compress_command'][0]
-
-      p1 = Popen( command, stdout=PIPE, stderr=PIPE )
-      p2 = Popen( CONFIG['compress_command'], stdin=p1.stdout, stdout=open(
-         join(staging_area, "%s.%s" % (filename, compress_suffix)), "wb"),
-         stderr=PIPE )
-
-      p1.wait()
-      p2.wait()
+   if result['returncode'] != 0:
+      LOG.error("Error while running pg_dump: %s" % result['stderr'])
 
-      if p1.returncode != 0:
-        LOG.error("Error while running pg_dump: %s" % p1.stderr.read())
+   if result['compressor_returncode'] != 0:
+      LOG.error("Error while running the compressor: %s" %
+            result['compressor_stderr'])
 
-      if p2.returncode != 0:
-        LOG.error("Error while running gzip: %s" % p2.stderr.read())
-
-   else:
-      target_file = join(staging_area, "%s" % filename)
-      p1 = Popen( command + ['-f', target_file] )
-      stdout, stderr = p1.communicate()
-      if p1.returncode != 0:
-        LOG.error("Error while running pg_dump: %s" % stderr)
+   log_result(dbname, result)
+   return result
 
 def dump_globals(staging_area):
    LOG.info("Dumping posgtres globals")
    command = [ 'pg_dumpall', '-g' ]
    command.extend( get_params("pg_dumpall") )
 
-   p1 = Popen( command, stdout=PIPE, stderr=PIPE )
-   p2 = Popen( "gzip", stdin=p1.stdout, stdout=open(
-      join(staging_area, "globals.gz" ), "wb"), stderr=PIPE )
+   with get_cluster_slots():
+      result = run_pipeline(command, join(staging_area, "globals.gz"),
+            get_compressor('gzip'))
 
-   p1.wait()
-   p2.wait()
+   if result['returncode'] != 0:
+      LOG.error("Error while running pg_dump: %s" % result['stderr'])
 
-   if p1.returncode != 0:
-      LOG.error("Error while running pg_dump: %s" % p1.stderr.read())
-
-   if p2.returncode != 0:
-      LOG.error("Error while running gzip: %s" % p2.stderr.read())
-
-def run(staging_area):
-
-   dump_globals(staging_area)
+   log_result("globals", result)
+   return result
 
+def get_dbnames():
+   """
+   Returns the names of the databases to dump, based on the config.
+   """
    if isinstance(CONFIG['database'], basestring):
       if CONFIG['database'] == '*':
+         output = []
          for dbname in list_dbs():
             if CONFIG['ignore_dbs'] and dbname in CONFIG['ignore_dbs']:
                 LOG.info("Database %r has been explicitly ignored "
                         "via the config file" % dbname)
                 continue
-            dump_one_db(staging_area, dbname)
+            output.append(dbname)
+         return output
       else:
-         dump_one_db(staging_area, CONFIG['database'])
+         return [CONFIG['database']]
    elif isinstance(CONFIG['database'], list):
-      for dbname in CONFIG['database']:
-         dump_one_db(staging_area, dbname)
+      return CONFIG['database']
+   return []
 
+def dump_or_reuse(staging_area, dbname, cache, activity):
+   """
+   Reuse the previous dump of ``dbname`` if the database has not been
+   modified since. Otherwise dump it and remember the new dump.
+   """
+   if CONFIG.get('jobs') or get_format_type(get_params("pg_dump")) == \
+         FORMAT_DIRECTORY:
+      return dump_one_db(staging_area, dbname)
+
+   fingerprint = get_fingerprint(dbname, activity)
+   entry = cache.restore(dbname, fingerprint, staging_area)
+   if entry:
+      LOG.info("Database %s is unchanged since %s. Reusing the previous "
+            "dump." % (dbname, entry['date']))
+      return dict(returncode=0, compressor_returncode=0,
+            filename=join(staging_area, entry['file']),
+            checksum=entry.get('checksum'), reused=True)
+
+   result = dump_one_db(staging_area, dbname)
+   if result['returncode'] == 0 and result['compressor_returncode'] == 0:
+      cache.store(dbname, fingerprint, result['filename'],
+            checksum = result['checksum'],
+            date = datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))
+   return result
 
+def run(staging_area):
+   # ``None`` stands for the globals. They are dumped first when running
+   # sequentially, and alongside the databases otherwise.
+   jobs = [None] + get_dbnames()
+
+   cache = activity = None
+   if CONFIG.get('skip_unchanged', False):
+      cache = ArtifactCache(state.get_folder(CONFIG, 'postgres',
+         SOURCE.get('name', 'postgres'), 'artifacts'))
+      activity = get_activity_counters()
+
+   def run_job(dbname):
+      if dbname is None:
+         return dump_globals(staging_area)
+      if cache:
+         return dump_or_reuse(staging_area, dbname, cache, activity)
+      return dump_one_db(staging_area, dbname)
+
+   run_parallel(run_job, jobs, CONFIG.get('parallel', 1))
+   if cache:
+      cache.save()
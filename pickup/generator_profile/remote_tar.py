@@ -4,6 +4,60 @@ The remote_tar plugin runs a tar command on a remote host and retrieves the
 generated tar file. In this initial version, the details are specified in the
 config variable "tar_params".
 
+SSH connections are kept open for the whole session and shared by all
+profiles connecting to the same host, port and user. This profile can run in
+parallel with other profiles (see ``PARALLEL_GENERATORS``).
+
+By default, the archive is written into a temporary file on the remote host
+which is downloaded once tar has finished. With ``streaming`` enabled, the
+output of tar is read directly from the SSH channel into the staging area
+instead. This needs no space on the remote host and the transfer overlaps
+completely with the creation of the archive.
+
+Without ``streaming``, large archives are downloaded over several SFTP
+channels in parallel (see ``download_workers``). If the connection drops, the
+download is resumed and only the missing parts are fetched again. Afterwards
+the file is compared against the checksum computed by ``sha256sum`` on the
+remote host.
+
+Split archives
+~~~~~~~~~~~~~~
+
+With ``split`` enabled, the plugin behaves like the ``split`` option of the
+folder plugin: it lists the entries of the remote folder ``path`` and creates
+one archive per subfolder, plus one archive named ``__PICKUP_FILES__``
+containing the plain files. Up to ``split_workers`` tar processes run at the
+same time, each on its own SSH channel. This uses several cores on the remote
+host for compression. With ``connections`` larger than 1, the streams are
+spread over several SSH connections, which helps when the throughput of a
+single TCP connection is limited (f.ex. on links with a high latency).
+
+In this mode, ``tar_params`` only contains the options for tar (f.ex.
+``-cz``) and the extension of ``target_filename`` is used for all archives
+(f.ex. ``home.tar.gz`` creates ``documents.tar.gz``, ``music.tar.gz``, ...).
+``split`` cannot be combined with ``incremental``.
+
+Incremental archives
+~~~~~~~~~~~~~~~~~~~~
+
+With ``incremental`` set, the plugin manages GNU tar snapshot files
+(``--listed-incremental``) itself. A full (level 0) archive is created when
+none exists yet or the last one is older than ``full_every`` days. All other
+sessions only archive what changed since the previous session. The archives
+are named ``<target_filename>`` with the level added before the extension
+(f.ex. ``home.level0.tar.gz``, ``home.level1.tar.gz``, ...).
+
+The snapshot file is kept on the remote host (in ``snapshot_folder``) and
+mirrored into the local state folder. tar works on a copy of the snapshot,
+which only replaces the old one once the archive was transferred
+successfully. A failed session therefore never breaks the chain. If the remote
+snapshot is lost, it is restored from the local mirror.
+
+The chains are recorded in ``tar-manifest.json`` (in the state folder and in
+the staging area). To restore, extract the level 0 archive and then each
+incremental archive of the chain in order, using
+``tar --listed-incremental=/dev/null -x``.
+
 Configuration
 ~~~~~~~~~~~~~
 
@@ -55,6 +109,101 @@ The following fields are used by this plugin:
                    ``0600`` so this is less of a concern. It may be useful,
                    where this is not ensured.
 
+   **max_host_sessions** (int) *optional*
+      .. versionadded:: 1.5
+
+      When profiles run in parallel (see ``PARALLEL_GENERATORS`` in
+      :ref:`configuration`), this limits the number of profiles running
+      against the same host at the same time. This limit is shared by all
+      profiles targeting the host. Default: no limit
+
+   **streaming** (boolean) *optional*
+      .. versionadded:: 1.5
+
+      If set to ``True``, the output of tar is streamed over the SSH channel
+      directly into ``target_filename``. No temporary file is created on the
+      remote host (``tmpfolder`` is not used). Default: ``False``
+
+   **window_size** (int) *optional*
+      .. versionadded:: 1.5
+
+      The SSH window size (in bytes) of the streaming channel. Larger windows
+      allow more data in flight, which is needed to fill links with a high
+      latency. Default: 16 MiB
+
+   **max_packet_size** (int) *optional*
+      .. versionadded:: 1.5
+
+      The maximum SSH packet size (in bytes) of the streaming channel.
+      Default: 32 KiB
+
+   **split** (boolean) *optional*
+      .. versionadded:: 1.5
+
+      Create one archive per entry of ``path`` (see above). Default:
+      ``False``
+
+   **path** (string) *optional*
+      The remote folder which is split. Required if ``split`` is set.
+
+   **split_workers** (int) *optional*
+      .. versionadded:: 1.5
+
+      The number of archives created at the same time. Default: 4
+
+   **connections** (int) *optional*
+      .. versionadded:: 1.5
+
+      The number of SSH connections used by ``split``. Default: 1
+
+   **incremental** (dict) *optional*
+      .. versionadded:: 1.5
+
+      Enables incremental archives (see above). GNU tar is required on the
+      remote host. The dictionary may contain:
+
+         ``full_every`` (int)
+            The number of days after which a new level 0 archive is created.
+            Default: 7
+
+         ``keep_chains`` (int)
+            The number of chains (one level 0 archive and its incrementals)
+            kept in the manifest. Default: 10
+
+         ``snapshot_folder`` (string)
+            The folder on the **remote** host keeping the snapshot files.
+            Relative paths are relative to the home folder of ``username``.
+            Default: ``.pickup/snapshots``
+
+   **state_folder** (string) *optional* (default="~/.pickup/state")
+      .. versionadded:: 1.5
+
+      The local folder keeping the manifest and the mirror of the snapshot
+      file.
+
+   **download_workers** (int) *optional*
+      .. versionadded:: 1.5
+
+      The number of SFTP channels used to download the archive. Default: 4
+
+   **chunk_size** (int) *optional*
+      .. versionadded:: 1.5
+
+      The size (in bytes) of the parts fetched by each channel. Default:
+      8 MiB
+
+   **retries** (int) *optional*
+      .. versionadded:: 1.5
+
+      How often missing parts are fetched again after a network error.
+      Default: 3
+
+   **verify_checksum** (boolean) *optional*
+      .. versionadded:: 1.5
+
+      Compare the downloaded archive against its checksum on the remote host.
+      This requires ``sha256sum`` on the remote host. Default: ``True``
+
 Configuration Example
 ~~~~~~~~~~~~~~~~~~~~~
 
@@ -70,43 +219,80 @@ Configuration Example
          key_filename = ["/home/ninjamonkey/ssh_keys/batcave.rsa"],
          tmpfolder = "",
          tar_params = "-cz /home/ninjamonkey",
-         target_filename = "home_ninjamonkey.tar.gz"
+         target_filename = "home_ninjamonkey.tar.gz",
+         streaming = True,
          )
       ),
 """
 
-import paramiko
+from datetime import datetime, timedelta
+from os.path import join, exists
+from pipes import quote
 import logging
-from os.path import join
+import os
+import threading
+
+from pickup.lib import sshpool, state, transfer
+from pickup.lib.pipeline import Sink, throughput
+from pickup.lib.workers import server_slots, run_parallel
 
 LOG = logging.getLogger(__name__)
 API_VERSION = (2,0)
+PARALLEL_SAFE = True
 CONFIG = {}
 SOURCE = {}
 
+#: The default SSH window size of the streaming channel
+WINDOW_SIZE = 16 * 1024 * 1024
+
+#: The default maximum SSH packet size of the streaming channel
+MAX_PACKET_SIZE = 32 * 1024
+
+#: The number of bytes read from the channel at once
+CHUNK_SIZE = 256 * 1024
+
+#: Exit codes of tar meaning success. GNU tar exits with 1 if files changed
+#: while they were read, which is common on live systems.
+TAR_OK = (0, 1)
+
+#: The name of the archive containing the plain files in split mode
+FILES_ARCHIVE = "__PICKUP_FILES__"
+
+#: The format of the dates stored in the manifest
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
 def init(source):
    CONFIG.update(source['config'])
    SOURCE.update(source)
    LOG.debug("Initialised '%s' with %r" % ( __name__, CONFIG))
 
-def connect():
-   client = paramiko.SSHClient()
-   client.load_system_host_keys()
-   client.set_missing_host_key_policy(paramiko.WarningPolicy())
+def connect(slot=None):
+   """
+   Returns a connection to the remote host. Connections are pooled, so
+   profiles targeting the same host share one SSH transport.
 
-   LOG.info("Connecting to remote host %r" % CONFIG['hostname'])
-   client.connect(
+   @param slot: Selects one of several connections (see
+                `pickup.lib.sshpool.get_client`)
+   """
+   return sshpool.get_client(
          hostname = CONFIG['hostname'],
          port = CONFIG.get('port', 22),
          username = CONFIG['username'],
          password = CONFIG.get('password', None),
-         key_filename = CONFIG.get('key_filename', None)
+         key_filename = CONFIG.get('key_filename', None),
+         slot = slot
          )
-   return client
 
-def exec_ssh(client, command):
+def exec_ssh(client, command, with_status=False):
+   """
+   Run a command on the remote host.
+
+   @param with_status: Also return the exit status of the command
+   @return: A tuple (stdout, stderr) or (stdout, stderr, status)
+   """
    LOG.info("Executing remote command %r" % command)
    _, stdout, stderr = client.exec_command(command)
+   channel = stdout.channel
    stdout = stdout.read().strip()
    stderr = stderr.read().strip()
    LOG.debug("Remote STDOUT")
@@ -116,14 +302,33 @@ def exec_ssh(client, command):
       LOG.error("Remote STDERR")
       LOG.error(stderr)
 
+   if with_status:
+      return stdout, stderr, channel.recv_exit_status()
    return stdout, stderr
 
 def cleanup(client, tar_name):
-   LOG.debug( "Removing %r on remote site % tar_name" )
+   LOG.debug( "Removing %r on remote site" % tar_name )
    exec_ssh(client, "rm -v %s" % tar_name)
-   client.close()
 
-def create_tar(client):
+def get_tar_command(snapshot=None):
+   """
+   Returns the tar command line.
+
+   @param snapshot: The remote snapshot file for ``--listed-incremental``
+   """
+   if snapshot:
+      return "tar --listed-incremental=%s %s" % (snapshot, CONFIG['tar_params'])
+   return "tar %s" % CONFIG['tar_params']
+
+def create_tar(client, command=None):
+   """
+   Run tar on the remote host writing into a temporary file.
+
+   @param command: The tar command. Defaults to `get_tar_command`
+   @return: A tuple (remote filename, exit status of tar)
+   """
+   command = command or get_tar_command()
+
    # create a temporary file
    stdout, stderr = exec_ssh(client, "mktemp --tmpdir=%s" % CONFIG.get("tmpfolder", ""))
    tmpfile = stdout
@@ -133,14 +338,292 @@ def create_tar(client):
       raise ValueError("No tempfile name received. Cannot continue!")
 
    # create the tar file
-   exec_ssh(client, "tar %s > %s" % (CONFIG['tar_params'], tmpfile))
-   return tmpfile
-
-def download_tar(client, tar_name, target_folder):
+   _, _, status = exec_ssh(client, "%s > %s" % (command, tmpfile),
+         with_status=True)
+   if status not in TAR_OK:
+      LOG.error("Remote command %r exited with status %d" % (command, status))
+   return tmpfile, status
+
+def download_tar(tar_name, target_folder, target_filename=None, slot=None):
+   """
+   Download the remote archive using parallel SFTP channels.
+
+   @param target_filename: The local filename. Defaults to the config value
+                           ``target_filename``
+   @param slot: The connection slot to use (see `connect`)
+   @return: The download statistics (see `pickup.lib.transfer.download`)
+   """
    LOG.info("Downloading %r into %r" % (tar_name, target_folder))
+   result = transfer.download(lambda: connect(slot), tar_name,
+         join(target_folder, target_filename or CONFIG["target_filename"]),
+         workers = CONFIG.get('download_workers', 4),
+         chunk_size = CONFIG.get('chunk_size', transfer.CHUNK_SIZE),
+         retries = CONFIG.get('retries', 3),
+         verify = CONFIG.get('verify_checksum', True))
+   if result['verified'] is False:
+      LOG.error("The downloaded archive %r is corrupt!" % result['filename'])
+   return result
+
+def open_channel(client):
+   """
+   Open a new session channel with the configured window and packet size.
+   """
+   transport = client.get_transport()
+   return transport.open_session(
+         window_size = CONFIG.get('window_size', WINDOW_SIZE),
+         max_packet_size = CONFIG.get('max_packet_size', MAX_PACKET_SIZE))
+
+def stream_tar(client, target_folder, command=None, target_filename=None):
+   """
+   Run tar on the remote host and write its output directly into a file in
+   ``target_folder``.
+
+   @param command: The remote command. Defaults to ``tar <tar_params>``
+   @param target_filename: The local filename. Defaults to the config value
+                           ``target_filename``
+   @return: The statistics of the written file (see `Sink.close`)
+   """
+   command = command or "tar %s" % CONFIG['tar_params']
+   filename = join(target_folder,
+         target_filename or CONFIG["target_filename"])
+   LOG.info("Streaming output of remote command %r into %r" % (
+      command, filename))
+
+   channel = open_channel(client)
+   channel.exec_command(command)
+
+   # stderr is drained in a separate thread. Otherwise a chatty tar could
+   # stall the channel.
+   stderr = []
+   def drain():
+      while True:
+         data = channel.recv_stderr(CHUNK_SIZE)
+         if not data:
+            return
+         stderr.append(data)
+   drainer = threading.Thread(target=drain)
+   drainer.daemon = True
+   drainer.start()
+
+   sink = Sink(filename)
+   try:
+      while True:
+         data = channel.recv(CHUNK_SIZE)
+         if not data:
+            break
+         sink.write(data)
+   finally:
+      stats = sink.close()
+
+   status = channel.recv_exit_status()
+   drainer.join()
+   channel.close()
+
+   if status != 0:
+      LOG.error("Remote command %r exited with status %d" % (command, status))
+   if stderr:
+      LOG.error("Remote STDERR")
+      LOG.error("".join(stderr).strip())
+
+   LOG.info("Received %d bytes in %.1fs (%s)" % (stats['bytes_out'],
+      stats['elapsed'], throughput(stats['bytes_out'], stats['elapsed'])))
+   stats['returncode'] = status
+   return stats
+
+def fetch_archive(client, target_folder, command=None, target_filename=None,
+      slot=None):
+   """
+   Create an archive on the remote host and bring it into ``target_folder``,
+   either streamed or downloaded (depending on ``streaming``).
+
+   @param command: The tar command. Defaults to `get_tar_command`
+   @param target_filename: The local filename. Defaults to the config value
+                           ``target_filename``
+   @param slot: The connection slot of ``client`` (see `connect`)
+   @return: ``True`` if tar succeeded and the archive was transferred intact
+   """
+   if CONFIG.get('streaming', False):
+      stats = stream_tar(client, target_folder, command, target_filename)
+      return stats['returncode'] in TAR_OK
+
+   tar_name, status = create_tar(client, command)
+   try:
+      result = download_tar(tar_name, target_folder, target_filename, slot)
+   finally:
+      cleanup(connect(slot), tar_name)
+   return status in TAR_OK and result['verified'] is not False
+
+def list_entries(client, path):
+   """
+   List the entries of a remote folder.
+
+   @return: A tuple (folders, files) of entry names
+   """
+   command = "find %s -mindepth 1 -maxdepth 1 -printf '%%y %%f\\0'" % (
+         quote(path))
+   stdout, _, status = exec_ssh(client, command, with_status=True)
+   if status != 0:
+      raise IOError("Unable to list remote folder %r" % path)
+
+   folders, files = [], []
+   for line in stdout.split("\0"):
+      if not line:
+         continue
+      kind, name = line.split(" ", 1)
+      if kind == "d":
+         folders.append(name)
+      else:
+         files.append(name)
+   return sorted(folders), sorted(files)
+
+def run_split(client, staging_area):
+   """
+   Create one archive per folder in ``path`` and one for the remaining
+   files, running several tar processes at the same time.
+   """
+   path = CONFIG['path']
+   folders, files = list_entries(client, path)
+   LOG.info("Creating %d archives for %r" % (
+      len(folders) + (files and 1 or 0), path))
+
+   ext = ""
+   if "." in CONFIG['target_filename']:
+      ext = "." + CONFIG['target_filename'].split(".", 1)[1]
+
+   jobs = [(name, [name]) for name in folders]
+   if files:
+      jobs.append((FILES_ARCHIVE, files))
+   jobs = [(index, name, entries) for index, (name, entries) in
+         enumerate(jobs)]
+   connections = max(1, int(CONFIG.get('connections', 1)))
+
+   def fetch(job):
+      index, name, entries = job
+      slot = index % connections or None
+      command = "tar %s -C %s %s" % (CONFIG['tar_params'], quote(path),
+            " ".join(quote(entry) for entry in entries))
+      return fetch_archive(connect(slot), staging_area, command,
+            "%s%s" % (name, ext), slot)
+
+   results = run_parallel(fetch, jobs, CONFIG.get('split_workers', 4))
+   failed = [job[1] for job, ok, _ in results if not ok]
+   if failed:
+      LOG.error("Unable to archive %d of %d entries: %s" % (len(failed),
+         len(jobs), ", ".join(failed)))
+
+def get_level_filename(level):
+   """
+   Returns the value of ``target_filename`` with the level inserted before
+   the extension (``home.tar.gz`` becomes ``home.level1.tar.gz``).
+   """
+   name = CONFIG['target_filename']
+   if "." in name:
+      base, ext = name.split(".", 1)
+      return "%s.level%d.%s" % (base, level, ext)
+   return "%s.level%d" % (name, level)
+
+def needs_full_archive(manifest, has_snapshot):
+   """
+   Returns a reason (string) if a level 0 archive must be created, or
+   ``None``.
+   """
+   if not manifest['chains']:
+      return "no previous archive"
+   if not has_snapshot:
+      return "the snapshot file is missing"
+   chain = manifest['chains'][-1]
+   full_date = datetime.strptime(chain[0]['date'], DATE_FORMAT)
+   full_every = CONFIG['incremental'].get('full_every', 7)
+   if datetime.now() - full_date >= timedelta(days=full_every):
+      return "last level 0 archive is older than %d days" % full_every
+   return None
+
+def prepare_snapshot(client, remote_snapshot, local_snapshot):
+   """
+   Make sure the remote snapshot exists, restoring it from the local mirror
+   if necessary.
+
+   @return: ``True`` if a snapshot is available on the remote host
+   """
+   folder = os.path.dirname(remote_snapshot)
+   _, _, status = exec_ssh(client, "mkdir -p %s && test -f %s" % (
+      folder, remote_snapshot), with_status=True)
+   if status == 0:
+      return True
+   if not exists(local_snapshot):
+      return False
+
+   LOG.warning("Remote snapshot %r is missing. Restoring it from %r" % (
+      remote_snapshot, local_snapshot))
    sftp = client.open_sftp()
-   sftp.get( tar_name, join(target_folder, CONFIG["target_filename"]) )
-   sftp.close()
+   try:
+      sftp.put(local_snapshot, remote_snapshot)
+   finally:
+      sftp.close()
+   return True
+
+def commit_snapshot(client, remote_snapshot, local_snapshot):
+   """
+   Replace the remote snapshot with the one updated by tar and mirror it
+   locally.
+   """
+   exec_ssh(client, "mv %s.new %s" % (remote_snapshot, remote_snapshot))
+   sftp = client.open_sftp()
+   try:
+      sftp.get(remote_snapshot, "%s.tmp" % local_snapshot)
+   finally:
+      sftp.close()
+   os.rename("%s.tmp" % local_snapshot, local_snapshot)
+
+def run_incremental(client, staging_area):
+   """
+   Create a level 0 or incremental archive and update the manifest.
+   """
+   name = state.clean_name(SOURCE.get('name', 'remote_tar'))
+   state_folder = state.get_folder(CONFIG, 'remote_tar')
+   manifest_file = join(state_folder, "%s.json" % name)
+   local_snapshot = join(state_folder, "%s.snar" % name)
+   manifest = state.load(manifest_file, dict(chains=[]))
+
+   snapshot_folder = CONFIG['incremental'].get('snapshot_folder',
+         '.pickup/snapshots')
+   remote_snapshot = "%s/%s.snar" % (snapshot_folder.rstrip("/"), name)
+
+   has_snapshot = prepare_snapshot(client, remote_snapshot, local_snapshot)
+   reason = needs_full_archive(manifest, has_snapshot)
+   if reason:
+      LOG.info("Creating a level 0 archive (%s)" % reason)
+      level = 0
+      exec_ssh(client, "rm -f %s.new" % remote_snapshot)
+   else:
+      level = len(manifest['chains'][-1])
+      LOG.info("Creating a level %d archive" % level)
+      exec_ssh(client, "cp %s %s.new" % (remote_snapshot, remote_snapshot))
+
+   filename = get_level_filename(level)
+   command = get_tar_command("%s.new" % remote_snapshot)
+   if not fetch_archive(client, staging_area, command, filename):
+      LOG.error("Unable to create the level %d archive. The snapshot and "
+            "manifest are left unchanged." % level)
+      exec_ssh(client, "rm -f %s.new" % remote_snapshot)
+      return
+
+   commit_snapshot(client, remote_snapshot, local_snapshot)
+   entry = dict(
+         date = datetime.now().strftime(DATE_FORMAT),
+         level = level,
+         file = filename,
+         bytes = os.path.getsize(join(staging_area, filename)),
+         )
+   if level == 0:
+      manifest['chains'].append([entry])
+   else:
+      manifest['chains'][-1].append(entry)
+
+   keep = CONFIG['incremental'].get('keep_chains', 10)
+   manifest['chains'] = manifest['chains'][-keep:]
+   state.save(manifest_file, manifest)
+   state.save(join(staging_area, "tar-manifest.json"), manifest)
 
 def run(staging_area):
    if not "target_filename" in CONFIG:
@@ -150,10 +633,23 @@ def run(staging_area):
    if not "tar_params" in CONFIG:
       LOG.error("Config key 'tar_params' is required!")
 
-   client = connect()
-   tar_name = create_tar(client)
-   download_tar(client, tar_name, staging_area)
-   cleanup(client, tar_name)
+   if CONFIG.get('split') and not CONFIG.get('path'):
+      LOG.error("Config key 'path' is required with 'split'!")
+      return
+
+   if CONFIG.get('split') and CONFIG.get('incremental'):
+      LOG.error("'split' cannot be combined with 'incremental'!")
+      return
+
+   host = ('ssh', CONFIG['hostname'], CONFIG.get('port', 22))
+   with server_slots(host, CONFIG.get('max_host_sessions')):
+      client = connect()
+      if CONFIG.get('split'):
+         run_split(client, staging_area)
+      elif CONFIG.get('incremental'):
+         run_incremental(client, staging_area)
+      else:
+         fetch_archive(client, staging_area)
 
 if __name__ == "__main__":
    logging.basicConfig(level=logging.INFO)
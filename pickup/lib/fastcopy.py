@@ -0,0 +1,173 @@
+"""
+Fast local file copies.
+
+Depending on the filesystem and kernel, a file is copied using the first
+method that works:
+
+   ``reflink``
+      The target shares the data blocks of the source (``FICLONE`` ioctl,
+      supported by f.ex. XFS and btrfs). This is nearly instant, independent
+      of the file size.
+
+   ``copy_file_range``
+      The kernel copies the data without passing it through user space. Some
+      filesystems (f.ex. NFS 4.2) perform the copy on the server.
+
+   ``sendfile``
+      Like ``copy_file_range``, available on older kernels.
+
+   ``read/write``
+      A plain copy using Python.
+
+Files of a tree are copied in parallel, as physical copies are often limited
+by the latency of the storage rather than its bandwidth.
+"""
+from os.path import join, relpath
+from shutil import copyfileobj, copystat
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+
+try:
+   import fcntl
+except ImportError:
+   fcntl = None
+
+from pickup.lib.workers import run_parallel
+
+LOG = logging.getLogger(__name__)
+
+#: The ioctl request number of FICLONE (from linux/fs.h)
+FICLONE = 0x40049409
+
+#: The number of bytes copied by one call to copy_file_range/sendfile
+COPY_CHUNK = 1024 * 1024 * 1024
+
+#: Errors meaning "this method is not supported here". The next method is
+#: tried when one of them occurs.
+UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+      errno.ENOTTY, errno.EBADF, errno.ETXTBSY)
+
+def _load_libc():
+   name = ctypes.util.find_library('c')
+   if not name:
+      return None, None
+   libc = ctypes.CDLL(name, use_errno=True)
+
+   copy_file_range = getattr(libc, 'copy_file_range', None)
+   if copy_file_range:
+      copy_file_range.restype = ctypes.c_ssize_t
+      copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+
+   sendfile = getattr(libc, 'sendfile', None)
+   if sendfile:
+      sendfile.restype = ctypes.c_ssize_t
+      sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+            ctypes.c_size_t]
+   return copy_file_range, sendfile
+
+try:
+   _COPY_FILE_RANGE, _SENDFILE = _load_libc()
+except OSError:
+   _COPY_FILE_RANGE, _SENDFILE = None, None
+
+def _reflink(source, target):
+   if not fcntl:
+      return False
+   try:
+      fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+   except IOError, exc:
+      if exc.errno in UNSUPPORTED:
+         return False
+      raise
+   return True
+
+def _kernel_copy(func, source, target, size):
+   """
+   Copy using ``copy_file_range`` or ``sendfile``. Returns False if the
+   first call fails because the method is not supported.
+   """
+   if not func:
+      return False
+   copied = 0
+   while copied < size:
+      if func is _COPY_FILE_RANGE:
+         result = func(source.fileno(), None, target.fileno(), None,
+               min(COPY_CHUNK, size - copied), 0)
+      else:
+         result = func(target.fileno(), source.fileno(), None,
+               min(COPY_CHUNK, size - copied))
+      if result < 0:
+         err = ctypes.get_errno()
+         if copied == 0 and err in UNSUPPORTED:
+            return False
+         raise OSError(err, os.strerror(err))
+      if result == 0:
+         # the file was truncated while copying
+         break
+      copied += result
+   return True
+
+def copy_file(source, target):
+   """
+   Copy the content and the metadata of a file using the fastest available
+   method.
+
+   @return: The name of the method used
+   """
+   with open(source, 'rb') as src:
+      with open(target, 'wb') as dst:
+         size = os.fstat(src.fileno()).st_size
+         if size and _reflink(src, dst):
+            method = 'reflink'
+         elif size and _kernel_copy(_COPY_FILE_RANGE, src, dst, size):
+            method = 'copy_file_range'
+         elif size and _kernel_copy(_SENDFILE, src, dst, size):
+            method = 'sendfile'
+         else:
+            copyfileobj(src, dst, 1024 * 1024)
+            method = 'read/write'
+   copystat(source, target)
+   return method
+
+def copy_tree(source, target, workers=1):
+   """
+   Copy a folder recursively, copying up to ``workers`` files at the same
+   time. Like ``shutil.copytree``, symlinks are followed and ``target`` must
+   not exist.
+
+   @return: A dictionary mapping each method to the number of files copied
+            with it
+   """
+   folders = []
+   files = []
+   for dirpath, _, filenames in os.walk(source, followlinks=True):
+      folder = join(target, relpath(dirpath, source))
+      os.makedirs(folder)
+      folders.append((dirpath, folder))
+      for name in filenames:
+         files.append((join(dirpath, name), join(folder, name)))
+
+   # Big files first, to keep all workers busy until the end
+   files.sort(key=lambda item: os.path.getsize(item[0]), reverse=True)
+   results = run_parallel(lambda item: copy_file(*item), files, workers)
+
+   methods = {}
+   errors = []
+   for (src, _), method, exc in results:
+      if exc:
+         errors.append((src, exc))
+         continue
+      methods[method] = methods.get(method, 0) + 1
+
+   # Folder times are set last, as adding files changes them
+   for src, dst in folders:
+      copystat(src, dst)
+
+   if errors:
+      raise IOError("Unable to copy %d files (first error on %r: %s)" % (
+         len(errors), errors[0][0], errors[0][1]))
+   return methods
@@ -0,0 +1,70 @@
+"""
+A pool of FTP sessions used by worker threads.
+
+``ftplib.FTP`` objects cannot be shared between threads, as each command
+waits for its reply on the control connection. The pool gives every thread
+its own session, created on first use.
+"""
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+
+class FTPPool(object):
+   """
+   Hands out one FTP session per thread.
+   """
+
+   def __init__(self, factory):
+      """
+      @param factory: A callable returning a new, logged in ``ftplib.FTP``
+                      instance
+      """
+      self.factory = factory
+      self._local = threading.local()
+      self._sessions = []
+      self._lock = threading.Lock()
+
+   def get(self):
+      """
+      Returns the session of the current thread, opening it if needed.
+      """
+      conn = getattr(self._local, 'conn', None)
+      if conn is None:
+         conn = self.factory()
+         self._local.conn = conn
+         with self._lock:
+            self._sessions.append(conn)
+            LOG.debug("Opened FTP session #%d" % len(self._sessions))
+      return conn
+
+   def discard(self):
+      """
+      Drop the session of the current thread (f.ex. after a connection
+      error). The next call to `get` opens a new one.
+      """
+      conn = getattr(self._local, 'conn', None)
+      if conn is None:
+         return
+      self._local.conn = None
+      with self._lock:
+         if conn in self._sessions:
+            self._sessions.remove(conn)
+      try:
+         conn.close()
+      except Exception, exc:
+         LOG.debug("Error while closing FTP session: %s" % exc)
+
+   def close_all(self):
+      """
+      Close all sessions of the pool.
+      """
+      with self._lock:
+         sessions, self._sessions = self._sessions, []
+         self._local = threading.local()
+      for conn in sessions:
+         try:
+            conn.quit()
+         except Exception, exc:
+            LOG.debug("Error while closing FTP session: %s" % exc)
+            conn.close()
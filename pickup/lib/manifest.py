@@ -0,0 +1,176 @@
+"""
+The integrity manifest of a backup session.
+
+At the end of the generator phase, the core writes ``pickup-manifest.json``
+into the staging area. It lists the size and hash of every file, so the
+targets (and later restores) can verify their copies.
+
+Hashing a file again after it was written would mean reading all of the data
+a second time. Files written through `pickup.lib.pipeline` are therefore
+hashed while the bytes pass through, and the result is recorded in a registry
+kept by this module. Only files which are not found in the registry are read
+again when the manifest is built.
+
+The hash algorithm is configured by the core (``HASH_ALGORITHM``). Any
+algorithm known to ``hashlib`` can be used. ``xxh64`` and ``xxh128`` are
+supported if the ``xxhash`` package is installed.
+"""
+from os.path import join, relpath, getsize, abspath
+from datetime import datetime
+import hashlib
+import logging
+import os
+import threading
+
+from pickup.lib import state
+
+LOG = logging.getLogger(__name__)
+
+#: The name of the manifest file inside the staging area
+MANIFEST_FILE = "pickup-manifest.json"
+
+#: The algorithm used unless the core configures another one
+DEFAULT_ALGORITHM = "sha256"
+
+_ALGORITHM = [DEFAULT_ALGORITHM]
+_REGISTRY = {}
+_LOCK = threading.Lock()
+
+def set_algorithm(name):
+   """
+   Set the hash algorithm of the session. Raises a ``ValueError`` if it is
+   not available.
+   """
+   new_hash(name)
+   _ALGORITHM[0] = name
+
+def get_algorithm():
+   """
+   Returns the name of the hash algorithm of the session.
+   """
+   return _ALGORITHM[0]
+
+def new_hash(name=None):
+   """
+   Returns a new hash object (with ``update`` and ``hexdigest``).
+
+   @param name: The algorithm. Defaults to the one of the session.
+   """
+   name = name or get_algorithm()
+   if name.startswith("xxh"):
+      try:
+         import xxhash
+      except ImportError:
+         raise ValueError("The hash algorithm %r requires the python "
+               "package 'xxhash'" % name)
+      if not hasattr(xxhash, name):
+         raise ValueError("Unknown hash algorithm %r" % name)
+      return getattr(xxhash, name)()
+   return hashlib.new(name)
+
+def register(filename, size, digest, algorithm=None):
+   """
+   Remember the hash of a file computed while it was written.
+
+   @param algorithm: The algorithm of ``digest``. Defaults to the one of the
+                     session.
+   """
+   with _LOCK:
+      _REGISTRY[abspath(filename)] = (size, digest,
+            algorithm or get_algorithm())
+
+def hash_file(filename, algorithm=None):
+   """
+   Read a file and return its hex digest.
+   """
+   digest = new_hash(algorithm)
+   with open(filename, "rb") as fptr:
+      while True:
+         data = fptr.read(1024 * 1024)
+         if not data:
+            break
+         digest.update(data)
+   return digest.hexdigest()
+
+def get_digest(filename):
+   """
+   Returns the digest of a file using the algorithm of the session. The
+   registry is used if it contains an entry for the file with the same size.
+   """
+   size = getsize(filename)
+   with _LOCK:
+      known = _REGISTRY.get(abspath(filename))
+   if known and known[0] == size and known[2] == get_algorithm():
+      return known[1]
+   LOG.debug("Hashing %r (not hashed while written)" % filename)
+   return hash_file(filename)
+
+def build(folder):
+   """
+   Create the manifest for all files inside ``folder``.
+
+   @return: A dictionary with the keys ``algorithm``, ``created`` and
+            ``files`` (mapping relative paths to ``size`` and ``hash``)
+   """
+   files = {}
+   for dirpath, _, filenames in os.walk(folder):
+      for name in filenames:
+         filename = join(dirpath, name)
+         path = relpath(filename, folder).replace(os.sep, "/")
+         if path == MANIFEST_FILE:
+            continue
+         files[path] = dict(
+               size = getsize(filename),
+               hash = get_digest(filename))
+   return dict(
+         algorithm = get_algorithm(),
+         created = datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+         files = files)
+
+def write(folder):
+   """
+   Build the manifest and store it in ``folder``.
+
+   @return: The manifest
+   """
+   manifest = build(folder)
+   state.save(join(folder, MANIFEST_FILE), manifest)
+   LOG.info("Wrote manifest of %d files (%s)" % (len(manifest['files']),
+      manifest['algorithm']))
+   return manifest
+
+def load(folder):
+   """
+   Read the manifest of ``folder``. Returns ``None`` if there is none.
+   """
+   return state.load(join(folder, MANIFEST_FILE))
+
+def verify(manifest, check, name="target"):
+   """
+   Compare the files of a target with the manifest.
+
+   @param check: A callable receiving a relative path and the manifest entry.
+                 It returns a tuple (size, hash) of the copy. Either value
+                 may be ``None`` if it cannot be determined; it is not
+                 compared in that case.
+   @param name: Used in log messages
+   @return: A list of (path, reason) tuples of all mismatches
+   """
+   errors = []
+   for path, entry in sorted(manifest['files'].items()):
+      try:
+         size, digest = check(path, entry)
+      except Exception, exc:
+         errors.append((path, "unable to check (%s)" % exc))
+         continue
+      if size is not None and size != entry['size']:
+         errors.append((path, "size is %d instead of %d" % (size,
+            entry['size'])))
+      elif digest is not None and digest != entry['hash']:
+         errors.append((path, "hash mismatch"))
+
+   for path, reason in errors:
+      LOG.error("%s: %s: %s" % (name, path, reason))
+   if not errors:
+      LOG.info("%s: %d files verified" % (name, len(manifest['files'])))
+   return errors
@@ -0,0 +1,128 @@
+"""
+Packs small files into a few container archives before they are sent over
+the network.
+
+Remote targets pay a fixed cost for each file (a command round trip, a new
+data connection, ...). With thousands of small files, this overhead dominates
+the upload time. Targets can therefore pack all files below a size threshold
+into uncompressed tar files (``__PICKUP_PACK_0001.tar``, ...). Each container
+comes with an index (``__PICKUP_PACK_0001.json``) listing the path, size,
+hash and position of each member, so single files can be found without
+reading the whole archive.
+
+To restore the original layout, run the module on the downloaded folder::
+
+   python -m pickup.lib.packing /path/to/2010-11-01
+
+This extracts all containers into the folder and removes them.
+"""
+from os.path import join, exists
+import json
+import logging
+import os
+import sys
+import tarfile
+
+from pickup.lib import manifest, state
+
+LOG = logging.getLogger(__name__)
+
+#: The file name pattern of the containers (without extension)
+PACK_NAME = "__PICKUP_PACK_%04d"
+
+#: The default maximum size of one container
+MAX_PACK_SIZE = 256 * 1024 * 1024
+
+def pack_files(source, paths, target_folder, max_size=MAX_PACK_SIZE):
+   """
+   Pack files into containers.
+
+   @param source: The folder containing the files (the staging area)
+   @param paths: The relative paths (using ``/``) of the files to pack
+   @param target_folder: The folder in which the containers are created
+   @param max_size: Start a new container once this size is reached
+   @return: A list of dictionaries, one per container, with the keys
+            ``filename`` (the tar file), ``index`` (the index file),
+            ``members`` (the packed paths), ``size`` and ``hash`` (of the tar
+            file)
+   """
+   packs = []
+   tar = None
+   for path in sorted(paths):
+      if tar is None or current['size'] >= max_size:
+         if tar is not None:
+            _close_pack(tar, current)
+         name = PACK_NAME % (len(packs) + 1)
+         current = dict(
+               filename = join(target_folder, "%s.tar" % name),
+               index = join(target_folder, "%s.json" % name),
+               members = [],
+               entries = {},
+               size = 0)
+         packs.append(current)
+         tar = tarfile.open(current['filename'], "w")
+
+      filename = join(source, *path.split("/"))
+      info = tar.gettarinfo(filename, path)
+      with open(filename, "rb") as fptr:
+         tar.addfile(info, fptr)
+      current['members'].append(path)
+      current['entries'][path] = dict(
+            offset = info.offset_data,
+            size = info.size,
+            hash = manifest.get_digest(filename))
+      current['size'] = tar.offset
+
+   if tar is not None:
+      _close_pack(tar, current)
+
+   LOG.info("Packed %d files into %d containers" % (len(paths), len(packs)))
+   return packs
+
+def _close_pack(tar, pack):
+   tar.close()
+   pack['size'] = os.path.getsize(pack['filename'])
+   pack['hash'] = manifest.hash_file(pack['filename'])
+   state.save(pack['index'], dict(
+      algorithm = manifest.get_algorithm(),
+      archive = os.path.basename(pack['filename']),
+      files = pack.pop('entries')))
+
+def unpack(folder, remove=True):
+   """
+   Extract all containers found in ``folder`` into that folder.
+
+   @param remove: Delete the containers and their index after extraction
+   @return: The number of extracted files
+   """
+   count = 0
+   for name in sorted(os.listdir(folder)):
+      if not (name.startswith("__PICKUP_PACK_") and name.endswith(".json")):
+         continue
+      index = state.load(join(folder, name))
+      archive = join(folder, index['archive'])
+      tar = tarfile.open(archive, "r")
+      try:
+         for member in tar.getmembers():
+            if member.name.startswith("/") or ".." in member.name.split("/"):
+               raise ValueError("Refusing to extract %r" % member.name)
+            tar.extract(member, folder)
+            target = join(folder, *member.name.split("/"))
+            expected = index['files'].get(member.name)
+            if expected and os.path.getsize(target) != expected['size']:
+               raise IOError("Size mismatch for %r" % member.name)
+            count += 1
+      finally:
+         tar.close()
+      LOG.info("Extracted %s" % index['archive'])
+      if remove:
+         os.unlink(archive)
+         os.unlink(join(folder, name))
+   return count
+
+if __name__ == "__main__":
+   logging.basicConfig(level=logging.INFO)
+   if len(sys.argv) < 2 or not exists(sys.argv[1]):
+      print >> sys.stderr, "Usage: python -m pickup.lib.packing <folder>"
+      sys.exit(1)
+   print "%d files extracted" % unpack(sys.argv[1])
@@ -0,0 +1,485 @@
+"""
+Streaming helpers used by the generator plugins to move data from a process
+into a file in the staging area, compressing it on the way.
+
+The main entry point is `run_pipeline` which connects a dump command to a
+compressor and a file. Both stderr streams are drained concurrently, so a
+chatty process can never block on a full pipe. While the data passes through,
+the number of bytes before and after compression and a checksum of the written
+file are computed, and the time spent in each stage is measured.
+
+Compressors are selected by name:
+
+   ``gzip``
+      In-process gzip compression (``.gz``)
+
+   ``bzip2``
+      In-process bzip2 compression (``.bz2``)
+
+   ``none``
+      No compression. The data is written as-is.
+
+If ``threads`` is larger than 1, the in-process compressors split the stream
+into blocks which are compressed concurrently. The result is a sequence of
+complete gzip members (or bzip2 streams) which ``gunzip`` and ``bunzip2``
+decompress as one file.
+
+Alternatively, a compressor may be given as a list, which is then run as
+external command (f.ex.: ``['pigz', '-p', '8']``). The data is piped through
+its standard input and output.
+"""
+import bz2
+import logging
+import os
+import threading
+import time
+import zlib
+from Queue import Queue
+from subprocess import Popen, PIPE
+
+from pickup.lib import manifest
+
+LOG = logging.getLogger(__name__)
+
+#: The number of bytes read from a source at once
+CHUNK_SIZE = 1024 * 1024
+
+#: The size of the blocks compressed by each thread of a `ParallelCompressor`
+BLOCK_SIZE = 4 * 1024 * 1024
+
+#: File suffixes of well-known external compression commands
+EXTERNAL_SUFFIXES = {
+      'gzip': 'gz',
+      'pigz': 'gz',
+      'bzip2': 'bz2',
+      'pbzip2': 'bz2',
+      'lbzip2': 'bz2',
+      'compress': 'z',
+      'xz': 'xz',
+      'zstd': 'zst',
+      }
+
+class NullCompressor(object):
+   """
+   A compressor which passes the data through unmodified.
+   """
+   suffix = ''
+
+   def compress(self, data):
+      return data
+
+   def flush(self):
+      return ''
+
+class GzipCompressor(object):
+   """
+   Produces a gzip stream (compatible with ``gunzip``) using ``zlib``.
+   """
+   suffix = 'gz'
+
+   def __init__(self, level=6):
+      # a wbits value of 16+MAX_WBITS makes zlib write the gzip header and
+      # trailer
+      self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+   def compress(self, data):
+      return self._obj.compress(data)
+
+   def flush(self):
+      return self._obj.flush()
+
+class Bzip2Compressor(object):
+   """
+   Produces a bzip2 stream (compatible with ``bunzip2``).
+   """
+   suffix = 'bz2'
+
+   def __init__(self, level=9):
+      self._obj = bz2.BZ2Compressor(level)
+
+   def compress(self, data):
+      return self._obj.compress(data)
+
+   def flush(self):
+      return self._obj.flush()
+
+class ParallelCompressor(object):
+   """
+   Compresses independent blocks of the stream in several threads. The
+   compressed blocks are returned in their original order.
+
+   ``zlib`` and ``bz2`` release the GIL while compressing, so this scales with
+   the number of cores.
+   """
+
+   def __init__(self, factory, threads, block_size=BLOCK_SIZE):
+      """
+      @param factory: A callable returning a new single-threaded compressor
+      @param threads: The number of compression threads
+      @param block_size: The number of uncompressed bytes per block
+      """
+      self._factory = factory
+      self.suffix = factory().suffix
+      self._block_size = block_size
+      self._buffer = []
+      self._buffered = 0
+      self._next_in = 0
+      self._next_out = 0
+      self._results = {}
+      self._cond = threading.Condition()
+      self._jobs = Queue(threads * 2)
+      self._threads = [threading.Thread(target=self._work)
+            for _ in range(threads)]
+      for thread in self._threads:
+         thread.daemon = True
+         thread.start()
+
+   def _work(self):
+      while True:
+         seq, block = self._jobs.get()
+         if seq is None:
+            return
+         compressor = self._factory()
+         data = compressor.compress(block) + compressor.flush()
+         with self._cond:
+            self._results[seq] = data
+            self._cond.notify_all()
+
+   def _submit(self, block):
+      self._jobs.put((self._next_in, block))
+      self._next_in += 1
+
+   def _collect(self, wait):
+      output = []
+      with self._cond:
+         while self._next_out < self._next_in:
+            if self._next_out not in self._results:
+               if not wait:
+                  break
+               self._cond.wait()
+               continue
+            output.append(self._results.pop(self._next_out))
+            self._next_out += 1
+      return ''.join(output)
+
+   def compress(self, data):
+      self._buffer.append(data)
+      self._buffered += len(data)
+      if self._buffered < self._block_size:
+         return ''
+      data = ''.join(self._buffer)
+      offset = 0
+      while len(data) - offset >= self._block_size:
+         self._submit(data[offset:offset+self._block_size])
+         offset += self._block_size
+      self._buffer = [data[offset:]]
+      self._buffered = len(data) - offset
+      return self._collect(wait=False)
+
+   def flush(self):
+      if self._buffered:
+         self._submit(''.join(self._buffer))
+         self._buffer = []
+         self._buffered = 0
+      output = self._collect(wait=True)
+      for _ in self._threads:
+         self._jobs.put((None, None))
+      return output
+
+class ExternalCompressor(object):
+   """
+   Describes an external compression command. This is not used with
+   `copy_stream` but handled by `run_pipeline` as separate process.
+   """
+
+   def __init__(self, command):
+      self.command = list(command)
+      name = os.path.basename(self.command[0])
+      self.suffix = EXTERNAL_SUFFIXES.get(name, name)
+
+COMPRESSORS = {
+      'none': NullCompressor,
+      'gzip': GzipCompressor,
+      'bzip2': Bzip2Compressor,
+      }
+
+def get_compressor(name, level=None, threads=1):
+   """
+   Create a new compressor instance.
+
+   @param name: The compressor name (see the module docs). ``None`` is the
+                same as ``"none"``. If this is a list, it is used as external
+                command.
+   @param level: The compression level. If ``None`` the default level of the
+                 compressor is used.
+   @param threads: The number of threads used to compress the data.
+   """
+   if isinstance(name, (list, tuple)):
+      return ExternalCompressor(name)
+
+   name = name or 'none'
+   if name not in COMPRESSORS:
+      raise ValueError("Unknown compressor %r! Known compressors: %s" % (
+         name, ", ".join(sorted(COMPRESSORS))))
+   cls = COMPRESSORS[name]
+   if cls is NullCompressor:
+      return cls()
+
+   if level is None:
+      factory = cls
+   else:
+      factory = lambda: cls(level)
+
+   if threads and threads > 1:
+      return ParallelCompressor(factory, threads)
+   return factory()
+
+def add_suffix(filename, compressor):
+   """
+   Append the compressor's file suffix to ``filename`` (if any).
+   """
+   if compressor.suffix:
+      return "%s.%s" % (filename, compressor.suffix)
+   return filename
+
+def copy_stream(source, sink, compressor=None, chunk_size=CHUNK_SIZE,
+      digest=None):
+   """
+   Read everything from ``source`` and write it to ``sink``, compressing the
+   data on the way.
+
+   @param source: A file-like object to read from
+   @param sink: A file-like object to write into
+   @param compressor: A compressor as returned by `get_compressor`
+   @param chunk_size: The number of bytes to read at once
+   @param digest: An optional ``hashlib`` object which is updated with the
+                  written bytes
+   @return: A dictionary with the keys ``bytes_in``, ``bytes_out``,
+            ``elapsed`` (seconds) and ``stages`` (a dictionary with the
+            seconds spent in "read", "compress" and "write")
+   """
+   compressor = compressor or NullCompressor()
+   bytes_in = bytes_out = 0
+   stages = dict(read=0.0, compress=0.0, write=0.0)
+   start = time.time()
+
+   def write(data):
+      if digest:
+         digest.update(data)
+      sink.write(data)
+
+   while True:
+      tick = time.time()
+      data = source.read(chunk_size)
+      stages['read'] += time.time() - tick
+      if not data:
+         break
+      bytes_in += len(data)
+      tick = time.time()
+      data = compressor.compress(data)
+      stages['compress'] += time.time() - tick
+      if data:
+         tick = time.time()
+         write(data)
+         stages['write'] += time.time() - tick
+         bytes_out += len(data)
+   tick = time.time()
+   data = compressor.flush()
+   stages['compress'] += time.time() - tick
+   if data:
+      tick = time.time()
+      write(data)
+      stages['write'] += time.time() - tick
+      bytes_out += len(data)
+   return dict(bytes_in=bytes_in, bytes_out=bytes_out,
+         elapsed=time.time() - start, stages=stages)
+
+class Sink(object):
+   """
+   A writable file which compresses, counts and hashes everything written to
+   it. Used when the data is produced in-process instead of by a command.
+   """
+
+   def __init__(self, filename, compressor=None, checksum=True):
+      """
+      @param filename: The target file
+      @param compressor: A compressor as returned by `get_compressor`. External
+                         compressors are not supported.
+      @param checksum: The name of a hash algorithm used to compute the
+                       checksum of the written file (see
+                       `pickup.lib.manifest.new_hash`). ``True`` uses the
+                       algorithm of the session, ``None`` disables it.
+      """
+      if isinstance(compressor, ExternalCompressor):
+         raise ValueError("External compressors cannot be used with a Sink!")
+      self.filename = filename
+      self._compressor = compressor or NullCompressor()
+      self._algorithm = (checksum is True and manifest.get_algorithm()
+            or checksum)
+      self._digest = checksum and manifest.new_hash(self._algorithm) or None
+      self._file = open(filename, "wb")
+      self._start = time.time()
+      self.bytes_in = 0
+      self.bytes_out = 0
+
+   def _write(self, data):
+      if not data:
+         return
+      if self._digest:
+         self._digest.update(data)
+      self._file.write(data)
+      self.bytes_out += len(data)
+
+   def write(self, data):
+      self.bytes_in += len(data)
+      self._write(self._compressor.compress(data))
+
+   def close(self):
+      """
+      Flush the compressor and close the file.
+
+      @return: A dictionary with the keys ``filename``, ``bytes_in``,
+               ``bytes_out``, ``elapsed`` and ``checksum``
+      """
+      self._write(self._compressor.flush())
+      self._file.close()
+      checksum = None
+      if self._digest:
+         checksum = self._digest.hexdigest()
+         manifest.register(self.filename, self.bytes_out, checksum,
+               self._algorithm)
+      return dict(
+            filename = self.filename,
+            bytes_in = self.bytes_in,
+            bytes_out = self.bytes_out,
+            elapsed = time.time() - self._start,
+            checksum = checksum,
+            )
+
+def drain(stream, lines):
+   """
+   Start a thread which reads ``stream`` until EOF and appends the data to
+   ``lines``. Used to empty stderr pipes while the main stream is processed.
+
+   @return: The started thread
+   """
+   def read():
+      for line in iter(stream.readline, ''):
+         lines.append(line)
+      stream.close()
+   thread = threading.Thread(target=read)
+   thread.daemon = True
+   thread.start()
+   return thread
+
+def run_pipeline(command, filename, compressor=None, checksum=True,
+      popen_params=None):
+   """
+   Run ``command`` and write its standard output through ``compressor`` into
+   ``filename``. The compressor's suffix is *not* appended to the filename.
+   Use `add_suffix` to construct it.
+
+   @param command: The command (a list) passed to Popen
+   @param filename: The target file
+   @param compressor: A compressor as returned by `get_compressor`
+   @param checksum: The name of a hash algorithm used to compute the checksum
+                    of the written file (see `pickup.lib.manifest.new_hash`).
+                    ``True`` uses the algorithm of the session, ``None``
+                    disables it.
+   @param popen_params: Additional keyword arguments passed to Popen when
+                        starting ``command``
+   @return: A dictionary with the statistics of `copy_stream` and the
+            additional keys ``filename``, ``returncode``, ``stderr``,
+            ``compressor_returncode``, ``compressor_stderr`` and
+            ``checksum`` (the hex digest)
+   """
+   compressor = compressor or NullCompressor()
+   algorithm = checksum is True and manifest.get_algorithm() or checksum
+   digest = checksum and manifest.new_hash(algorithm) or None
+   start = time.time()
+
+   LOG.debug("Running command %r into %r" % (command, filename))
+   dumper = Popen(command, stdout=PIPE, stderr=PIPE, **(popen_params or {}))
+   stderr = []
+   drainers = [drain(dumper.stderr, stderr)]
+
+   compressor_process = None
+   compressor_stderr = []
+   sink = open(filename, "wb")
+   try:
+      if isinstance(compressor, ExternalCompressor):
+         compressor_process = Popen(compressor.command, stdin=PIPE,
+               stdout=PIPE, stderr=PIPE)
+         drainers.append(drain(compressor_process.stderr, compressor_stderr))
+         feed_stats = {}
+
+         def feed():
+            try:
+               feed_stats.update(copy_stream(dumper.stdout,
+                  compressor_process.stdin))
+            finally:
+               compressor_process.stdin.close()
+
+         feeder = threading.Thread(target=feed)
+         feeder.daemon = True
+         feeder.start()
+         stats = copy_stream(compressor_process.stdout, sink, digest=digest)
+         feeder.join()
+         stats['bytes_in'] = feed_stats.get('bytes_in', 0)
+         stats['stages'] = dict(
+               read=feed_stats.get('stages', {}).get('read', 0.0),
+               compress=stats['stages']['read'],
+               write=stats['stages']['write'])
+      else:
+         stats = copy_stream(dumper.stdout, sink, compressor, digest=digest)
+   finally:
+      sink.close()
+      dumper.stdout.close()
+
+   stats['returncode'] = dumper.wait()
+   if compressor_process:
+      stats['compressor_returncode'] = compressor_process.wait()
+   else:
+      stats['compressor_returncode'] = 0
+   for thread in drainers:
+      thread.join()
+
+   stats.update(
+         filename = filename,
+         elapsed = time.time() - start,
+         stderr = ''.join(stderr),
+         compressor_stderr = ''.join(compressor_stderr),
+         checksum = digest and digest.hexdigest() or None,
+         )
+   if digest:
+      manifest.register(filename, stats['bytes_out'], stats['checksum'],
+            algorithm)
+   return stats
+
+def log_result(name, result):
+   """
+   Log the statistics returned by `run_pipeline`.
+
+   @param name: A label for the log messages (f.ex. the database name)
+   @param result: The dictionary returned by `run_pipeline`
+   """
+   LOG.info("%s: %d bytes read, %d bytes written in %.1fs (%s)" % (
+      name, result['bytes_in'], result['bytes_out'], result['elapsed'],
+      throughput(result['bytes_in'], result['elapsed'])))
+   stages = result['stages']
+   LOG.debug("%s: read %.1fs (%s), compress %.1fs (%s), write %.1fs (%s)" % (
+      name,
+      stages['read'], throughput(result['bytes_in'], stages['read']),
+      stages['compress'], throughput(result['bytes_in'], stages['compress']),
+      stages['write'], throughput(result['bytes_out'], stages['write'])))
+   if result.get('checksum'):
+      LOG.debug("%s: checksum of %r: %s" % (name, result['filename'],
+         result['checksum']))
+
+def throughput(num_bytes, elapsed):
+   """
+   Format a throughput value for log messages.
+   """
+   if elapsed <= 0:
+      return "n/a"
+   return "%.2f MB/s" % (num_bytes / elapsed / 1024.0 / 1024.0)
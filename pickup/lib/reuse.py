@@ -0,0 +1,102 @@
+"""
+Keeps the artifacts of the last successful dump in the state folder, so they
+can be reused when the source did not change since.
+
+Artifacts are hard-linked between the staging area and the cache. This costs
+no additional disk space or I/O as long as both are on the same filesystem.
+Otherwise the files are copied. The checksum of an artifact is kept in the
+cache, so a reused artifact does not need to be hashed again for the
+manifest of the session.
+"""
+from os.path import exists, join, basename
+from shutil import copy2
+import logging
+import os
+import threading
+
+from pickup.lib import manifest, state
+
+LOG = logging.getLogger(__name__)
+
+def link_or_copy(source, target):
+   """
+   Hard-link ``source`` to ``target``. Falls back to a copy if that is not
+   possible (f.ex. when crossing filesystems).
+   """
+   if exists(target):
+      os.unlink(target)
+   try:
+      os.link(source, target)
+   except OSError, exc:
+      LOG.debug("Unable to link %r to %r (%s). Copying instead." % (
+         source, target, exc))
+      copy2(source, target)
+
+class ArtifactCache(object):
+   """
+   A folder containing the last artifact for each key (f.ex. a database name)
+   together with the fingerprint of the source at the time it was created.
+   """
+
+   def __init__(self, folder):
+      self.folder = folder
+      self.index_file = join(folder, "index.json")
+      self.index = state.load(self.index_file, {})
+      self._lock = threading.Lock()
+
+   def restore(self, key, fingerprint, target_folder):
+      """
+      Put the cached artifact for ``key`` into ``target_folder`` if its
+      fingerprint matches.
+
+      @return: The entry of the reused artifact, or ``None`` if the artifact
+               must be regenerated
+      """
+      if not fingerprint:
+         return None
+      with self._lock:
+         entry = self.index.get(key)
+      if not entry or entry['fingerprint'] != fingerprint:
+         return None
+
+      cached = join(self.folder, entry['file'])
+      if not exists(cached):
+         LOG.warning("Cached artifact %r is missing!" % cached)
+         return None
+
+      target = join(target_folder, entry['file'])
+      link_or_copy(cached, target)
+      if entry.get('checksum') and entry.get('algorithm'):
+         manifest.register(target, os.path.getsize(target),
+               entry['checksum'], entry['algorithm'])
+      return entry
+
+   def store(self, key, fingerprint, filename, **info):
+      """
+      Remember ``filename`` as the artifact for ``key``. Any previous
+      artifact for that key is removed from the cache.
+
+      @param info: Additional values stored in the index entry. A
+                   ``checksum`` is assumed to use the hash algorithm of the
+                   session.
+      """
+      name = basename(filename)
+      with self._lock:
+         old = self.index.get(key)
+         if old and exists(join(self.folder, old['file'])):
+            os.unlink(join(self.folder, old['file']))
+         if fingerprint:
+            link_or_copy(filename, join(self.folder, name))
+            entry = dict(info, fingerprint=fingerprint, file=name)
+            if entry.get('checksum'):
+               entry.setdefault('algorithm', manifest.get_algorithm())
+            self.index[key] = entry
+         else:
+            self.index.pop(key, None)
+
+   def save(self):
+      """
+      Write the index to disk.
+      """
+      with self._lock:
+         state.save(self.index_file, self.index)
@@ -0,0 +1,78 @@
+"""
+A pool of SSH connections shared by all profiles of a session.
+
+Connections are keyed by (hostname, port, username). Profiles targeting the
+same host reuse the transport of the first one instead of doing a new key
+exchange. paramiko multiplexes any number of channels over one transport, so
+several commands and SFTP sessions can run on it at the same time.
+
+All channels of a transport share one TCP connection. Where a single TCP
+stream is the bottleneck (f.ex. on long links), callers can ask for
+additional connections to the same host using ``slot``.
+"""
+import logging
+import threading
+
+import paramiko
+
+LOG = logging.getLogger(__name__)
+
+_CLIENTS = {}
+_KEY_LOCKS = {}
+_LOCK = threading.Lock()
+
+def get_client(hostname, port=22, username=None, password=None,
+      key_filename=None, slot=None):
+   """
+   Returns a connected ``paramiko.SSHClient`` for the given host. An existing
+   connection is reused if its transport is still active.
+
+   Connections to different hosts (or slots) are opened at the same time.
+   Only callers asking for the same connection wait for each other.
+
+   @param slot: Selects one of several connections to the same host. Calls
+                with different slots get separate connections.
+   """
+   key = (hostname, int(port), username, slot)
+   with _LOCK:
+      key_lock = _KEY_LOCKS.setdefault(key, threading.Lock())
+
+   with key_lock:
+      with _LOCK:
+         client = _CLIENTS.get(key)
+      if client:
+         transport = client.get_transport()
+         if transport and transport.is_active():
+            LOG.debug("Reusing connection to %s@%s:%s" % (username,
+               hostname, port))
+            return client
+         LOG.debug("Connection to %s@%s:%s is no longer active" % (
+            username, hostname, port))
+
+      client = paramiko.SSHClient()
+      client.load_system_host_keys()
+      client.set_missing_host_key_policy(paramiko.WarningPolicy())
+
+      LOG.info("Connecting to remote host %r" % hostname)
+      client.connect(
+            hostname = hostname,
+            port = int(port),
+            username = username,
+            password = password,
+            key_filename = key_filename
+            )
+      with _LOCK:
+         _CLIENTS[key] = client
+      return client
+
+def close_all():
+   """
+   Close all pooled connections. Called by the core at the end of the
+   session.
+   """
+   with _LOCK:
+      for (hostname, port, username, _), client in _CLIENTS.items():
+         LOG.debug("Closing connection to %s@%s:%s" % (username, hostname,
+            port))
+         client.close()
+      _CLIENTS.clear()
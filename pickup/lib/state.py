@@ -0,0 +1,61 @@
+"""
+Persistent state shared between backup sessions.
+
+The staging area is deleted at the end of each session. Plugins which need to
+remember something between runs (f.ex. for incremental backups) store it in a
+state folder instead. The folder defaults to ``~/.pickup/state`` and can be
+changed per profile with the config value ``state_folder``.
+"""
+from os.path import exists, expanduser, join, dirname
+import json
+import logging
+import os
+import re
+
+LOG = logging.getLogger(__name__)
+
+#: The default location of the state folder
+DEFAULT_FOLDER = "~/.pickup/state"
+
+def clean_name(name):
+   """
+   Turn a profile name into a string usable as filename.
+   """
+   return re.sub( r'[^a-zA-Z0-9_-]', '_', name ).strip("_")
+
+def get_folder(config, *parts):
+   """
+   Returns (and creates) a folder inside the state folder.
+
+   @param config: The profile config. The key ``state_folder`` overrides the
+                  default location.
+   @param parts: Path elements appended to the state folder
+   """
+   folder = expanduser(config.get('state_folder', None) or DEFAULT_FOLDER)
+   folder = join(folder, *[clean_name(part) for part in parts])
+   if not exists(folder):
+      os.makedirs(folder, 0700)
+      LOG.debug("Created state folder %r" % folder)
+   return folder
+
+def load(filename, default=None):
+   """
+   Read a JSON state file. Returns ``default`` if the file does not exist.
+   """
+   if not exists(filename):
+      return default
+   with open(filename) as fptr:
+      return json.load(fptr)
+
+def save(filename, data):
+   """
+   Write a JSON state file. The data is written to a temporary file first
+   which then replaces the old file, so an interrupted session never leaves a
+   corrupt state behind.
+   """
+   tmpname = "%s.tmp" % filename
+   if not exists(dirname(filename) or "."):
+      os.makedirs(dirname(filename), 0700)
+   with open(tmpname, "w") as fptr:
+      json.dump(data, fptr, indent=2, sort_keys=True)
+   os.rename(tmpname, filename)
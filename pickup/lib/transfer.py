@@ -0,0 +1,358 @@
+"""
+Parallel, resumable SFTP downloads.
+
+A single ``SFTPClient.get()`` waits for each block before requesting the next
+one, so on a link with a high latency it only uses a fraction of the
+available bandwidth. `download` splits the remote file into byte ranges which
+are fetched by several workers, each on its own SFTP channel over the same
+SSH transport. Inside each range, reads are pipelined using
+``SFTPFile.readv``.
+
+The file is written to ``<filename>.part`` and renamed once it is complete.
+If the transfer is interrupted, only the missing ranges are fetched again on
+the next attempt. If it still fails after all attempts, the partial file is
+removed, so it does not end up in the backup.
+"""
+from os.path import exists
+import logging
+import os
+import socket
+import threading
+import time
+
+import paramiko
+
+from pickup.lib import manifest
+from pickup.lib.pipeline import throughput
+from pickup.lib.workers import run_parallel
+
+LOG = logging.getLogger(__name__)
+
+#: The default size of the byte ranges fetched by the workers. The ranges
+#: are handed out in order, so the data of all workers arrives close to the
+#: position up to which the file has been hashed.
+CHUNK_SIZE = 8 * 1024 * 1024
+
+#: The maximum number of bytes kept in memory while they wait to be hashed
+HASH_BUFFER = 64 * 1024 * 1024
+
+#: The size of a single read request. Larger requests are split by paramiko.
+BLOCK_SIZE = 32 * 1024
+
+#: Errors considered transient. The download is retried when one occurs.
+TRANSIENT_ERRORS = (IOError, EOFError, socket.error, paramiko.SSHException)
+
+class RemoteDigest(object):
+   """
+   Computes the checksum of a remote file (using ``sha256sum``) while the
+   download is running.
+   """
+
+   def __init__(self, client, remote_name, command="sha256sum"):
+      self.command = "%s %s" % (command, remote_name)
+      _, self.stdout, self.stderr = client.exec_command(self.command)
+
+   def result(self):
+      """
+      Returns the remote digest, or ``None`` if it could not be computed.
+      """
+      try:
+         stdout = self.stdout.read().strip()
+         stderr = self.stderr.read().strip()
+         status = self.stdout.channel.recv_exit_status()
+      except TRANSIENT_ERRORS, exc:
+         LOG.warning("Unable to read remote checksum: %s" % exc)
+         return None
+      if status != 0 or not stdout:
+         LOG.warning("Unable to compute remote checksum with %r: %s" % (
+            self.command, stderr))
+         return None
+      return stdout.split()[0]
+
+class Download(object):
+   """
+   The state of one download. See `download`.
+
+   The checksum is computed while the data is written. Blocks arriving at
+   the current hash position are hashed immediately. Blocks arriving ahead
+   of it (from the other channels) are kept in memory until the blocks
+   before them have been hashed. If more than `HASH_BUFFER` bytes are
+   waiting (f.ex. because a chunk has to be fetched again), they are
+   dropped and read back from the partial file later.
+   """
+
+   def __init__(self, remote_name, filename, size, chunk_size,
+         algorithms=('sha256',)):
+      self.remote_name = remote_name
+      self.filename = filename
+      self.partname = "%s.part" % filename
+      self.size = size
+      self.chunk_size = chunk_size
+      self.done = set()
+      self.digests = dict((name, manifest.new_hash(name))
+            for name in algorithms)
+      self.position = 0
+      self.reread = 0
+      self._pending = {}
+      self._pending_size = 0
+      self._lock = threading.Lock()
+
+   def prepare(self):
+      """
+      Create the partial file with its final size.
+      """
+      with open(self.partname, "wb") as fptr:
+         fptr.truncate(self.size)
+
+   def chunks(self):
+      """
+      Returns all byte ranges as (offset, length) tuples.
+      """
+      return [(offset, min(self.chunk_size, self.size - offset))
+            for offset in range(0, self.size, self.chunk_size)]
+
+   def missing(self):
+      return [chunk for chunk in self.chunks() if chunk[0] not in self.done]
+
+   def _update(self, data):
+      for digest in self.digests.values():
+         digest.update(data)
+      self.position += len(data)
+
+   def _drain(self):
+      """
+      Hash the buffered blocks which continue the hashed range.
+      """
+      while self._pending:
+         data = self._pending.pop(self.position, None)
+         if data is None:
+            break
+         self._pending_size -= len(data)
+         self._update(data)
+      for offset in [offset for offset in self._pending
+            if offset < self.position]:
+         self._pending_size -= len(self._pending.pop(offset))
+
+   def feed(self, offset, data):
+      """
+      Hash a block written at ``offset``.
+      """
+      with self._lock:
+         if offset == self.position:
+            self._update(data)
+            self._drain()
+         elif offset > self.position and offset not in self._pending:
+            if self._pending_size + len(data) > HASH_BUFFER:
+               self._pending.clear()
+               self._pending_size = 0
+            else:
+               self._pending[offset] = data
+               self._pending_size += len(data)
+
+   def mark_done(self, offset):
+      with self._lock:
+         self.done.add(offset)
+         self._catch_up()
+
+   def _catch_up(self):
+      """
+      Read back the completed chunks at the hash position whose blocks were
+      not hashed while they were written.
+      """
+      while self.position < self.size:
+         chunk = self.position - self.position % self.chunk_size
+         if chunk not in self.done:
+            return
+         end = min(chunk + self.chunk_size, self.size)
+         with open(self.partname, "rb") as fptr:
+            while self.position < end:
+               if self.position in self._pending:
+                  self._drain()
+                  continue
+               fptr.seek(self.position)
+               data = fptr.read(min(BLOCK_SIZE, end - self.position))
+               if not data:
+                  raise IOError("%r is shorter than expected" %
+                        self.partname)
+               self.reread += len(data)
+               self._update(data)
+
+   def checksums(self):
+      """
+      Returns a dictionary mapping each algorithm to the hex digest.
+      """
+      if self.position != self.size:
+         raise IOError("Only %d of %d bytes of %r were hashed" % (
+            self.position, self.size, self.filename))
+      return dict((name, digest.hexdigest())
+            for name, digest in self.digests.items())
+
+   def finish(self):
+      os.rename(self.partname, self.filename)
+
+   def abort(self):
+      if exists(self.partname):
+         os.unlink(self.partname)
+
+class Channels(object):
+   """
+   Hands out one open handle of the remote file per thread, so the chunks
+   fetched by a thread reuse its SFTP channel.
+   """
+
+   def __init__(self, client, remote_name):
+      self.client = client
+      self.remote_name = remote_name
+      self._local = threading.local()
+      self._opened = []
+      self._lock = threading.Lock()
+
+   def get(self):
+      remote = getattr(self._local, 'remote', None)
+      if remote is None:
+         sftp = self.client.open_sftp()
+         remote = sftp.open(self.remote_name, "rb")
+         self._local.remote = remote
+         with self._lock:
+            self._opened.append((sftp, remote))
+      return remote
+
+   def discard(self):
+      """
+      Drop the handle of the current thread after an error.
+      """
+      self._local.remote = None
+
+   def close_all(self):
+      with self._lock:
+         opened, self._opened = self._opened, []
+      for sftp, remote in opened:
+         try:
+            remote.close()
+            sftp.close()
+         except TRANSIENT_ERRORS, exc:
+            LOG.debug("Error while closing SFTP channel: %s" % exc)
+
+def fetch_chunk(channels, job, chunk):
+   """
+   Fetch one byte range of the remote file into the partial file.
+   """
+   offset, length = chunk
+   remote = channels.get()
+   blocks = [(pos, min(BLOCK_SIZE, offset + length - pos))
+         for pos in range(offset, offset + length, BLOCK_SIZE)]
+   with open(job.partname, "r+b") as local:
+      local.seek(offset)
+      position = offset
+      for data in remote.readv(blocks):
+         local.write(data)
+         job.feed(position, data)
+         position += len(data)
+   job.mark_done(offset)
+
+def download(connect, remote_name, filename, workers=4, chunk_size=CHUNK_SIZE,
+      retries=3, verify=True):
+   """
+   Download a remote file using several parallel SFTP channels.
+
+   @param connect: A callable returning a connected ``paramiko.SSHClient``.
+                   It is called again after a connection failure, so it
+                   should return a fresh client if the old transport is gone
+                   (see `pickup.lib.sshpool.get_client`).
+   @param remote_name: The name of the file on the remote host
+   @param filename: The local filename
+   @param workers: The number of parallel channels
+   @param chunk_size: The size of the byte ranges fetched by the workers
+   @param retries: How often missing chunks are fetched again after a
+                   transient error
+   @param verify: Compare the checksum of the local file with the one of the
+                  remote file (``sha256sum`` on the remote host)
+   @return: A dictionary with the keys ``filename``, ``bytes``, ``elapsed``,
+            ``checksum`` and ``verified`` (``None`` if it could not be
+            checked)
+   """
+   client = connect()
+   sftp = client.open_sftp()
+   try:
+      stat = sftp.stat(remote_name)
+   finally:
+      sftp.close()
+
+   # sha256 is compared with the remote checksum, the algorithm of the
+   # session is recorded in the manifest.
+   job = Download(remote_name, filename, stat.st_size, chunk_size,
+         set(['sha256', manifest.get_algorithm()]))
+   job.prepare()
+
+   remote_digest = None
+   if verify:
+      remote_digest = RemoteDigest(client, remote_name)
+
+   LOG.info("Downloading %r (%d bytes) into %r using %d channels" % (
+      remote_name, job.size, filename, workers))
+   start = time.time()
+   attempt = 0
+   success = False
+   try:
+      while True:
+         missing = job.missing()
+         if not missing:
+            break
+         if attempt > retries:
+            raise IOError("Download of %r incomplete after %d attempts. "
+                  "%d chunks missing." % (remote_name, attempt,
+                     len(missing)))
+         if attempt:
+            delay = min(2 ** attempt, 60)
+            LOG.warning("%d chunks of %r missing. Retrying in %ds" % (
+               len(missing), remote_name, delay))
+            time.sleep(delay)
+            client = connect()
+
+         channels = Channels(client, remote_name)
+         def fetch(chunk):
+            try:
+               fetch_chunk(channels, job, chunk)
+            except TRANSIENT_ERRORS, exc:
+               channels.discard()
+               LOG.warning("Unable to fetch %d bytes at offset %d of %r: "
+                     "%s" % (chunk[1], chunk[0], remote_name, exc))
+         try:
+            run_parallel(fetch, missing, workers)
+         finally:
+            channels.close_all()
+         attempt += 1
+
+      checksums = job.checksums()
+      job.finish()
+      success = True
+   finally:
+      if not success:
+         LOG.error("Removing incomplete download %r" % job.partname)
+         job.abort()
+
+   elapsed = time.time() - start
+   LOG.info("Downloaded %d bytes in %.1fs (%s)" % (job.size, elapsed,
+      throughput(job.size, elapsed)))
+   LOG.debug("%d bytes of %r were read back for hashing" % (job.reread,
+      filename))
+   checksum = checksums['sha256']
+   manifest.register(filename, job.size,
+         checksums[manifest.get_algorithm()])
+   verified = None
+   if remote_digest:
+      expected = remote_digest.result()
+      if expected:
+         verified = expected == checksum
+         if not verified:
+            LOG.error("Checksum mismatch for %r: remote %s, local %s" % (
+               filename, expected, checksum))
+         else:
+            LOG.debug("Checksum of %r verified (%s)" % (filename, checksum))
+
+   return dict(
+         filename = filename,
+         bytes = job.size,
+         elapsed = elapsed,
+         checksum = checksum,
+         verified = verified)
@@ -0,0 +1,88 @@
+"""
+Helpers to run jobs concurrently using a fixed number of worker threads.
+"""
+import logging
+import threading
+from Queue import Queue, Empty
+
+LOG = logging.getLogger(__name__)
+
+def run_parallel(func, items, workers=1):
+   """
+   Call ``func(item)`` for each element in ``items`` using at most ``workers``
+   threads. Items are picked up in the order they are given, so they should
+   be sorted beforehand if some of them need to start first.
+
+   Exceptions raised by ``func`` are logged and do not prevent the remaining
+   items from being processed.
+
+   @param func: A callable taking one item as parameter
+   @param items: An iterable of items
+   @param workers: The maximum number of concurrent threads
+   @return: A list of (item, result, exception) tuples in the order of
+            ``items``
+   """
+   items = list(items)
+   results = [None] * len(items)
+   queue = Queue()
+   for i, item in enumerate(items):
+      queue.put((i, item))
+
+   def worker():
+      while True:
+         try:
+            i, item = queue.get_nowait()
+         except Empty:
+            return
+         try:
+            results[i] = (item, func(item), None)
+         except Exception, exc:
+            LOG.error("Job %r failed: %s" % (item, exc))
+            LOG.exception(exc)
+            results[i] = (item, None, exc)
+
+   workers = max(1, min(int(workers), len(items)))
+   if workers == 1:
+      worker()
+      return results
+
+   LOG.debug("Running %d jobs with %d workers" % (len(items), workers))
+   threads = [threading.Thread(target=worker) for _ in range(workers)]
+   for thread in threads:
+      thread.start()
+   for thread in threads:
+      thread.join()
+   return results
+
+_SLOTS = {}
+_SLOTS_LOCK = threading.Lock()
+
+class _Unlimited(object):
+   """
+   A stand-in for a semaphore when no limit is configured.
+   """
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      return False
+
+def server_slots(key, limit):
+   """
+   Returns a semaphore shared by all jobs talking to the same server. This
+   caps the number of concurrent connections to one server, even if several
+   profiles are targeting it. Use it in a ``with`` statement.
+
+   The limit of the first call for a given key is used.
+
+   @param key: A hashable identifying the server (f.ex. ``(host, port)``)
+   @param limit: The maximum number of concurrent jobs. If ``None``, no limit
+                 is applied.
+   """
+   if not limit:
+      return _Unlimited()
+   with _SLOTS_LOCK:
+      if key not in _SLOTS:
+         _SLOTS[key] = threading.BoundedSemaphore(int(limit))
+      return _SLOTS[key]
@@ -28,11 +28,15 @@ import logging
 import os
 import sys
 import re
+import threading
 
 import generator_profile
 import target_profile
 import config
 from lib.term import TerminalController
+from lib.workers import run_parallel
+from lib import sshpool
+from lib import manifest
 
 LOG = logging.getLogger(__name__)
 OPTIONS = {}
@@ -44,6 +48,9 @@ config_instance = None
 EXPECTED_CONFIG_VERSION = (2,2)
 TERM = TerminalController()
 
+# Protects the creation of staging folders when profiles run in parallel
+STAGING_LOCK = threading.Lock()
+
 class ReverseLevelFilter(logging.Filter):
     """
     Filter out messages *above* a specific level. (In other words: log only
@@ -112,6 +119,7 @@ def setup_logging():
 
     gen_log = logging.getLogger("pickup.generator_profile")
     tgt_log = logging.getLogger("pickup.target_profile")
+    lib_log = logging.getLogger("pickup.lib")
 
     if not OPTIONS.quiet:
         stdout_handler = logging.StreamHandler(sys.stdout)
@@ -126,6 +134,7 @@ def setup_logging():
         LOG.addHandler(stdout_handler)
         gen_log.addHandler(stdout_handler)
         tgt_log.addHandler(stdout_handler)
+        lib_log.addHandler(stdout_handler)
 
     stderr_handler = logging.StreamHandler(sys.stderr)
     stderr_handler.setLevel(logging.WARNING)
@@ -157,6 +166,10 @@ def setup_logging():
     tgt_log.addHandler(stderr_handler)
     tgt_log.addHandler(debug_handler)
 
+    lib_log.setLevel(logging.DEBUG)
+    lib_log.addHandler(stderr_handler)
+    lib_log.addHandler(debug_handler)
+
 def api_is_compatible(module, api_version):
     """
     Check if a plugin module is compatible with this version of the application.
@@ -205,32 +218,41 @@ def get_profile_folder(container, profile_config):
         profile_folder = "%s-%d" % (profile_folder, counter)
     return profile_folder
 
-def load_profile(package, profile_config):
+def load_profile(package, profile_config, isolated=False):
     LOG.debug("Loading profile '%(name)s' [%(profile)s]" % profile_config )
 
     profile = None
     try:
-        profile = package.create(profile_config["profile"])
+        if isolated:
+            profile = package.create(profile_config["profile"], isolated=True)
+        else:
+            profile = package.create(profile_config["profile"])
         if not api_is_compatible(profile, (2,0)):
             return
         profile.init(profile_config)
     except ImportError, exc:
         LOG.error( "Unable to instantiate target profile %s. "
                 "Error message was: %s" % (profile_config["profile"], exc) )
+    except ValueError, exc:
+        LOG.error( "Invalid configuration of profile '%s': %s" % (
+                profile_config["name"], exc) )
+        return None
 
     return profile
 
-def run_profile(package, profile_config):
+def run_profile(package, profile_config, isolated=False):
     """
     Run the generator/target profile
 
     @param package: The profile package
     @param profile_config: The profile settings (from the config)
+    @param isolated: Use a private instance of the profile module (required
+                     when running profiles in parallel)
     """
 
     LOG.info("Running '%(name)s' [%(profile)s]" % profile_config )
 
-    profile = load_profile(package, profile_config)
+    profile = load_profile(package, profile_config, isolated)
     if not profile:
         return
 
@@ -242,12 +264,13 @@ def run_profile(package, profile_config):
         module_folder = join(config_instance.STAGING_AREA, module_folder)
 
         # into the module folder we put a folder based on the profile's name
-        staging_folder = get_profile_folder(module_folder, profile_config)
+        with STAGING_LOCK:
+            staging_folder = get_profile_folder(module_folder, profile_config)
 
-        # just in case it does not exist, we'll create all required folders
-        if not exists( staging_folder ):
-            os.makedirs( staging_folder )
-            LOG.debug( "Created directory %r" % staging_folder )
+            # just in case it does not exist, we'll create all required folders
+            if not exists( staging_folder ):
+                os.makedirs( staging_folder )
+                LOG.debug( "Created directory %r" % staging_folder )
     else:
         staging_folder = config_instance.STAGING_AREA
 
@@ -258,6 +281,46 @@ def run_profile(package, profile_config):
                 (profile_config['name'], exc))
         LOG.exception(exc)
 
+def is_parallel_safe(profile_config):
+    """
+    Returns True if the generator module of a profile declares that it can
+    run in parallel with other profiles (``PARALLEL_SAFE = True``).
+    """
+    try:
+        module = generator_profile.create(profile_config["profile"])
+    except ImportError:
+        return False
+    return getattr(module, "PARALLEL_SAFE", False)
+
+def run_generators(generators):
+    """
+    Run all generator profiles.
+
+    If ``PARALLEL_GENERATORS`` is larger than 1, profiles of plugins which are
+    marked as ``PARALLEL_SAFE`` run concurrently using that many threads. All
+    other profiles run one after the other (in config order) in one of these
+    threads.
+    """
+    workers = getattr(config_instance, "PARALLEL_GENERATORS", 1)
+    if workers <= 1:
+        for generator in generators:
+            run_profile(generator_profile, generator)
+        return
+
+    parallel = [gen for gen in generators if is_parallel_safe(gen)]
+    sequential = [gen for gen in generators if gen not in parallel]
+    LOG.info("Running %d generators in parallel (%d threads), %d "
+            "sequentially" % (len(parallel), workers, len(sequential)))
+
+    def run_job(job):
+        if job is None:
+            for generator in sequential:
+                run_profile(generator_profile, generator)
+        else:
+            run_profile(generator_profile, job, isolated=True)
+
+    run_parallel(run_job, [None] + parallel, workers)
+
 def get_lock_file():
     """
     Returns a lock file.
@@ -322,6 +385,13 @@ def init():
 
     check_config()
 
+    try:
+        manifest.set_algorithm(getattr(config_instance, "HASH_ALGORITHM",
+            manifest.DEFAULT_ALGORITHM))
+    except ValueError, exc:
+        LOG.critical(str(exc))
+        sys.exit(9)
+
     first_target = None
     if (hasattr(config_instance, "FIRST_TARGET_IS_STAGING") and
             config_instance.FIRST_TARGET_IS_STAGING):
@@ -353,15 +423,23 @@ def main():
 
     now = datetime.now()
     LOG.info("Fetching from generators")
-    for generator in config_instance.GENERATORS:
-        run_profile(generator_profile, generator)
+    run_generators(config_instance.GENERATORS)
+    sshpool.close_all()
+    manifest.write(config_instance.STAGING_AREA)
+
+    delete_staging = (not hasattr(config_instance, "FIRST_TARGET_IS_STAGING")
+            or not config_instance.FIRST_TARGET_IS_STAGING)
+
+    # The last target may consume the staging area (f.ex. move it instead of
+    # copying it), as it is deleted afterwards anyway.
+    if delete_staging and config_instance.TARGETS:
+        config_instance.TARGETS[-1]['last_consumer'] = True
 
     LOG.info("Pushing to targets")
     for target in config_instance.TARGETS:
         run_profile(target_profile, target)
 
-    if (not hasattr(config_instance, "FIRST_TARGET_IS_STAGING") or
-            not config_instance.FIRST_TARGET_IS_STAGING):
+    if delete_staging and exists(config_instance.STAGING_AREA):
         LOG.info("Deleting staging area")
         rmtree(config_instance.STAGING_AREA)
 
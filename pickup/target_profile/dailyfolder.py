@@ -2,6 +2,19 @@
 Creates a subfolder with the current date (YYYY-MM-DD) in the target folder and
 copies everything inside the staging area into that folder
 
+If this is the last target and the staging area is on the same filesystem,
+the staging area is simply renamed to the new folder. Otherwise the files are
+copied in parallel using reflinks, ``copy_file_range`` or ``sendfile`` where
+the filesystem supports it (see `pickup.lib.fastcopy`).
+
+Expired folders are not deleted inline. They are renamed into the folder
+``.trash`` (inside ``path``) and deleted by a background thread while the new
+backup is stored. If a session ends before the trash is empty, the next
+session continues. Only one process empties the trash at a time (see
+``.trash.lock``). The creation dates of the folders are kept in a catalog
+(``.pickup-catalog.json`` inside ``path``), so finding expired folders does
+not need to inspect the folders themselves.
+
 Configuration
 ~~~~~~~~~~~~~
 
@@ -19,9 +32,29 @@ The following fields are used by this plugin:
 
       **Default:** ``None``
 
-      .. note:: This script uses the OSs ``mtime`` value to determine the
-                folder's date. Refer to you OS reference to see if this is what
-                you want!
+      .. note:: The folder's date is taken from the catalog. For folders
+                not in the catalog (f.ex. created by older versions), this
+                script uses the OSs ``mtime`` value to determine the folder's
+                date. Refer to you OS reference to see if this is what you
+                want!
+
+   **copy_workers** (int) *optional*
+      .. versionadded:: 1.5
+
+      The number of files copied at the same time. Default: 4
+
+   **verify** (string) *optional*
+      .. versionadded:: 1.5
+
+      How the copy is checked against the manifest of the session:
+      ``"size"`` compares the file sizes, ``"hash"`` reads the copies and
+      compares their hashes. ``None`` disables the check. If the staging area
+      was moved, no check is necessary. Default: ``"size"``
+
+   **prune_workers** (int) *optional*
+      .. versionadded:: 1.5
+
+      The number of threads deleting expired files. Default: 4
 
 Configuration Example
 ~~~~~~~~~~~~~~~~~~~~~
@@ -43,18 +76,40 @@ Configuration Example
 """
 
 from datetime import datetime, timedelta
-from os.path import exists, join
+from os.path import exists, join, islink
 from os import listdir, stat
-from shutil import copytree, rmtree
 import stat as stat_info
 import logging
 import os
+import threading
+import time
+
+try:
+   import fcntl
+except ImportError:
+   fcntl = None
+
+from pickup.lib import manifest, state
+from pickup.lib.fastcopy import copy_tree
+from pickup.lib.workers import run_parallel
 
 LOG = logging.getLogger(__name__)
 API_VERSION = (2,0)
 CONFIG = {}
 TARGET = {}
 
+#: The folder (inside ``path``) holding expired folders until they are deleted
+TRASH_FOLDER = ".trash"
+
+#: The lock file (inside ``path``) held while the trash is emptied
+TRASH_LOCK = ".trash.lock"
+
+#: The catalog file (inside ``path``)
+CATALOG_FILE = ".pickup-catalog.json"
+
+#: The format of the dates stored in the catalog
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
 def init(target):
    CONFIG.update(target['config'])
    TARGET.update(target)
@@ -63,31 +118,191 @@ def init(target):
 def folder():
    return join(CONFIG['path'], datetime.now().strftime('%Y-%m-%d'))
 
+def load_catalog(root):
+   """
+   Returns the catalog of ``root``, a dictionary mapping each entry to its
+   creation date. Entries missing from the catalog are added using their
+   ``mtime``, entries which no longer exist are dropped.
+   """
+   catalog = state.load(join(root, CATALOG_FILE), {})
+   entries = set(entry for entry in listdir(root)
+         if entry not in (TRASH_FOLDER, TRASH_LOCK, CATALOG_FILE,
+            "%s.tmp" % CATALOG_FILE))
+   for entry in entries:
+      if entry not in catalog:
+         file_meta = stat(join(root, entry))
+         mtime = datetime.fromtimestamp(file_meta[stat_info.ST_MTIME])
+         catalog[entry] = mtime.strftime(DATE_FORMAT)
+   for entry in catalog.keys():
+      if entry not in entries:
+         del catalog[entry]
+   return catalog
+
+def save_catalog(root, catalog):
+   state.save(join(root, CATALOG_FILE), catalog)
+
+def remove_tree(path, workers=1):
+   """
+   Delete a folder recursively. The files of different folders are deleted
+   in parallel. Files and symlinks are simply unlinked.
+   """
+   if islink(path) or not os.path.isdir(path):
+      os.unlink(path)
+      return
+   folders = []
+   for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+      # symlinks to folders are listed as folders, but must be unlinked
+      links = [name for name in dirnames if islink(join(dirpath, name))]
+      folders.append((dirpath, filenames + links))
+
+   def unlink_all(item):
+      dirpath, names = item
+      for name in names:
+         os.unlink(join(dirpath, name))
+   run_parallel(unlink_all, folders, workers)
+
+   for dirpath, _ in folders:
+      os.rmdir(dirpath)
+
+def lock_trash(trash):
+   """
+   Lock the trash folder exclusively. Waits while another process (f.ex. the
+   pruner of the previous session, which may outlive its session lock) is
+   emptying it.
+
+   @return: The open lock file. Closing it releases the lock.
+   """
+   lock_file = open(join(os.path.dirname(trash), TRASH_LOCK), "a")
+   if fcntl:
+      try:
+         fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except IOError:
+         LOG.info("The trash is being emptied by another process. Waiting.")
+         fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+   return lock_file
+
+def empty_trash(trash, workers=1):
+   """
+   Delete everything inside the trash folder.
+   """
+   lock_file = lock_trash(trash)
+   try:
+      start = time.time()
+      entries = listdir(trash)
+      deleted = 0
+      for entry in entries:
+         LOG.info("Deleting %s" % entry)
+         try:
+            remove_tree(join(trash, entry), workers)
+            deleted += 1
+         except OSError, exc:
+            LOG.error("Unable to delete %r: %s" % (join(trash, entry), exc))
+      LOG.info("Deleted %d of %d expired entries in %.1fs" % (deleted,
+         len(entries), time.time() - start))
+   finally:
+      lock_file.close()
+
 def remove_old_files(root, timedelta_params):
+   """
+   Move the folders older than the retention period into the trash and
+   start deleting them in the background.
+
+   @return: The thread deleting the files, or ``None`` if the trash is empty
+   """
    delta = timedelta(**timedelta_params)
    threshold_date = datetime.now() - delta
    LOG.info("Removing files created before %s" % threshold_date)
-   for entry in listdir(root):
-      file_meta = stat(join(root, entry))
-      mtime = datetime.fromtimestamp(file_meta[stat_info.ST_MTIME])
-      LOG.debug("Inspecting %s (mtime=%s, threshold=%s, todelete=%s)" % (
-         entry, mtime, threshold_date, mtime<threshold_date ))
-      if mtime < threshold_date:
-         LOG.info("Deleting %s" % entry)
-         rmtree(join(root, entry))
-   else:
-      LOG.info("All obsolete files successfully removed.")
+
+   trash = join(root, TRASH_FOLDER)
+   if not exists(trash):
+      os.makedirs(trash)
+
+   catalog = load_catalog(root)
+   for entry, created in sorted(catalog.items()):
+      created = datetime.strptime(created, DATE_FORMAT)
+      LOG.debug("Inspecting %s (created=%s, threshold=%s, todelete=%s)" % (
+         entry, created, threshold_date, created<threshold_date ))
+      if created < threshold_date:
+         LOG.info("Moving %s to the trash" % entry)
+         os.rename(join(root, entry), join(trash, "%s-%s" % (entry,
+            datetime.now().strftime("%Y%m%d%H%M%S"))))
+         del catalog[entry]
+   save_catalog(root, catalog)
+
+   if not listdir(trash):
+      return None
+
+   # Not a daemon thread: the process waits for it before exiting.
+   pruner = threading.Thread(target=empty_trash,
+         args=(trash, CONFIG.get('prune_workers', 4)),
+         name="%s-prune" % TARGET.get('name', 'dailyfolder'))
+   pruner.start()
+   return pruner
+
+def store(staging_area, target):
+   """
+   Put the content of the staging area into ``target``.
+
+   The staging area is moved if this is the last target (the core deletes the
+   staging area afterwards anyway) and both are on the same filesystem.
+   Otherwise it is copied.
+
+   @return: ``True`` if the staging area was moved, ``False`` if it was copied
+   """
+   start = time.time()
+   same_device = (os.stat(staging_area).st_dev ==
+         os.stat(CONFIG['path']).st_dev)
+   if TARGET.get('last_consumer') and same_device:
+      LOG.info("Moving %r to %r" % (staging_area, target))
+      os.rename(staging_area, target)
+      return True
+
+   LOG.info("Copying %r to %r" % (staging_area, target))
+   methods = copy_tree(staging_area, target, CONFIG.get('copy_workers', 4))
+   LOG.info("Copied %s in %.1fs" % (", ".join("%d files using %s" % (count,
+      method) for method, count in sorted(methods.items())) or "no files",
+      time.time() - start))
+   return False
+
+def verify(target, mode):
+   """
+   Check the files in ``target`` against the manifest of the session.
+
+   @param mode: ``"size"`` or ``"hash"``
+   """
+   session_manifest = manifest.load(target)
+   if not session_manifest:
+      LOG.warning("No manifest found in %r. Unable to verify." % target)
+      return
+
+   def check(path, entry):
+      filename = join(target, *path.split("/"))
+      if not exists(filename):
+         raise IOError("file is missing")
+      digest = None
+      if mode == "hash":
+         digest = manifest.hash_file(filename, session_manifest['algorithm'])
+      return os.path.getsize(filename), digest
+
+   manifest.verify(session_manifest, check, TARGET.get('name', __name__))
 
 def run(staging_area):
    if not exists(CONFIG['path']):
       os.makedirs(CONFIG['path'])
       LOG.info("Path '%s' created." % CONFIG['path'])
 
-   # delete old files
+   # delete old files (in the background)
    timedelta_params = CONFIG.get('retention', None)
    if timedelta_params:
       remove_old_files(CONFIG['path'], timedelta_params)
 
    # store new files
-   copytree(staging_area, folder())
+   target = folder()
+   moved = store(staging_area, target)
+   if not moved and CONFIG.get('verify', 'size'):
+      verify(target, CONFIG.get('verify', 'size'))
+
+   catalog = load_catalog(CONFIG['path'])
+   catalog[os.path.basename(target)] = datetime.now().strftime(DATE_FORMAT)
+   save_catalog(CONFIG['path'], catalog)
 
@@ -3,6 +3,34 @@ Uploads the staging folder to an FTP host. On the remote host a new subfolder
 with the current date will be created (f.ex.: '2010-11-01'). The staging area
 will be stored in that folder.
 
+Files are uploaded by several FTP sessions in parallel (see ``connections``),
+largest files first. The folder structure is created before the upload
+starts.
+
+Expired date folders (see ``retention``) are deleted using as few listing
+commands as possible: one ``MLSD`` per folder (run in parallel over several
+sessions), or a single ``LIST -R`` if the server does not support ``MLSD``.
+The files are then deleted in parallel, followed by the folders, deepest
+first.
+
+With ``pack_threshold`` set, files smaller than the threshold are packed into
+a few tar containers before the upload (see `pickup.lib.packing`). Sessions
+with thousands of small files then need only a handful of transfers. To
+restore the original layout, run ``python -m pickup.lib.packing <folder>`` on
+the downloaded date folder.
+
+To save round trips on the control connection, the plugin keeps a model of
+the remote folders it has seen. Each folder is listed at most once (using
+``MLSD`` if the server supports it) and created at most once, and all
+commands use absolute paths instead of changing the working directory.
+
+Uploads are resumable. The progress is kept in a state file (see
+``state_folder``). If a session is interrupted, the next session with the
+same date folder skips files which were completely uploaded (checking them
+with ``SIZE`` and ``MDTM``) and continues partial files where they stopped
+(using ``REST`` or ``APPE``). Failed uploads are retried with an increasing
+delay, on a new connection.
+
 Configuration
 ~~~~~~~~~~~~~
 
@@ -34,6 +62,37 @@ The following fields are used by this plugin:
                 folders that have a name not expected by this script, will
                 issue a warning.
 
+   **connections** (int) *optional*
+      .. versionadded:: 1.5
+
+      The number of FTP sessions uploading files at the same time. Default: 4
+
+   **pack_threshold** (int) *optional*
+      .. versionadded:: 1.5
+
+      Files smaller than this many bytes are packed into containers before
+      the upload. Default: ``None`` (no packing)
+
+   **retries** (int) *optional*
+      .. versionadded:: 1.5
+
+      How often a failed upload is retried. Default: 3
+
+   **state_folder** (string) *optional* (default="~/.pickup/state")
+      .. versionadded:: 1.5
+
+      The local folder keeping the upload state between sessions.
+
+   **verify** (string) *optional*
+      .. versionadded:: 1.5
+
+      How the uploaded files are checked against the manifest of the session:
+      ``"size"`` compares the sizes reported by the server (``SIZE``).
+      ``"hash"`` additionally asks the server for the hash of each file
+      (``HASH`` command), if the server supports it and the session uses
+      ``sha256``, ``sha512``, ``sha1`` or ``md5``. ``None`` disables the
+      check. Default: ``"size"``
+
    **dry_run** (boolean) *optional*
       If set to ``True`` no files will be uploaded or deleted. Instead, the
       operations will only be reported to stdout.
@@ -67,17 +126,58 @@ from datetime import datetime, timedelta
 import logging
 import os
 import os.path
-from ftplib import FTP, error_perm
+import posixpath
+import shutil
+import tempfile
+import threading
+import time
+from ftplib import FTP, error_perm, error_temp, error_reply, all_errors
+
+from pickup.lib import manifest, state
+from pickup.lib.packing import pack_files
+from pickup.lib.ftppool import FTPPool
+from pickup.lib.workers import run_parallel
 
 LOG = logging.getLogger(__name__)
 API_VERSION = (2,0)
 CONFIG = {}
+TARGET = {}
 FOLDER_FORMAT = "%Y-%m-%d"
 
+#: The number of bytes sent per write on the data connection
+BLOCK_SIZE = 256 * 1024
+
+#: The upload state is written after this many changes...
+STATE_SAVE_COUNT = 200
+
+#: ... or after this many seconds, whichever comes first
+STATE_SAVE_INTERVAL = 5
+
+#: Names of the hash algorithms in the FTP ``HASH`` command
+HASH_NAMES = {
+      'sha256': 'SHA-256',
+      'sha512': 'SHA-512',
+      'sha1': 'SHA-1',
+      'md5': 'MD5',
+      }
+
 def init(target):
    CONFIG.update(target['config'])
+   TARGET.update(target)
    LOG.debug("Initialised '%s' with %r" % ( __name__, CONFIG))
 
+def connect():
+   """
+   Open a new FTP session in binary mode (required by ``SIZE`` on most
+   servers).
+   """
+   conn = FTP(CONFIG['host'],
+         user=CONFIG['username'],
+         passwd=CONFIG['password']
+         )
+   conn.voidcmd("TYPE I")
+   return conn
+
 def try_mkd( conn, foldername ):
    try:
       conn.mkd(foldername)
@@ -90,31 +190,537 @@ def try_mkd( conn, foldername ):
 def folder():
    return
 
-def rmrf(conn, path):
-   LOG.debug('Recursively deleting %s' % path)
-   conn.cwd(path)
-   for entry in conn.nlst():
-      if entry in (".", ".."):
+def supports_mlsd(conn):
+   """
+   Returns ``True`` if the server announces ``MLST``/``MLSD`` (RFC 3659).
+   """
+   try:
+      features = conn.sendcmd("FEAT")
+   except (error_perm, error_temp, error_reply):
+      return False
+   return "MLST" in features.upper()
+
+def parse_mlsd_line(line):
+   """
+   Split a line of a ``MLSD`` listing into the name and a dictionary of
+   facts (with lower-case keys).
+   """
+   facts, _, name = line.partition(" ")
+   entry = {}
+   for fact in facts.rstrip(";").split(";"):
+      if "=" in fact:
+         key, value = fact.split("=", 1)
+         entry[key.lower()] = value
+   return name, entry
+
+def mlsd(conn, path):
+   """
+   List a remote folder using ``MLSD``. ``ftplib`` in Python 2 has no
+   support for it, so the listing is parsed here.
+
+   @return: A dictionary mapping names to their facts (f.ex. ``type``,
+            ``size``)
+   """
+   lines = []
+   conn.retrlines("MLSD %s" % path, lines.append)
+   output = {}
+   for line in lines:
+      name, facts = parse_mlsd_line(line)
+      if name in (".", "..") or facts.get('type', '').lower() in (
+            'cdir', 'pdir'):
          continue
+      output[name] = facts
+   return output
+
+def parse_list_line(line):
+   """
+   Parse a line of a Unix style ``LIST`` output.
+
+   @return: A tuple (name, kind) with kind being ``"dir"``, ``"link"`` or
+            ``"file"``, or ``None`` if the line is not an entry
+   """
+   parts = line.split(None, 8)
+   if len(parts) < 9 or line[0] not in "-dlbcps":
+      return None
+   kind = {'d': 'dir', 'l': 'link'}.get(line[0], 'file')
+   name = parts[8]
+   if kind == 'link' and " -> " in name:
+      name = name.split(" -> ", 1)[0]
+   if name in (".", ".."):
+      return None
+   return name, kind
+
+def list_folder(conn, path, use_mlsd):
+   """
+   List one remote folder.
+
+   @return: A list of (name, is_folder) tuples
+   """
+   if use_mlsd:
+      return [(name, facts.get('type', '').lower() == 'dir')
+            for name, facts in mlsd(conn, path).items()]
+   lines = []
+   conn.retrlines("LIST %s" % path, lines.append)
+   entries = [parse_list_line(line) for line in lines]
+   return [(name, kind == 'dir') for name, kind in filter(None, entries)]
+
+def list_recursive(conn, root):
+   """
+   List a remote tree with a single ``LIST -R``.
+
+   @return: A tuple (files, folders) of absolute paths, or ``None`` if the
+            server did not return a recursive listing
+   """
+   lines = []
+   try:
+      conn.retrlines("LIST -R %s" % root, lines.append)
+   except (error_perm, error_temp), exc:
+      LOG.debug("LIST -R failed: %s" % exc)
+      return None
+   home = conn.pwd()
+   files, folders, listed = [], [], set([root])
+   current = root
+   for line in lines:
+      if not line.strip():
+         continue
+      if line.endswith(":") and parse_list_line(line) is None:
+         header = line[:-1]
+         current = posixpath.normpath(posixpath.join(home, header))
+         listed.add(current)
+         continue
+      entry = parse_list_line(line)
+      if entry is None:
+         continue
+      name, kind = entry
+      if kind == 'dir':
+         folders.append(posixpath.join(current, name))
+      else:
+         files.append(posixpath.join(current, name))
+
+   # Servers ignoring "-R" only return the top level
+   if set(folders) - listed:
+      return None
+   return files, folders
+
+def list_tree(pool, root, use_mlsd, workers):
+   """
+   Collect all files and folders below ``root``.
+
+   Without ``MLSD``, a single ``LIST -R`` is tried first. Otherwise the tree
+   is listed level by level, with the folders of one level listed in
+   parallel.
+
+   A folder which cannot be listed stays in the list of folders. If it is a
+   link to a folder, `remove_folder` deletes it. Otherwise removing it fails
+   and is reported, but its content is never assumed to be gone.
+
+   @return: A tuple (files, folders) of absolute paths
+   """
+   if not use_mlsd:
+      result = list_recursive(pool.get(), root)
+      if result is not None:
+         return result
+      LOG.debug("LIST -R not supported. Listing each folder.")
+
+   def list_path(path):
+      try:
+         return list_folder(pool.get(), path, use_mlsd)
+      except (error_temp, EOFError, IOError), exc:
+         # transient: try once more on a new session
+         LOG.debug("Listing %r failed (%s). Retrying." % (path, exc))
+         pool.discard()
+         return list_folder(pool.get(), path, use_mlsd)
+
+   files, folders = [], []
+   level = [root]
+   while level:
+      results = run_parallel(list_path, level, workers)
+      level = []
+      for path, entries, exc in results:
+         if exc:
+            LOG.warning("Unable to list %r: %s" % (path, exc))
+            continue
+         for name, is_folder in entries:
+            if is_folder:
+               level.append(posixpath.join(path, name))
+            else:
+               files.append(posixpath.join(path, name))
+      folders.extend(level)
+   return files, folders
+
+def remove_folder(conn, path):
+   """
+   Remove an empty remote folder. Some servers report links to folders as
+   folders, so ``DELE`` is tried if ``RMD`` fails.
+   """
+   try:
+      conn.rmd(path)
+   except error_perm:
+      try:
+         conn.delete(path)
+      except error_perm:
+         pass
+      else:
+         return
+      raise
+
+def delete_trees(roots, use_mlsd):
+   """
+   Delete remote folders recursively. All files are deleted in parallel
+   first, then the folders, deepest first.
+
+   @param roots: Absolute paths of the folders to delete
+   @return: The paths which could not be deleted
+   """
+   workers = CONFIG.get('connections', 4)
+   pool = FTPPool(connect)
+   try:
+      files, folders = [], list(roots)
+      for root in roots:
+         start = time.time()
+         tree_files, tree_folders = list_tree(pool, root, use_mlsd, workers)
+         LOG.debug("Listed %d files and %d folders in %r in %.1fs" % (
+            len(tree_files), len(tree_folders), root, time.time() - start))
+         files.extend(tree_files)
+         folders.extend(tree_folders)
+
+      start = time.time()
+      results = run_parallel(lambda path: pool.get().delete(path), files,
+            workers)
+      failed = [path for path, _, exc in results if exc]
+
+      # Folders of the same depth are independent of each other
+      by_depth = {}
+      for path in folders:
+         by_depth.setdefault(path.count("/"), []).append(path)
+      for depth in sorted(by_depth, reverse=True):
+         results = run_parallel(lambda path: remove_folder(pool.get(), path),
+               by_depth[depth], workers)
+         failed.extend(path for path, _, exc in results if exc)
+   finally:
+      pool.close_all()
+
+   LOG.info("Deleted %d of %d entries in %.1fs" % (
+      len(files) + len(folders) - len(failed), len(files) + len(folders),
+      time.time() - start))
+   if failed:
+      LOG.error("Unable to delete %d entries" % len(failed))
+   return failed
+
+class RemoteTree(object):
+   """
+   A model of the remote folders, built from the listings done in this
+   session. It is used to create each missing folder exactly once, without
+   probing existing ones.
+   """
+
+   def __init__(self, conn, root):
+      """
+      @param root: An absolute path known to exist (f.ex. the initial working
+                   folder). It and its parents are never listed or created,
+                   as they may not be readable (f.ex. ``/home``).
+      """
+      self.conn = conn
+      self.use_mlsd = supports_mlsd(conn)
+      self._listings = {}
+      self._existing = set()
+      while True:
+         self._existing.add(root)
+         if root in ("/", ""):
+            break
+         root = posixpath.dirname(root)
+      self._lock = threading.Lock()
+      LOG.debug("MLSD supported: %s" % self.use_mlsd)
+
+   def list(self, path):
+      """
+      Returns the entries of a remote folder as dictionary mapping names to
+      facts. With ``NLST``, the facts are empty.
+      """
+      with self._lock:
+         if path not in self._listings:
+            if self.use_mlsd:
+               listing = mlsd(self.conn, path)
+            else:
+               listing = dict((posixpath.basename(name), {})
+                     for name in self.conn.nlst(path)
+                     if posixpath.basename(name) not in (".", ".."))
+            self._listings[path] = listing
+         return self._listings[path]
+
+   def makedirs(self, path):
+      """
+      Create a remote folder and all missing parents.
+      """
+      parts = [part for part in path.split("/") if part]
+      current = path.startswith("/") and "/" or ""
+      for part in parts:
+         parent, current = current, posixpath.join(current, part)
+         with self._lock:
+            if current in self._existing:
+               continue
+         try:
+            listed = True
+            exists = part in self.list(parent or ".")
+         except (error_perm, error_temp), exc:
+            LOG.debug("Unable to list %r (%s)" % (parent, exc))
+            listed = exists = False
+         if not exists:
+            try:
+               try_mkd(self.conn, current)
+            except error_perm:
+               # Without a listing, the folder may exist without being
+               # visible (f.ex. a parent with mode 0711).
+               if listed or not self.is_folder(current):
+                  raise
+            else:
+               with self._lock:
+                  self._listings.setdefault(parent or ".", {})[part] = dict(
+                        type="dir")
+                  # a new folder is empty, so it never needs to be listed
+                  self._listings[current] = {}
+         with self._lock:
+            self._existing.add(current)
+
+   def is_folder(self, path):
+      """
+      Returns ``True`` if ``path`` is a folder the session can change into.
+      """
+      try:
+         self.conn.cwd(path)
+      except error_perm:
+         return False
+      return True
+
+   def forget(self, path):
+      """
+      Drop the cached listings of ``path`` and everything below it (f.ex.
+      after deleting entries).
+      """
+      prefix = path.rstrip("/") + "/"
+      with self._lock:
+         for known in self._listings.keys():
+            if known == path or known.startswith(prefix):
+               del self._listings[known]
+         self._existing = set(known for known in self._existing
+               if not known.startswith(prefix))
+
+def remote_size(conn, filename):
+   """
+   Returns the size of a remote file, or ``None`` if the server does not
+   support the ``SIZE`` command.
+   """
+   try:
+      return conn.size(filename)
+   except (error_perm, error_temp, error_reply), exc:
+      LOG.debug("Unable to get the size of %r: %s" % (filename, exc))
+      return None
+
+def remote_hash(conn, filename, algorithm):
+   """
+   Ask the server for the hash of a file using the ``HASH`` command. Returns
+   ``None`` if the server (or the algorithm) is not supported.
+   """
+   if algorithm not in HASH_NAMES:
+      return None
+   try:
+      conn.sendcmd("OPTS HASH %s" % HASH_NAMES[algorithm])
+      response = conn.sendcmd("HASH %s" % filename)
+   except (error_perm, error_temp, error_reply), exc:
+      LOG.debug("Unable to get the hash of %r: %s" % (filename, exc))
+      return None
+   # f.ex.: 213 SHA-256 0-49 <hash> <filename>
+   parts = response.split(None, 4)
+   if len(parts) < 4:
+      return None
+   return parts[3].lower()
+
+def remote_mtime(conn, filename):
+   """
+   Returns the modification time of a remote file as reported by ``MDTM``
+   (f.ex. ``"20101101123000"``), or ``None`` if not supported.
+   """
+   try:
+      return conn.sendcmd("MDTM %s" % filename).split()[-1]
+   except (error_perm, error_temp, error_reply), exc:
+      LOG.debug("Unable to get the mtime of %r: %s" % (filename, exc))
+      return None
 
+class UploadState(object):
+   """
+   Remembers which files were (partially) uploaded into a date folder, so an
+   interrupted upload can be continued by a later session writing into the
+   same date folder (i.e. a re-run on the same day). The state is reset when
+   the date folder changes, as the next night uploads a new staging area
+   into a new folder.
+
+   Entries are keyed by the remote path. Each entry contains the size and
+   hash of the local file, whether the upload completed and the ``MDTM`` of
+   the remote file after the upload.
+
+   Changes are written to disk every `STATE_SAVE_COUNT` updates or
+   `STATE_SAVE_INTERVAL` seconds, and by `flush`. Losing the latest changes
+   is harmless: the affected files are uploaded (or resumed) again.
+   """
+
+   def __init__(self, filename, backup_root):
+      self.filename = filename
+      self._lock = threading.Lock()
+      self._changes = 0
+      self._saved = time.time()
+      data = state.load(filename, {})
+      if data.get('root') != backup_root:
+         data = dict(root=backup_root, files={})
+      self.data = data
+
+   def get(self, path):
+      with self._lock:
+         return self.data['files'].get(path)
+
+   def update(self, path, **values):
+      with self._lock:
+         self.data['files'].setdefault(path, {}).update(values)
+         self._changes += 1
+         if self._changes >= STATE_SAVE_COUNT or \
+               time.time() - self._saved >= STATE_SAVE_INTERVAL:
+            self._save()
+
+   def flush(self):
+      """
+      Write pending changes to disk.
+      """
+      with self._lock:
+         if self._changes:
+            self._save()
+
+   def _save(self):
+      state.save(self.filename, self.data)
+      self._changes = 0
+      self._saved = time.time()
+
+class Uploader(object):
+   """
+   Uploads files from the staging area into the date folder using a pool of
+   FTP sessions.
+   """
+
+   def __init__(self, pool, staging_area, backup_root, session_manifest,
+         upload_state, hashes=None):
+      """
+      @param hashes: Hashes of files which are not in the manifest (f.ex.
+                     containers of packed files), keyed by relative path
+      """
+      self.pool = pool
+      self.staging_area = staging_area
+      self.backup_root = backup_root
+      self.manifest = session_manifest
+      self.state = upload_state
+      self.verify = session_manifest and CONFIG.get('verify', 'size') or None
+      self.hashes = hashes or {}
+
+   def get_hash(self, path):
+      if not self.manifest or path not in self.manifest['files']:
+         return self.hashes.get(path)
+      return self.manifest['files'][path]['hash']
+
+   def store(self, conn, filename, fptr, offset):
+      """
+      Send a file, starting at ``offset``. Resuming uses ``REST`` and falls
+      back to ``APPE`` if the server does not support it.
+      """
+      if not offset:
+         conn.storbinary("STOR %s" % filename, fptr, BLOCK_SIZE)
+         return
+      fptr.seek(offset)
       try:
-         conn.delete(entry)
+         conn.storbinary("STOR %s" % filename, fptr, BLOCK_SIZE, rest=offset)
       except error_perm, exc:
-         # Permission Denied (most likely a directory)
+         LOG.debug("REST not supported (%s). Using APPE." % exc)
+         fptr.seek(offset)
+         conn.storbinary("APPE %s" % filename, fptr, BLOCK_SIZE)
+
+   def send(self, item):
+      """
+      Upload (or resume, or skip) one file.
+      """
+      folder, filename, size, local_name = item
+      path = remote_path(folder, filename)
+      conn = self.pool.get()
+      key = remote_path(self.backup_root, path)
+      identity = dict(size=size, hash=self.get_hash(path))
+
+      # Without a hash, there is no way to tell whether the remote file has
+      # the same content. Such files are always uploaded again.
+      offset = 0
+      entry = self.state.get(key)
+      if entry and identity['hash'] and entry.get('size') == size and \
+            entry.get('hash') == identity['hash']:
+         current = remote_size(conn, key)
+         if entry.get('done'):
+            if current == size and remote_mtime(conn, key) == \
+                  entry.get('mdtm'):
+               LOG.info("Skipping %s (already uploaded)" % path)
+               return conn
+         elif current and current <= size:
+            LOG.info("Resuming %s at %d of %d bytes" % (path, current, size))
+            offset = current
+
+      if not offset:
+         LOG.info("Uploading %s (%d bytes) to %s" % (path, size,
+            remote_path(self.backup_root, folder)))
+      self.state.update(key, done=False, **identity)
+      with open(local_name, "rb") as fptr:
+         self.store(conn, key, fptr, offset)
+      self.state.update(key, done=True, mdtm=remote_mtime(conn, key))
+      return conn
+
+   def upload(self, item):
+      """
+      Upload one file using the session of the current thread. Failures are
+      retried with an increasing delay on a new session.
+
+      @param item: A tuple (relative folder, filename, size, local filename)
+      @return: A tuple (remote size, remote hash) for the verification. Either
+               value may be ``None``.
+      """
+      folder, filename, size = item[:3]
+      if CONFIG.get("dry_run", False):
+         LOG.info("Uploading %s (%d bytes) to %s" % (remote_path(folder,
+            filename), size, remote_path(self.backup_root, folder)))
+         return None, None
+
+      retries = CONFIG.get('retries', 3)
+      attempt = 0
+      while True:
          try:
-            rmrf(conn, entry)
-         except Exception, exc2:
-            # Probably not a directory. Skip this entry
-            LOG.warning(str(exc2))
-            pass
-   conn.cwd("..")
-   conn.rmd(path)
-
-def remove_old_files(conn, timedelta_params):
+            conn = self.send(item)
+            break
+         except error_perm:
+            raise
+         except all_errors, exc:
+            attempt += 1
+            if attempt > retries:
+               raise
+            delay = min(2 ** attempt, 60)
+            LOG.warning("Upload of %s failed (%s). Retrying in %ds" % (
+               remote_path(folder, filename), exc, delay))
+            self.pool.discard()
+            time.sleep(delay)
+
+      if not self.verify:
+         return None, None
+      key = remote_path(self.backup_root, folder, filename)
+      digest = None
+      if self.verify == "hash":
+         digest = remote_hash(conn, key, self.manifest['algorithm'])
+      return remote_size(conn, key), digest
+
+def remove_old_files(tree, base, timedelta_params):
    delta = timedelta(**timedelta_params)
    threshold_date = datetime.now() - delta
    LOG.info("Removing files created before %s" % threshold_date)
-   for entry in conn.nlst():
+   expired = []
+   for entry in sorted(tree.list(base)):
       if entry in ('.', '..'):
          continue
 
@@ -124,13 +730,73 @@ def remove_old_files(conn, timedelta_params):
             entry, threshold_date, entry_date<threshold_date ))
          if entry_date < threshold_date:
             LOG.info("Deleting %s" % entry)
-            if not CONFIG.get("dry_run", False):
-               rmrf(conn, entry)
+            expired.append(posixpath.join(base, entry))
       except ValueError, e:
          LOG.warning( str(e) )
+
+   failed = []
+   if expired and not CONFIG.get("dry_run", False):
+      failed = delete_trees(expired, tree.use_mlsd)
+   if failed:
+      LOG.error("Some obsolete files could not be removed. They will be "
+            "retried by the next session.")
    else:
       LOG.info("All obsolete files successfully removed.")
 
+def list_local_files(staging_area):
+   """
+   List the folders and files of the staging area.
+
+   @return: A tuple (folders, files). Folders are relative paths (using
+            ``/``) in creation order. Files are tuples (relative folder,
+            filename, size, local filename), largest first.
+   """
+   folders = []
+   files = []
+   for root, dirs, filenames in os.walk(staging_area):
+      folder = os.path.relpath(root, staging_area).replace(os.sep, "/")
+      if folder == ".":
+         folder = ""
+      else:
+         folders.append(folder)
+      for filename in filenames:
+         local_name = os.path.join(root, filename)
+         files.append((folder, filename, os.path.getsize(local_name),
+            local_name))
+   files.sort(key=lambda item: item[2], reverse=True)
+   return folders, files
+
+def remote_path(*parts):
+   return "/".join(part for part in parts if part)
+
+def pack_small_files(staging_area, files, threshold, target_folder):
+   """
+   Replace the small files in a list of upload items by containers.
+
+   @param files: The upload items (see `list_local_files`)
+   @return: A tuple (items, packs, hashes) with the new upload items, the
+            containers (see `pickup.lib.packing.pack_files`) and the hashes of
+            the container files
+   """
+   small = [item for item in files if item[2] < threshold and
+         remote_path(item[0], item[1]) != manifest.MANIFEST_FILE]
+   if len(small) < 2:
+      return files, [], {}
+
+   packs = pack_files(staging_area, [remote_path(item[0], item[1])
+      for item in small], target_folder)
+   items = [item for item in files if item not in small]
+   hashes = {}
+   for pack in packs:
+      for filename in (pack['filename'], pack['index']):
+         name = os.path.basename(filename)
+         items.append(("", name, os.path.getsize(filename), filename))
+      hashes[os.path.basename(pack['filename'])] = pack['hash']
+      hashes[os.path.basename(pack['index'])] = manifest.hash_file(
+            pack['index'])
+   items.sort(key=lambda item: item[2], reverse=True)
+   return items, packs, hashes
+
 def run_ftp(staging_area):
    """
    Run the ftp profile
@@ -139,51 +805,79 @@ def run_ftp(staging_area):
    restoration easier to read in the "run" method.
    """
    os.chdir(staging_area)
+   staging_area = os.getcwd()
    current_date_folder = datetime.now().strftime(FOLDER_FORMAT)
 
-   ftp = FTP(CONFIG['host'],
-         user=CONFIG['username'],
-         passwd=CONFIG['password']
-         )
+   ftp = connect()
+   home = ftp.pwd()
+   tree = RemoteTree(ftp, home)
 
-   if CONFIG.get('remote_folder', None):
-      try_mkd( ftp, CONFIG['remote_folder'] )
-      ftp.cwd(CONFIG['remote_folder'])
+   base = posixpath.normpath(posixpath.join(home,
+      CONFIG.get('remote_folder', None) or ""))
+   tree.makedirs(base)
 
    # delete old files
    timedelta_params = CONFIG.get('retention', None)
    if timedelta_params:
-      remove_old_files(ftp, timedelta_params)
+      remove_old_files(tree, base, timedelta_params)
+      tree.forget(base)
 
-   try_mkd( ftp, current_date_folder )
-   ftp.cwd( current_date_folder )
-
-   backup_root = ftp.pwd()
+   backup_root = posixpath.join(base, current_date_folder)
+   tree.makedirs(backup_root)
    LOG.info("Current FTP folder: %r" % backup_root)
 
-   for root, dirs, files in os.walk("."):
-      ftp.cwd(backup_root)
+   session_manifest = manifest.load(staging_area)
+   state_file = os.path.join(state.get_folder(CONFIG, 'ftp'), "%s.json" % (
+      state.clean_name(TARGET.get('name', CONFIG['host']))))
+   upload_state = UploadState(state_file, backup_root)
+
+   folders, files = list_local_files(staging_area)
+   packs, hashes = [], {}
+   pack_folder = None
+   if CONFIG.get('pack_threshold'):
+      pack_folder = tempfile.mkdtemp(prefix="pickup-pack-")
+      files, packs, hashes = pack_small_files(staging_area, files,
+            CONFIG['pack_threshold'], pack_folder)
+      folders = sorted(set(item[0] for item in files if item[0]))
+
+   # The folders are created up front, so the upload sessions never race to
+   # create the same folder.
+   for folder in folders:
+      tree.makedirs(remote_path(backup_root, folder))
+   ftp.quit()
 
-      if root == '.':
+   pool = FTPPool(connect)
+   uploader = Uploader(pool, staging_area, backup_root, session_manifest,
+         upload_state, hashes)
+   try:
+      results = run_parallel(uploader.upload, files,
+            CONFIG.get('connections', 4))
+   finally:
+      upload_state.flush()
+      pool.close_all()
+      if pack_folder:
+         shutil.rmtree(pack_folder)
+
+   uploaded = {}
+   for item, result, exc in results:
+      if not exc:
+         uploaded[remote_path(item[0], item[1])] = result
+
+   # Packed files are verified through their container
+   for pack in packs:
+      result = uploaded.get(os.path.basename(pack['filename']))
+      if not session_manifest or not result or \
+            result[0] not in (None, pack['size']):
          continue
-
-      # create required folder structure
-      for node in os.path.split(root):
-         if node == '.':
-            continue
-
-         try_mkd(ftp, node)
-         ftp.cwd(node)
-
-      # upload files
-      for filename in files:
-         LOG.info( "Uploading %s to %s" % (
-            filename, ftp.pwd()))
-         if not CONFIG.get("dry_run", False):
-            ftp.storbinary( "STOR %s" % filename,
-                  open(os.path.join(root,filename), "rb") )
-
-   ftp.quit()
+      for path in pack['members']:
+         uploaded[path] = (session_manifest['files'][path]['size'], None)
+
+   if uploader.verify and not CONFIG.get("dry_run", False):
+      def check(path, entry):
+         if path not in uploaded:
+            raise IOError("file was not uploaded")
+         return uploaded[path]
+      manifest.verify(session_manifest, check, CONFIG['host'])
 
 def run(staging_area):
    workdir_bak = os.getcwd()
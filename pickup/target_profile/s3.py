@@ -0,0 +1,329 @@
+"""
+Uploads the staging folder to an S3 compatible object storage (Amazon S3,
+MinIO, Ceph, ...). Like the ftp target, the objects are stored below a prefix
+with the current date (f.ex.: 'backups/2010-11-01/').
+
+Large files are sent as multipart uploads. The parts of all files are uploaded
+at the same time by a shared pool of ``concurrency`` threads, each part being
+read from disk when it is sent. Files are never loaded into memory as a whole.
+
+This plugin requires the python package ``boto3``.
+
+Configuration
+~~~~~~~~~~~~~
+
+The following fields are used by this plugin:
+
+   **bucket** (string)
+      The name of the bucket. It must exist.
+
+   **prefix** (string) *optional*
+      If specified, the backups will be stored below this prefix (f.ex.
+      ``"pickup"``). If not specified, the date prefixes are created at the
+      top of the bucket.
+
+   **endpoint_url** (string) *optional*
+      The URL of the storage service (f.ex.:
+      ``"https://minio.example.com:9000"``). If not specified, Amazon S3 is
+      used.
+
+   **region_name** (string) *optional*
+      The region of the bucket.
+
+   **aws_access_key_id** (string) *optional*
+
+   **aws_secret_access_key** (string) *optional*
+      The credentials. If not specified, boto3 looks them up in the usual
+      places (environment variables, ``~/.aws/credentials``, ...).
+
+   **retention** (dict) *optional*
+      How long the data should be kept. Everything older than this will be
+      deleted. The dictionary values will be passed as keyword arguments to
+      `datetime.timedelta
+      <http://docs.python.org/library/datetime.html#datetime.timedelta>`_. If
+      set to ``None``, the data will be kept indefinitely!
+
+      **Default:** ``None``
+
+      .. note:: This script uses the prefix name to determine the date! All
+                prefixes that have a name not expected by this script, will
+                issue a warning.
+
+   **part_size** (int) *optional*
+      The size (in bytes) of the parts of multipart uploads. Files larger
+      than this are uploaded in parts. S3 requires at least 5 MiB and allows
+      at most 10000 parts per file. Default: 64 MiB
+
+   **concurrency** (int) *optional*
+      The number of parts (or small files) uploaded at the same time.
+      Default: 10
+
+   **verify** (string) *optional*
+      ``"size"`` compares the size of each uploaded object with the manifest
+      of the session. ``None`` disables the check. Default: ``"size"``
+
+   **dry_run** (boolean) *optional*
+      If set to ``True`` no objects will be uploaded or deleted. Instead, the
+      operations will only be reported.
+
+Configuration Example
+~~~~~~~~~~~~~~~~~~~~~
+
+.. code-block:: python
+
+   dict(
+      name = "object storage",
+      profile = "s3",
+      config = dict(
+         endpoint_url = "https://minio.example.com:9000",
+         bucket = "backups",
+         prefix = "pickup",
+         aws_access_key_id = "backup",
+         aws_secret_access_key = "secret",
+         part_size = 128 * 1024 * 1024,
+         concurrency = 32,
+         retention = dict(
+               weeks=4
+            ),
+         )
+      ),
+
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+import posixpath
+import time
+
+import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+
+from pickup.lib import manifest
+from pickup.lib.pipeline import throughput
+from pickup.lib.workers import run_parallel
+
+LOG = logging.getLogger(__name__)
+API_VERSION = (2,0)
+CONFIG = {}
+TARGET = {}
+FOLDER_FORMAT = "%Y-%m-%d"
+
+#: The default size of the parts of multipart uploads
+PART_SIZE = 64 * 1024 * 1024
+
+#: The default number of parts uploaded at the same time
+CONCURRENCY = 10
+
+#: The maximum number of keys accepted by one DeleteObjects request
+DELETE_BATCH = 1000
+
+def init(target):
+   CONFIG.update(target['config'])
+   TARGET.update(target)
+   LOG.debug("Initialised '%s' with %r" % ( __name__, CONFIG))
+
+def folder():
+   return
+
+def connect():
+   """
+   Returns a new S3 client. The HTTP connection pool is large enough for all
+   upload threads.
+   """
+   return boto3.client("s3",
+         endpoint_url = CONFIG.get('endpoint_url', None),
+         region_name = CONFIG.get('region_name', None),
+         aws_access_key_id = CONFIG.get('aws_access_key_id', None),
+         aws_secret_access_key = CONFIG.get('aws_secret_access_key', None),
+         config = Config(max_pool_connections=CONFIG.get('concurrency',
+            CONCURRENCY)))
+
+def get_key(*parts):
+   """
+   Join the parts of an object key, ignoring empty parts and slashes at the
+   ends.
+   """
+   return "/".join(part.strip("/") for part in parts if part and
+         part.strip("/"))
+
+def list_local_files(staging_area):
+   """
+   List the files of the staging area.
+
+   @return: A list of tuples (relative path, size, local filename). Relative
+            paths use ``/``.
+   """
+   files = []
+   for root, _, filenames in os.walk(staging_area):
+      folder = os.path.relpath(root, staging_area).replace(os.sep, "/")
+      for filename in filenames:
+         local_name = os.path.join(root, filename)
+         path = posixpath.normpath(posixpath.join(folder, filename))
+         files.append((path, os.path.getsize(local_name), local_name))
+   return files
+
+def list_objects(client, prefix):
+   """
+   List all objects below a prefix.
+
+   @return: A dictionary mapping keys to their size
+   """
+   objects = {}
+   paginator = client.get_paginator("list_objects_v2")
+   for page in paginator.paginate(Bucket=CONFIG['bucket'], Prefix=prefix):
+      for entry in page.get('Contents', []):
+         objects[entry['Key']] = entry['Size']
+   return objects
+
+def list_prefixes(client, prefix):
+   """
+   List the names of the "folders" directly below a prefix.
+   """
+   names = []
+   paginator = client.get_paginator("list_objects_v2")
+   for page in paginator.paginate(Bucket=CONFIG['bucket'], Prefix=prefix,
+         Delimiter="/"):
+      for entry in page.get('CommonPrefixes', []):
+         names.append(entry['Prefix'][len(prefix):].strip("/"))
+   return sorted(names)
+
+def upload(client, staging_area, backup_prefix):
+   """
+   Upload the staging area below ``backup_prefix``.
+
+   @return: A list of the relative paths which could not be uploaded
+   """
+   part_size = CONFIG.get('part_size', PART_SIZE)
+   concurrency = CONFIG.get('concurrency', CONCURRENCY)
+   transfer_config = TransferConfig(
+         multipart_threshold = part_size,
+         multipart_chunksize = part_size,
+         max_concurrency = concurrency,
+         use_threads = True)
+
+   # Big files first, to keep all threads busy until the end
+   files = sorted(list_local_files(staging_area), key=lambda item: item[1],
+         reverse=True)
+   total = sum(size for _, size, _ in files)
+   LOG.info("Uploading %d files (%d bytes) using %d threads" % (len(files),
+      total, concurrency))
+
+   start = time.time()
+   failed = []
+   manager = create_transfer_manager(client, transfer_config)
+   try:
+      futures = []
+      for path, size, local_name in files:
+         key = get_key(backup_prefix, path)
+         LOG.debug("Uploading %s (%d bytes)" % (key, size))
+         futures.append((path, manager.upload(local_name, CONFIG['bucket'],
+            key)))
+      for path, future in futures:
+         try:
+            future.result()
+         except Exception, exc:
+            LOG.error("Unable to upload %s: %s" % (path, exc))
+            failed.append(path)
+   finally:
+      manager.shutdown()
+
+   elapsed = time.time() - start
+   LOG.info("Uploaded %d bytes in %.1fs (%s)" % (total, elapsed,
+      throughput(total, elapsed)))
+   return failed
+
+def delete_prefixes(client, prefixes):
+   """
+   Delete all objects below the given prefixes. The keys are deleted in
+   batches, several batches at the same time.
+
+   @return: The keys which could not be deleted
+   """
+   keys = []
+   for prefix in prefixes:
+      keys.extend(sorted(list_objects(client, prefix)))
+   batches = [keys[i:i + DELETE_BATCH] for i in range(0, len(keys),
+      DELETE_BATCH)]
+
+   def delete(batch):
+      response = client.delete_objects(Bucket=CONFIG['bucket'], Delete=dict(
+         Objects=[dict(Key=key) for key in batch], Quiet=True))
+      return response.get('Errors', [])
+
+   start = time.time()
+   errors = []
+   for batch, result, exc in run_parallel(delete, batches,
+         CONFIG.get('concurrency', CONCURRENCY)):
+      if exc:
+         errors.extend((key, str(exc)) for key in batch)
+      else:
+         errors.extend((error['Key'], error.get('Message', ''))
+               for error in result)
+
+   LOG.info("Deleted %d objects in %.1fs" % (len(keys) - len(errors),
+      time.time() - start))
+   for key, message in errors:
+      LOG.error("Unable to delete %r: %s" % (key, message))
+   return [key for key, _ in errors]
+
+def remove_old_files(client, base, timedelta_params):
+   delta = timedelta(**timedelta_params)
+   threshold_date = datetime.now() - delta
+   LOG.info("Removing files created before %s" % threshold_date)
+
+   expired = []
+   for entry in list_prefixes(client, base and base + "/"):
+      try:
+         entry_date = datetime.strptime(entry, FOLDER_FORMAT)
+         LOG.debug("Inspecting %s (threshold=%s, todelete=%s)" % (
+            entry, threshold_date, entry_date<threshold_date ))
+         if entry_date < threshold_date:
+            LOG.info("Deleting %s" % entry)
+            expired.append(get_key(base, entry) + "/")
+      except ValueError, e:
+         LOG.warning( str(e) )
+
+   failed = []
+   if expired and not CONFIG.get("dry_run", False):
+      failed = delete_prefixes(client, expired)
+   if failed:
+      LOG.error("Some obsolete files could not be removed. They will be "
+            "retried by the next session.")
+   else:
+      LOG.info("All obsolete files successfully removed.")
+
+def run_s3(staging_area):
+   client = connect()
+   base = get_key(CONFIG.get('prefix', None))
+
+   # delete old files
+   timedelta_params = CONFIG.get('retention', None)
+   if timedelta_params:
+      remove_old_files(client, base, timedelta_params)
+
+   backup_prefix = get_key(base, datetime.now().strftime(FOLDER_FORMAT))
+   LOG.info("Uploading to s3://%s/%s/" % (CONFIG['bucket'], backup_prefix))
+   if CONFIG.get("dry_run", False):
+      for path, size, _ in list_local_files(staging_area):
+         LOG.info("Uploading %s (%d bytes)" % (path, size))
+      return
+
+   failed = upload(client, staging_area, backup_prefix)
+
+   session_manifest = manifest.load(staging_area)
+   if session_manifest and CONFIG.get('verify', 'size'):
+      sizes = list_objects(client, backup_prefix + "/")
+      def check(path, entry):
+         key = get_key(backup_prefix, path)
+         if path in failed or key not in sizes:
+            raise IOError("object was not uploaded")
+         return sizes[key], None
+      manifest.verify(session_manifest, check, "s3://%s" % CONFIG['bucket'])
+
+def run(staging_area):
+   try:
+      run_s3(staging_area)
+   except Exception, e:
+      LOG.exception(e)
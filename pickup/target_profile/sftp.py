@@ -0,0 +1,451 @@
+"""
+Uploads the staging folder to a remote host using SFTP. Like the ftp target,
+a new subfolder with the current date will be created on the remote host
+(f.ex.: '2010-11-01') and the staging area will be stored in that folder.
+
+Writes are pipelined: data is sent without waiting for the server to
+acknowledge each packet. Files are uploaded by several SFTP channels at the
+same time (see ``connections``), all running over one SSH connection. Files
+larger than ``chunk_size`` are split into parts which are written by several
+channels in parallel.
+
+Connections are shared with other profiles connecting to the same host, port
+and user (see `pickup.lib.sshpool`).
+
+Configuration
+~~~~~~~~~~~~~
+
+The following fields are used by this plugin:
+
+   **hostname** (string)
+      The hostname to connect to.
+
+   **username** (string)
+      The username to connect as.
+
+   **port** (int) *optional*
+      The port to connect to (default=22)
+
+   **password** (string) *optional*
+      The password for the user. (default=None)
+
+      .. note:: Leave this empty if you want to use private/public key
+                authentication (see: "key_filename")
+
+   **key_filename** (string|list of strings) *optional*
+      A filename (or list of filenames) used for private/public key
+      authentication.
+
+   **remote_folder** (string) *optional*
+      If specified, the backups will be rooted in this folder. Relative paths
+      are relative to the home folder of ``username``. If not specified, the
+      backups will be created in the home folder.
+
+   **retention** (dict) *optional*
+      How long the data should be kept. Everything older than this will be
+      deleted. The dictionary values will be passed as keyword arguments to
+      `datetime.timedelta
+      <http://docs.python.org/library/datetime.html#datetime.timedelta>`_. If
+      set to ``None``, the data will be kept indefinitely!
+
+      **Default:** ``None``
+
+      .. note:: This script uses the folder name to determine the date! All
+                folders that have a name not expected by this script, will
+                issue a warning.
+
+   **connections** (int) *optional*
+      The number of SFTP channels writing at the same time. Default: 4
+
+   **chunk_size** (int) *optional*
+      Files larger than this (in bytes) are split into parts of this size,
+      which are written in parallel. Default: 64 MiB
+
+   **window_size** (int) *optional*
+      The SSH window size (in bytes) of each channel. Default: 16 MiB
+
+   **max_packet_size** (int) *optional*
+      The maximum SSH packet size (in bytes) of each channel.
+      Default: 32 KiB
+
+   **verify** (string) *optional*
+      ``"size"`` compares the size of each uploaded file with the manifest of
+      the session. ``None`` disables the check. Default: ``"size"``
+
+   **dry_run** (boolean) *optional*
+      If set to ``True`` no files will be uploaded or deleted. Instead, the
+      operations will only be reported.
+
+Configuration Example
+~~~~~~~~~~~~~~~~~~~~~
+
+.. code-block:: python
+
+   dict(
+      name = "offsite",
+      profile = "sftp",
+      config = dict(
+         hostname = "backup.example.com",
+         username = "backup",
+         key_filename = "/root/.ssh/backup_rsa",
+         remote_folder = "pickup",
+         connections = 8,
+         retention = dict(
+               weeks=4
+            ),
+         )
+      ),
+
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+import posixpath
+import stat
+import threading
+import time
+
+import paramiko
+
+from pickup.lib import manifest, sshpool
+from pickup.lib.pipeline import throughput
+from pickup.lib.workers import run_parallel
+
+LOG = logging.getLogger(__name__)
+API_VERSION = (2,0)
+CONFIG = {}
+TARGET = {}
+FOLDER_FORMAT = "%Y-%m-%d"
+
+#: The default size of the parts of large files
+CHUNK_SIZE = 64 * 1024 * 1024
+
+#: The default SSH window size of each channel
+WINDOW_SIZE = 16 * 1024 * 1024
+
+#: The default maximum SSH packet size of each channel
+MAX_PACKET_SIZE = 32 * 1024
+
+#: The number of bytes passed to one write call
+BLOCK_SIZE = 1024 * 1024
+
+def init(target):
+   CONFIG.update(target['config'])
+   TARGET.update(target)
+   LOG.debug("Initialised '%s' with %r" % ( __name__, CONFIG))
+
+def folder():
+   return
+
+def connect():
+   """
+   Returns a (pooled) SSH connection to the remote host.
+   """
+   return sshpool.get_client(
+         hostname = CONFIG['hostname'],
+         port = CONFIG.get('port', 22),
+         username = CONFIG['username'],
+         password = CONFIG.get('password', None),
+         key_filename = CONFIG.get('key_filename', None)
+         )
+
+def open_sftp(client):
+   """
+   Open a new SFTP channel with the configured window and packet size.
+   """
+   return paramiko.SFTPClient.from_transport(client.get_transport(),
+         window_size = CONFIG.get('window_size', WINDOW_SIZE),
+         max_packet_size = CONFIG.get('max_packet_size', MAX_PACKET_SIZE))
+
+class ChannelPool(object):
+   """
+   Hands out one SFTP channel per thread. All channels share the SSH
+   connection of ``client``.
+   """
+
+   def __init__(self, client):
+      self.client = client
+      self._local = threading.local()
+      self._channels = []
+      self._lock = threading.Lock()
+
+   def get(self):
+      sftp = getattr(self._local, 'sftp', None)
+      if sftp is None:
+         sftp = open_sftp(self.client)
+         self._local.sftp = sftp
+         with self._lock:
+            self._channels.append(sftp)
+      return sftp
+
+   def close_all(self):
+      with self._lock:
+         channels, self._channels = self._channels, []
+         self._local = threading.local()
+      for sftp in channels:
+         sftp.close()
+
+def makedirs(sftp, path, known):
+   """
+   Create a remote folder and all missing parents.
+
+   @param known: A set of folders known to exist. It is updated.
+   """
+   if path in known or path in ("", "/"):
+      return
+   makedirs(sftp, posixpath.dirname(path), known)
+   try:
+      sftp.stat(path)
+   except IOError:
+      sftp.mkdir(path)
+   known.add(path)
+
+def list_local_files(staging_area):
+   """
+   List the folders and files of the staging area.
+
+   @return: A tuple (folders, files). Folders are relative paths (using
+            ``/``). Files are tuples (relative path, size, local filename).
+   """
+   folders = []
+   files = []
+   for root, dirs, filenames in os.walk(staging_area):
+      folder = os.path.relpath(root, staging_area).replace(os.sep, "/")
+      if folder != ".":
+         folders.append(folder)
+      for filename in filenames:
+         local_name = os.path.join(root, filename)
+         path = posixpath.normpath(posixpath.join(folder, filename))
+         files.append((path, os.path.getsize(local_name), local_name))
+   return folders, files
+
+def plan_jobs(files, chunk_size):
+   """
+   Split the files into write jobs. Large files are split into parts.
+
+   @return: A list of (relative path, local filename, offset, length)
+            tuples, largest first
+   """
+   jobs = []
+   for path, size, local_name in files:
+      if size <= chunk_size:
+         jobs.append((path, local_name, 0, size))
+         continue
+      for offset in range(0, size, chunk_size):
+         jobs.append((path, local_name, offset, min(chunk_size,
+            size - offset)))
+   jobs.sort(key=lambda job: job[3], reverse=True)
+   return jobs
+
+def write_part(sftp, remote_name, local_name, offset, length, create):
+   """
+   Write a part of a local file into a remote file.
+
+   @param create: Create (or truncate) the remote file. Otherwise the remote
+                  file must exist.
+   """
+   remote = sftp.open(remote_name, create and "wb" or "r+b")
+   try:
+      remote.set_pipelined(True)
+      remote.seek(offset)
+      with open(local_name, "rb") as local:
+         local.seek(offset)
+         remaining = length
+         while remaining > 0:
+            data = local.read(min(BLOCK_SIZE, remaining))
+            if not data:
+               break
+            remote.write(data)
+            remaining -= len(data)
+   finally:
+      # waits for the outstanding acknowledgements
+      remote.close()
+
+def upload(client, staging_area, backup_root):
+   """
+   Upload the staging area into ``backup_root``.
+
+   @return: A dictionary mapping relative paths to the remote size (or
+            ``None`` if the upload failed)
+   """
+   folders, files = list_local_files(staging_area)
+   sftp = open_sftp(client)
+   try:
+      known = set()
+      makedirs(sftp, backup_root, known)
+      for folder in folders:
+         makedirs(sftp, posixpath.join(backup_root, folder), known)
+
+      # Files split into parts are created (empty) first, so the parts can
+      # be written in any order.
+      chunk_size = CONFIG.get('chunk_size', CHUNK_SIZE)
+      for path, size, _ in files:
+         if size > chunk_size:
+            sftp.open(posixpath.join(backup_root, path), "wb").close()
+   finally:
+      sftp.close()
+
+   split = set(path for path, size, _ in files if size > chunk_size)
+   jobs = plan_jobs(files, chunk_size)
+   pool = ChannelPool(client)
+
+   def write(job):
+      path, local_name, offset, length = job
+      LOG.debug("Writing %s (%d bytes at %d)" % (path, length, offset))
+      write_part(pool.get(), posixpath.join(backup_root, path), local_name,
+            offset, length, path not in split)
+
+   LOG.info("Uploading %d files (%d parts) using %d channels" % (len(files),
+      len(jobs), CONFIG.get('connections', 4)))
+   start = time.time()
+   try:
+      results = run_parallel(write, jobs, CONFIG.get('connections', 4))
+   finally:
+      pool.close_all()
+   elapsed = time.time() - start
+   total = sum(size for _, size, _ in files)
+   LOG.info("Uploaded %d bytes in %.1fs (%s)" % (total, elapsed,
+      throughput(total, elapsed)))
+
+   failed = set()
+   for job, _, exc in results:
+      if exc:
+         LOG.error("Unable to upload %s (at %d): %s" % (job[0], job[2], exc))
+         failed.add(job[0])
+   sizes = {}
+   sftp = open_sftp(client)
+   try:
+      for path, _, _ in files:
+         if path in failed:
+            sizes[path] = None
+         else:
+            sizes[path] = sftp.stat(posixpath.join(backup_root, path)).st_size
+   finally:
+      sftp.close()
+   return sizes
+
+def list_tree(sftp, root):
+   """
+   Collect all files and folders below ``root``.
+
+   @return: A tuple (files, folders) of absolute paths. Folders are ordered
+            parents first.
+   """
+   files, folders = [], []
+   pending = [root]
+   while pending:
+      path = pending.pop(0)
+      for attr in sftp.listdir_attr(path):
+         child = posixpath.join(path, attr.filename)
+         if stat.S_ISDIR(attr.st_mode):
+            folders.append(child)
+            pending.append(child)
+         else:
+            files.append(child)
+   return files, folders
+
+def delete_trees(client, roots):
+   """
+   Delete remote folders recursively. The files are deleted by several
+   channels in parallel, then the folders, deepest first.
+
+   @return: The paths which could not be deleted
+   """
+   pool = ChannelPool(client)
+   workers = CONFIG.get('connections', 4)
+   start = time.time()
+   try:
+      files, folders = [], list(roots)
+      for root in roots:
+         tree_files, tree_folders = list_tree(pool.get(), root)
+         files.extend(tree_files)
+         folders.extend(tree_folders)
+
+      results = run_parallel(lambda path: pool.get().remove(path), files,
+            workers)
+      failed = [path for path, _, exc in results if exc]
+      for path in sorted(folders, key=lambda path: path.count("/"),
+            reverse=True):
+         try:
+            pool.get().rmdir(path)
+         except IOError, exc:
+            LOG.error("Unable to remove %r: %s" % (path, exc))
+            failed.append(path)
+   finally:
+      pool.close_all()
+
+   LOG.info("Deleted %d files and %d folders in %.1fs" % (
+      len(files), len(folders), time.time() - start))
+   if failed:
+      LOG.error("Unable to delete %d entries" % len(failed))
+   return failed
+
+def remove_old_files(client, base, timedelta_params):
+   delta = timedelta(**timedelta_params)
+   threshold_date = datetime.now() - delta
+   LOG.info("Removing files created before %s" % threshold_date)
+   sftp = open_sftp(client)
+   try:
+      entries = sorted(sftp.listdir(base))
+   finally:
+      sftp.close()
+
+   expired = []
+   for entry in entries:
+      try:
+         entry_date = datetime.strptime(entry, FOLDER_FORMAT)
+         LOG.debug("Inspecting %s (threshold=%s, todelete=%s)" % (
+            entry, threshold_date, entry_date<threshold_date ))
+         if entry_date < threshold_date:
+            LOG.info("Deleting %s" % entry)
+            expired.append(posixpath.join(base, entry))
+      except ValueError, e:
+         LOG.warning( str(e) )
+
+   failed = []
+   if expired and not CONFIG.get("dry_run", False):
+      failed = delete_trees(client, expired)
+   if failed:
+      LOG.error("Some obsolete files could not be removed. They will be "
+            "retried by the next session.")
+   else:
+      LOG.info("All obsolete files successfully removed.")
+
+def run_sftp(staging_area):
+   client = connect()
+   sftp = open_sftp(client)
+   try:
+      base = posixpath.normpath(posixpath.join(sftp.normalize("."),
+         CONFIG.get('remote_folder', None) or ""))
+      makedirs(sftp, base, set())
+   finally:
+      sftp.close()
+
+   # delete old files
+   timedelta_params = CONFIG.get('retention', None)
+   if timedelta_params:
+      remove_old_files(client, base, timedelta_params)
+
+   backup_root = posixpath.join(base, datetime.now().strftime(FOLDER_FORMAT))
+   LOG.info("Uploading to %s:%s" % (CONFIG['hostname'], backup_root))
+   if CONFIG.get("dry_run", False):
+      for path, size, _ in list_local_files(staging_area)[1]:
+         LOG.info("Uploading %s (%d bytes)" % (path, size))
+      return
+
+   sizes = upload(client, staging_area, backup_root)
+
+   session_manifest = manifest.load(staging_area)
+   if session_manifest and CONFIG.get('verify', 'size'):
+      def check(path, entry):
+         if sizes.get(path) is None:
+            raise IOError("file was not uploaded")
+         return sizes[path], None
+      manifest.verify(session_manifest, check, CONFIG['hostname'])
+
+def run(staging_area):
+   try:
+      run_sftp(staging_area)
+   except Exception, e:
+      LOG.exception(e)
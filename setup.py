@@ -9,6 +9,9 @@ setup(
       'mysql-python',
       'psycopg2',
       ],
+   extras_require = {
+      's3': ['boto3'],
+      },
    author = "Michel Albert",
    author_email = "michel@albert.lu",
    description = "Modular backup script",